@@ -1,8 +1,8 @@
 #!/bin/sh
 set -e
 
-# Initialize settings.py if it doesn't exist in the data volume
-if [ ! -f /data/settings.py ]; then
+# Initialize settings.py if the data volume has no configuration file
+if [ ! -f /data/settings.toml ] && [ ! -f /data/settings.json ] && [ ! -f /data/settings.py ]; then
     echo "No settings.py found in /data, creating from available template..."
     # Prefer settings.py if it exists in the image, otherwise use example
     if [ -f /app/settings.py ]; then
@@ -15,8 +15,11 @@ if [ ! -f /data/settings.py ]; then
     echo "Configure via web UI at http://<host>:${WEBAPP_PORT:-5883}"
 fi
 
-# Use settings from data volume
-ln -sf /data/settings.py /app/settings.py
+# Use settings from data volume; both apps search /data first, so a
+# settings.toml or settings.json there is used without the link
+if [ -f /data/settings.py ]; then
+    ln -sf /data/settings.py /app/settings.py
+fi
 
 # Start the Flask web application in the background
 echo "Starting web interface on port ${WEBAPP_PORT:-5883}..."
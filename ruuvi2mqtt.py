@@ -9,17 +9,27 @@ Ruuvi integration but read the sensors data straight from MQTT broker.
 """
 
 import asyncio
+import atexit
 import logging
 import datetime
 import json
 import os
 import sys
+import time
 import platform
 from paho.mqtt.client import Client
 from paho.mqtt.enums import CallbackAPIVersion
 from ruuvitag_sensor.ruuvi import RuuviTagSensor
-from settings import my_brokers
-from settings import my_ruuvis
+import ruuvi_config
+import ruuvi_derived
+import ruuvi_discovery
+import ruuvi_fleet
+import ruuvi_health
+import ruuvi_logging
+import ruuvi_outbound
+import ruuvi_profiling
+import ruuvi_reading
+import ruuvi_tags
 
 def get_version():
     """Get version from VERSION file."""
@@ -32,21 +42,132 @@ def get_version():
 
 __version__ = get_version()
 
+# settings.toml, settings.json or settings.py in /data or next to this
+# file, validated at startup
+CONFIG = ruuvi_config.load(ruuvi_config.find())
+my_brokers = CONFIG.brokers  # pylint: disable=invalid-name
+my_ruuvis = CONFIG.ruuvis  # pylint: disable=invalid-name
+
+def get_setting(name, default=None):
+    """Get an optional value from the configuration.
+
+    Args:
+        name (str): Name of the setting.
+        default: Value returned when the setting is not defined.
+
+    Returns:
+        The configured value or the default.
+    """
+    return CONFIG.get(name, default)
+
 logging.basicConfig(
-    format='%(asctime)s %(levelname)-8s %(message)s',
+    format=ruuvi_logging.LOG_FORMAT,
     level=logging.INFO,
-    datefmt='%Y-%m-%d %H:%M:%S'
+    datefmt=ruuvi_logging.LOG_DATEFMT
 )
 
 MYHOSTNAME = platform.node()
 FOUND_RUUVIS = []
 CLIENTS = {}
 SEND_SINGLE_VALUES = False  # pylint: disable=invalid-name
-LAST_DATA_TIME = {}
 LAST_DISCOVERY_RESEND = None
 DISCOVERY_RESEND_INTERVAL = 3600
 LAST_BLE_RECEIVE = None  # Track last Bluetooth receive time
 WATCHDOG_TIMEOUT = 60  # 1 minute without any BLE data triggers restart
+# Fields published one per topic in single value mode (-s), sent when changed
+SINGLE_VALUES = ruuvi_outbound.SingleValues(
+    get_setting('single_fields', ruuvi_outbound.SINGLE_FIELDS))
+# Minimum seconds between log records per message template and first argument
+DEFAULT_LOG_RATE_LIMITS = {
+    "Not found %s. Using topic home/%s": 60,
+}
+# Persistent files (profiles etc.) go to the Docker data volume when present
+DATA_DIR = ruuvi_config.data_dir(CONFIG)
+PROFILE_TOPIC = f"ruuvi2mqtt/{MYHOSTNAME}/profile"
+PROFILER = ruuvi_profiling.Profiler(DATA_DIR, f"ruuvi2mqtt-{MYHOSTNAME}")
+# Seconds without data before a tag is reported offline on home/<room>/availability
+TAG_TIMEOUT = get_setting('tag_timeout', 300)
+AVAILABILITY = ruuvi_tags.StalenessTracker(TAG_TIMEOUT)
+# Derived metrics added to every reading, e.g. ["dew_point", "vpd"]
+ENRICHER = ruuvi_derived.Enricher(get_setting('derived_metrics', []))
+# "sensor": one retained config per sensor, "device": one per tag
+DISCOVERY_MODE = get_setting('discovery_mode', 'sensor')
+# Skip discovery configs the brokers already hold (see ruuvi_discovery)
+DISCOVERY_INDEX = (
+    ruuvi_discovery.DiscoveryIndex() if get_setting('discovery_diff', True) else None
+)
+DISCOVERY_INDEX_FILE = "discovery_index.json"
+# Packet loss and RSSI of every tag on home/<room>/link
+LINK_STATS_INTERVAL = get_setting('link_stats_interval', 300)  # 0 disables
+LINK_STATS_WINDOW = get_setting('link_stats_window', 256)
+LINK_STATS_TIMER = ruuvi_tags.Interval(LINK_STATS_INTERVAL)
+# Unconfigured tags kept at most, and seconds they are kept after last seen
+TAGS = ruuvi_tags.TagRegistry(
+    get_setting('max_unknown_tags', 256), get_setting('unknown_tag_ttl', 3600),
+    link_window=LINK_STATS_WINDOW if LINK_STATS_INTERVAL else 0
+)
+# Clear the retained discovery and availability topics of evicted tags
+CLEANUP_EVICTED_DISCOVERY = get_setting('cleanup_evicted_discovery', False)
+# Unconfigured tags are written here for the web UI at most every interval
+UNKNOWN_TAGS_FILE = "detected_ruuvis.json"
+UNKNOWN_TAGS_TIMER = ruuvi_tags.Interval(60, first=True)
+# Optional subsystems are imported only when enabled, to keep startup fast
+def create_sinks():
+    """Create the sinks of the sinks setting."""
+    configs = get_setting('sinks', [])
+    if not configs:
+        return []
+    import ruuvi_sinks  # pylint: disable=import-outside-toplevel
+    return ruuvi_sinks.create_sinks(configs, DATA_DIR)
+
+def create_tracer():
+    """Create the latency tracer if latency_tracing is set."""
+    if not get_setting('latency_tracing', False):
+        return None
+    import ruuvi_latency  # pylint: disable=import-outside-toplevel
+    return ruuvi_latency.LatencyTracer()
+
+def create_snapshot():
+    """Create the latest-value table if snapshot is set."""
+    options = get_setting('snapshot', {})
+    if not options:
+        return None
+    import ruuvi_snapshot  # pylint: disable=import-outside-toplevel
+    return ruuvi_snapshot.SnapshotTable(MYHOSTNAME, **dict(options))
+
+def create_load_generator():
+    """Create the load generator if load_generator is set."""
+    options = get_setting('load_generator', {})
+    if not options:
+        return None
+    import ruuvi_loadgen  # pylint: disable=import-outside-toplevel
+    return ruuvi_loadgen.LoadGenerator(**dict(options))
+
+SINKS = create_sinks()
+SNAPSHOT = create_snapshot()  # Retained state of all tags on home/_snapshot/<gateway>
+TRACER = create_tracer()
+LATENCY_IN_PAYLOAD = get_setting('latency_in_payload', False)
+BROKER_QOS = {}  # broker -> QoS of the readings
+LOAD_GENERATOR = create_load_generator()
+# Optional split into a capture process and publisher processes
+MULTIPROCESS = get_setting('multiprocess')
+RING = None  # ruuvi_shm.ReadingRing between the capture and publisher processes
+PUBLISHERS = {}  # name -> multiprocessing.Process, in the capture process
+PUBLISHER_CONNECTED = {}  # name -> shared number of connected brokers
+CONNECTED = None  # The shared value of this publisher process
+BROKER_GROUP = None  # Brokers of this per_broker publisher; None handles all brokers
+PRIMARY = True  # Writes the data files and sinks; False in other publishers
+STARTUP = ruuvi_health.StartupTimer()
+STARTUP_GRACE = get_setting('startup_grace', ruuvi_health.STARTUP_GRACE)
+HEALTH_PORT = int(os.environ.get('HEALTH_PORT', get_setting('health_port', 5884)))  # 0 disables
+# Optional fleet configuration on a retained topic of one broker
+FLEET_FILE = "fleet_config.json"
+FLEET = (ruuvi_fleet.FleetSync(MYHOSTNAME, get_setting('fleet'),
+                               os.path.join(DATA_DIR, FLEET_FILE))
+         if get_setting('fleet') else None)
+# Gateway metrics are published here every metrics_interval seconds
+METRICS_TOPIC = f"ruuvi2mqtt/{MYHOSTNAME}/metrics"
+METRICS_TIMER = ruuvi_tags.Interval(get_setting('metrics_interval', 60))
 
 def send_single(jdata, keyname, client):
     """Send a single sensor value to the MQTT broker.
@@ -60,9 +181,89 @@ def send_single(jdata, keyname, client):
         None
     """
     topic = f"{jdata['room']}/{keyname}"
-    logging.info("%s: %s", topic, jdata[keyname])
+    logging.debug("%s: %s", topic, jdata[keyname])
     client.publish(topic, jdata[keyname])
 
+def send_single_values(jdata, broker):
+    """Send the changed single values of SINGLE_VALUES to one broker.
+
+    Args:
+        jdata (dict): The data dictionary containing sensor values.
+        broker (str): Name of the broker in CLIENTS.
+
+    Returns:
+        list: Keys that were published.
+    """
+    sent = SINGLE_VALUES.changed(broker, jdata)
+    for key in sent:
+        send_single(jdata, key, CLIENTS[broker])
+    if sent:
+        logging.info("%s: sent %d single values to %s: %s",
+                     jdata['room'], len(sent), broker, ", ".join(sent))
+    return sent
+
+def availability_topic(room):
+    """Return the availability topic of a room."""
+    return f"home/{room}/availability"
+
+def publish_availability(room, state):
+    """Publish retained availability of a room to all brokers.
+
+    Args:
+        room (str): The room identifier.
+        state (str): "online" or "offline".
+
+    Returns:
+        None
+    """
+    logging.info("%s is %s", room, state)
+    for broker in my_brokers:
+        CLIENTS[broker].publish(availability_topic(room), state, retain=True)
+
+def update_availability(room=None):
+    """Publish availability changes, marking a room as seen first.
+
+    Online rooms are resent to the brokers queued for it, and rooms not
+    seen within TAG_TIMEOUT are reported offline. Only the tags that are
+    due are looked at, so this stays cheap with many tags.
+
+    Args:
+        room (str): The room identifier of the current reading, or None.
+
+    Returns:
+        None
+    """
+    brokers = [broker for broker in AVAILABILITY.resends() if broker in CLIENTS]
+    rooms = AVAILABILITY.online() if brokers else None  # Copied only when needed
+    if rooms:
+        logging.info("Resending availability of %d rooms to %s",
+                     len(rooms), ", ".join(brokers))
+        for online_room in rooms:
+            for broker in brokers:
+                CLIENTS[broker].publish(availability_topic(online_room), "online", retain=True)
+    if room is not None and AVAILABILITY.touch(room):
+        publish_availability(room, "online")
+    for stale_room in AVAILABILITY.expire():
+        publish_availability(stale_room, "offline")
+
+def discovery_configs(room, mac, link=False):
+    """Build the discovery configs of a room for the configured DISCOVERY_MODE.
+
+    Args:
+        room (str): The room identifier.
+        mac (str): MAC address of the tag.
+        link (bool): Include the link statistics sensors.
+
+    Returns:
+        list: (topic, payload) tuples.
+    """
+    sensors = ruuvi_discovery.sensors(MYHOSTNAME, ENRICHER.discovery_sensors(),
+                                      link and bool(LINK_STATS_INTERVAL))
+    if DISCOVERY_MODE == "device":
+        return ruuvi_discovery.device_configs(room, mac, sensors, availability_topic(room),
+                                              __version__)
+    return ruuvi_discovery.sensor_configs(room, mac, sensors, availability_topic(room))
+
 def publish_discovery_config(room, found_data):
     """Publish discovery configuration to Home Assistant.
 
@@ -74,59 +275,49 @@ def publish_discovery_config(room, found_data):
         None
     """
     jdata = found_data[1]
-    sendvals = {
-        "temperature": {"class": "temperature", "unit": "°C"},
-        "humidity": {"class": "humidity", "unit": "%"},
-        "pressure": {"class": "pressure", "unit": "hPa"},
-        "battery": {"class": "voltage", "unit": "mV"},
-        "acceleration": {"class": None, "unit": "mG"},
-        "acceleration_x": {"class": None, "unit": "mG"},
-        "acceleration_y": {"class": None, "unit": "mG"},
-        "acceleration_z": {"class": None, "unit": "mG"},
-        f"rssi_{MYHOSTNAME}": {"class": None, "unit": "dBm"},
-        "movement_counter": {"class": None, "unit": "times"}
-    }
-
-    for sensor_key, sensor_data in sendvals.items():
-        payload = {
-            "state_topic": f"home/{room}",
-            "unit_of_measurement": f"{sensor_data['unit']}",
-            "value_template": "{{ value_json." + sensor_key + " }}",
-            "unique_id": f"ruuvi{jdata['mac']}{sensor_key}",
-            "object_id": f"{room}_{sensor_key}",
-            "name": f"{sensor_key}",
-            "device": {
-                "identifiers": [
-                    f"{room}"
-                ],
-                "name": f"{room}",
-                "manufacturer": "Ruuvi",
-                "model": "Ruuvitag"
-            }
-        }
-        if sensor_data['class'] is not None:
-            payload.update({"device_class": f"{sensor_data['class']}"})
-        topic = f"homeassistant/sensor/{room}_{sensor_key}/config"
-        my_data = json.dumps(payload).replace("'", '"')
-        logging.info("%s: %s", topic, my_data)
-        for broker in my_brokers:
-            CLIENTS[broker].publish(topic, my_data, retain=True)
+    # Tags without a sequence number have no link statistics to show
+    configs = discovery_configs(room, jdata['mac'],
+                                'measurement_sequence_number' in jdata)
+    published = ruuvi_discovery.publish(
+        configs, {broker: CLIENTS[broker] for broker in my_brokers}, DISCOVERY_INDEX)
+    if published:
+        logging.info("Published discovery config for %s (%d messages)", room, published)
+    else:
+        logging.debug("Discovery config for %s unchanged on all brokers", room)
 
-def handle_data(found_data):
+def is_own_discovery_topic(topic):
+    """Check if a discovery topic belongs to one of our tags."""
+    return ruuvi_discovery.is_own_topic(topic, CONFIG.rooms, CONFIG.discovery_prefixes)
+
+def handle_data(found_data, received=None):
     """Handle Ruuvi tag sensor data.
 
     Args:
-        found_data (tuple): Tuple containing room identifier and sensor data.
+        found_data: ruuvi_reading.Reading, or a tuple of the MAC address
+            and sensor data.
+        received (float): time.perf_counter() when the data was received,
+            now if None. Ignored for a Reading.
 
     Returns:
         None
     """
+    reading = ruuvi_reading.from_found(found_data, received)
+    if not STARTUP.done:
+        STARTUP.mark("first_reading")
+    if FLEET is not None and FLEET.pending is not None:
+        apply_fleet_config()
+    PROFILER.poll()
+    with PROFILER.timers.stage("handle_data"):
+        _handle_data(reading)
+
+def _handle_data(reading):
+    """Handle Ruuvi tag sensor data, see handle_data()."""
     global LAST_DISCOVERY_RESEND
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
-    mac = found_data[0]
-
-    # Track last data time for each sensor
-    LAST_DATA_TIME[mac] = now
+    if TRACER is not None:
+        TRACER.stage("enqueue", reading.received)
+    now = reading.now
+    mac = reading.mac
+    jdata = reading.data
 
     # Periodic discovery resend (once per hour)
     time_since_last_discovery = (
@@ -140,40 +331,197 @@ def handle_data(found_data):
         )
         force_rediscovery()
         LAST_DISCOVERY_RESEND = now
+    elif DISCOVERY_INDEX is not None and DISCOVERY_INDEX.finish_sync():
+        logging.info("Brokers are missing discovery configs, resending")
+        force_rediscovery()
 
-    logging.debug(found_data)
+    logging.debug("%s: %s", mac, jdata)
     try:
-        room = my_ruuvis[found_data[0]]
+        room = my_ruuvis[mac]
         if room not in FOUND_RUUVIS:
-            publish_discovery_config(room, found_data)
+            publish_discovery_config(room, (mac, jdata))
             FOUND_RUUVIS.append(room)
     except KeyError as key_error:
-        room = f"Ruuvi-{found_data[0].replace(':', '')}"
+        room = f"Ruuvi-{mac.replace(':', '')}"
         if room not in FOUND_RUUVIS:
             logging.debug(key_error)
             logging.warning(
-                "Not found %s. Using topic home/%s", found_data[0], room
+                "Not found %s. Using topic home/%s", mac, room
             )
-            with open("detected_ruuvis.txt", "a", encoding="utf-8") as file_handle:
-                file_handle.write(f"{now.isoformat()} {room} {found_data}\n")
-            publish_discovery_config(room, found_data)
+            publish_discovery_config(room, (mac, jdata))
             FOUND_RUUVIS.append(room)
-    topic = "home/" + room
+    track_tag(mac, room, jdata, now)
+    topic = CONFIG.topics.get(room) or "home/" + room
     logging.debug(room)
-    jdata = found_data[1]
-    jdata.update({"room": room})
-    jdata.update({"client": MYHOSTNAME})
-    jdata.update({"ts": now.timestamp()})
-    jdata.update({"ts_iso": now.isoformat()})
-    jdata.update({f"rssi_{MYHOSTNAME}": jdata['rssi']})
-    my_data = json.dumps(jdata).replace("'", '"')
+    if ENRICHER:
+        ENRICHER.enrich(mac, jdata)
+    reading.room = room
+    reading.client = MYHOSTNAME
+    update_availability(room)
+    publish_reading(topic, reading)
+    if SNAPSHOT is not None:
+        SNAPSHOT.update(room, mac, jdata, reading.timestamp)
+        publish_snapshot()
+    logging.debug("-" * 40)
+
+def publish_reading(topic, reading):
+    """Serialize a reading and publish it to all brokers and sinks.
+
+    Args:
+        topic (str): State topic of the room.
+        reading (ruuvi_reading.Reading): The reading with room and client set.
+
+    Returns:
+        None
+    """
+    received = reading.received
+    if LATENCY_IN_PAYLOAD:
+        reading.add("latency_ms", round((time.perf_counter() - received) * 1000, 3))
+    with PROFILER.timers.stage("serialize"):
+        my_data = reading.payload()
     logging.debug(my_data)
+    if TRACER is not None:
+        TRACER.stage("serialize", received)
+    with PROFILER.timers.stage("publish"):
+        for broker in my_brokers:
+            info = CLIENTS[broker].publish(topic, my_data, qos=BROKER_QOS.get(broker, 0))
+            if TRACER is not None and info is not None:
+                TRACER.sent(broker, info.mid, received)
+            if SEND_SINGLE_VALUES:
+                send_single_values(reading.as_dict(), broker)
+    if TRACER is not None:
+        TRACER.stage("publish", received)
+    if not STARTUP.done:
+        STARTUP.finish("first_publish")
+    for sink in SINKS:
+        sink.submit(reading)
+
+def publish_snapshot():
+    """Publish the retained snapshot of all tags to all brokers if due."""
+    if SNAPSHOT is None or not SNAPSHOT.due():
+        return
+    my_data = SNAPSHOT.payload()
+    logging.debug("%s: %d tags", SNAPSHOT.topic, len(SNAPSHOT))
     for broker in my_brokers:
-        CLIENTS[broker].publish(topic, my_data)
-        if SEND_SINGLE_VALUES:
-            for key in jdata:
-                send_single(jdata, key, CLIENTS[broker])
-    logging.debug("-" * 40)
+        CLIENTS[broker].publish(SNAPSHOT.topic, my_data, retain=True)
+
+def collect_metrics():
+    """Return the gateway metrics published on METRICS_TOPIC."""
+    metrics = {"client": MYHOSTNAME, "tags": len(TAGS), "log_dropped": ruuvi_logging.dropped()}
+    outbound = ruuvi_outbound.publisher_metrics({broker: CLIENTS[broker] for broker in my_brokers})
+    if outbound:
+        metrics["outbound"] = outbound
+    if SINKS:
+        metrics["sinks"] = {sink.name: sink.metrics() for sink in SINKS}
+    if TRACER is not None:
+        metrics["latency"] = TRACER.summary()
+    if LOAD_GENERATOR is not None:
+        metrics["load_generator"] = LOAD_GENERATOR.stats()
+    if RING is not None:
+        metrics["ring"] = RING.metrics()
+    return metrics
+
+def publish_metrics(now):
+    """Publish gateway metrics to all brokers if due at the reading time now."""
+    if not METRICS_TIMER.due(now):  # First metrics after one full interval
+        return
+    my_data = json.dumps(collect_metrics())
+    logging.debug("%s: %s", METRICS_TOPIC, my_data)
+    for broker in my_brokers:
+        CLIENTS[broker].publish(METRICS_TOPIC, my_data)
+
+def track_tag(mac, room, jdata, now):
+    """Update the bookkeeping of a tag and publish the periodic reports.
+
+    Args:
+        mac (str): MAC address of the tag.
+        room (str): The room identifier.
+        jdata (dict): Decoded sensor data.
+        now (datetime.datetime): Time of the current reading.
+
+    Returns:
+        None
+    """
+    TAGS.touch(mac, room, mac in my_ruuvis, jdata.get('rssi'),
+               seq=jdata.get('measurement_sequence_number'))
+    for record in TAGS.evict():
+        forget_tag(record)
+    save_unknown_tags(now)
+    publish_metrics(now)
+    publish_link_stats(now)
+
+def publish_link_stats(now):
+    """Publish the link statistics of every tag to home/<room>/link if due.
+
+    Each message covers the packets since the previous one.
+
+    Args:
+        now (datetime.datetime): Time of the current reading.
+
+    Returns:
+        None
+    """
+    if not LINK_STATS_TIMER.due(now):
+        return
+    for room, stats in TAGS.link_reports():
+        stats.update({"client": MYHOSTNAME, "ts": now.timestamp()})
+        my_data = json.dumps(stats)
+        for broker in my_brokers:
+            CLIENTS[broker].publish(f"home/{room}/link", my_data)
+
+def save_unknown_tags(now):
+    """Write the unconfigured tags to UNKNOWN_TAGS_FILE if due at now and changed."""
+    if not PRIMARY or not UNKNOWN_TAGS_TIMER.due(now):
+        return
+    try:
+        TAGS.save_unknown(os.path.join(DATA_DIR, UNKNOWN_TAGS_FILE))
+    except OSError as exc:
+        logging.warning("Could not save unknown tags: %s", exc)
+
+def forget_tag(record):
+    """Drop all state of an evicted unconfigured tag.
+
+    Its retained topics are cleared with CLEANUP_EVICTED_DISCOVERY, otherwise
+    it is only reported offline.
+
+    Args:
+        record (ruuvi_tags.TagRecord): The evicted tag.
+
+    Returns:
+        None
+    """
+    logging.info("Forgetting unconfigured tag %s (%s)", record.mac, record.room)
+    ENRICHER.forget(record.mac)
+    forget_room(record.room, record.mac, CLEANUP_EVICTED_DISCOVERY)
+
+def forget_room(room, mac, clear_retained):
+    """Drop the per-room state of a tag that left the room.
+
+    Args:
+        room (str): The room identifier the tag was published as.
+        mac (str): MAC address of the tag.
+        clear_retained (bool): Clear the retained discovery and
+            availability topics with empty messages instead of only
+            reporting the room offline.
+
+    Returns:
+        None
+    """
+    if SNAPSHOT is not None:
+        SNAPSHOT.remove(room)
+    if room in FOUND_RUUVIS:
+        FOUND_RUUVIS.remove(room)
+    SINGLE_VALUES.forget_room(room)
+    online = room in AVAILABILITY
+    AVAILABILITY.remove(room)
+    if not clear_retained:
+        if online:
+            publish_availability(room, "offline")
+        return
+    topics = [topic for topic, _ in discovery_configs(room, mac, link=True)]
+    topics.append(availability_topic(room))
+    ruuvi_discovery.clear(topics, {broker: CLIENTS[broker] for broker in my_brokers},
+                          DISCOVERY_INDEX)
 
 def force_rediscovery():
     """Force re-sending of all discovery messages.
@@ -184,6 +532,8 @@ def force_rediscovery():
     global FOUND_RUUVIS
     logging.info("Forcing discovery resend for all %d sensors", len(FOUND_RUUVIS))
     FOUND_RUUVIS = []
+    SINGLE_VALUES.forget()
+    AVAILABILITY.request_resend(*my_brokers)
 
 def on_connect(client, userdata, flags, return_code, properties=None):
     """MQTT on_connect callback function.
@@ -203,10 +553,20 @@ def on_connect(client, userdata, flags, return_code, properties=None):
     logging.debug("%s %x %x", userdata, flags, properties)
     if return_code == 0:
         logging.info("MQTT Connection successful")
+        STARTUP.mark("connected")
         result = client.subscribe("homeassistant/status")
         logging.info("Subscribed to homeassistant/status, result: %s", result)
+        client.subscribe(PROFILE_TOPIC)
+        if FLEET is not None and userdata == FLEET.broker:
+            client.subscribe(FLEET.topic, qos=1)
+        if DISCOVERY_INDEX is not None:
+            DISCOVERY_INDEX.begin_sync(userdata)
+            for topic in ruuvi_discovery.CONFIG_TOPICS:
+                client.subscribe(topic)
         logging.info("Clearing discovery cache to force resend on reconnection")
         FOUND_RUUVIS = []
+        SINGLE_VALUES.forget()
+        AVAILABILITY.request_resend(userdata)
     else:
         logging.error("Bad MQTT connection, return code: %s", return_code)
 
@@ -215,21 +575,51 @@ def on_message(client, userdata, msg, properties=None):
 
     Args:
         client (mqtt.Client): The MQTT client.
-        userdata: The user data.
+        userdata: The user data, the broker name.
         msg (mqtt.MQTTMessage): The received MQTT message.
 
     Returns:
         None
     """
+    if msg.topic.startswith("homeassistant/") and msg.topic.endswith("/config"):
+        if DISCOVERY_INDEX is not None and is_own_discovery_topic(msg.topic):
+            DISCOVERY_INDEX.observe(userdata, msg.topic, msg.payload)
+        return
+    if FLEET is not None and msg.topic == FLEET.topic:
+        FLEET.receive(msg.payload)
+        return
     payload = msg.payload.decode()
     logging.info("Received MQTT message on topic %s: %s", msg.topic, payload)
     logging.debug("%s %s %s", client, userdata, properties)
-    if payload == "online":
+    if msg.topic == PROFILE_TOPIC:
+        PROFILER.request(payload)
+    elif payload == "online":
         logging.warning(
             "Home Assistant sent 'online' status - forcing discovery resend"
         )
         force_rediscovery()
 
+def on_publish(client, userdata, mid, reason_code=None, properties=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """MQTT on_publish callback function.
+
+    Records the acknowledgement for latency tracing and tells a conflating
+    publisher of the broker that capacity frees up; its pending messages
+    are sent from the main thread by housekeeping().
+
+    Args:
+        client (mqtt.Client): The MQTT client.
+        userdata: The user data, the broker name.
+        mid (int): Message id of the published message.
+
+    Returns:
+        None
+    """
+    if TRACER is not None:
+        TRACER.acked(userdata, mid)
+    ruuvi_outbound.acknowledge(CLIENTS.get(userdata), client, userdata, mid, reason_code,
+                               properties)
+
 def on_disconnect(client, userdata, flags, return_code, properties=None):
     """MQTT on_disconnect callback function.
 
@@ -258,19 +648,87 @@ def connect_brokers(brokers):
     for broker in brokers:
         logging.info("Connecting Broker: %s %s", broker, brokers[broker])
         # CLIENTS[broker] = Client(f"{MYHOSTNAME}-ruuviclient")
-        CLIENTS[broker] = Client(
-            CallbackAPIVersion.VERSION2, f"{MYHOSTNAME}-ruuviclient"
+        client = Client(
+            CallbackAPIVersion.VERSION2, f"{MYHOSTNAME}-ruuviclient", userdata=broker
         )
-        CLIENTS[broker].on_connect = on_connect
-        CLIENTS[broker].on_disconnect = on_disconnect
-        CLIENTS[broker].on_message = on_message
-        CLIENTS[broker].connect_async(
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_message = on_message
+        client.on_publish = on_publish
+        BROKER_QOS[broker] = brokers[broker].get('qos', 0)
+        client.connect_async(
             brokers[broker]['host'], brokers[broker]['port'], 60
         )
-        logging.info("Connection OK %s %s", CLIENTS[broker], brokers[broker])
-        CLIENTS[broker].loop_start()
+        logging.info("Connection OK %s %s", client, brokers[broker])
+        client.loop_start()
+        CLIENTS[broker] = ruuvi_outbound.wrap(client, brokers[broker], MYHOSTNAME)
     return CLIENTS
 
+def disconnect_broker(broker):
+    """Flush and disconnect a broker and drop its state.
+
+    Args:
+        broker (str): Broker name.
+
+    Returns:
+        None
+    """
+    publisher = CLIENTS.pop(broker, None)
+    if publisher is None:
+        return
+    logging.info("Disconnecting Broker: %s", broker)
+    ruuvi_outbound.close(publisher)
+    BROKER_QOS.pop(broker, None)
+    SINGLE_VALUES.forget(broker)
+
+def switch_config(config):
+    """Switch to a new configuration without restarting.
+
+    Tags that changed room leave their old room like evicted tags, with
+    its retained topics cleared; the new room is announced with their
+    next reading. Added, removed and changed brokers are connected and
+    disconnected, in a per_broker publisher only its own. Everything else
+    is left as it is.
+
+    Args:
+        config (ruuvi_config.Config): The new configuration.
+
+    Returns:
+        dict: The changes, see ruuvi_fleet.changes().
+    """
+    global CONFIG, my_ruuvis, my_brokers  # pylint: disable=invalid-name
+    changes = ruuvi_fleet.changes(CONFIG, config)
+    for mac in changes['moved']:
+        record = TAGS.get(mac)
+        if record is not None:
+            logging.info("Tag %s leaves room %s", mac, record.room)
+            forget_room(record.room, mac, True)
+    for broker in changes['brokers_removed'] + changes['brokers_changed']:
+        if BROKER_GROUP is None or broker in BROKER_GROUP:
+            disconnect_broker(broker)
+    CONFIG = config
+    my_ruuvis = config.ruuvis
+    my_brokers = {broker: options for broker, options in config.brokers.items()
+                  if BROKER_GROUP is None or broker in BROKER_GROUP}
+    connect_brokers({broker: my_brokers[broker] for broker in my_brokers
+                     if broker in changes['brokers_added'] + changes['brokers_changed']})
+    return changes
+
+def apply_fleet_config():
+    """Apply the fleet configuration received last and acknowledge it, retained."""
+    payload = FLEET.apply(CONFIG, switch_config)
+    publisher = CLIENTS.get(FLEET.broker)
+    if payload is not None and publisher is not None:
+        publisher.publish(FLEET.status_topic, payload, qos=1, retain=True)
+
+def restore_fleet_config():
+    """Use the tag mapping of the last applied fleet configuration."""
+    global CONFIG, my_ruuvis  # pylint: disable=invalid-name
+    config = FLEET.restore(CONFIG)
+    if config is not None:
+        CONFIG = config
+        my_ruuvis = config.ruuvis
+
 async def bluetooth_watchdog():
     """Monitor Bluetooth scanning health and restart if needed.
 
@@ -282,7 +740,15 @@ exits to allow container restart.
         None
     """
     while True:
-        await asyncio.sleep(60)  # Check every minute
+        for _ in range(60):  # Check every minute, do the housekeeping every second
+            await asyncio.sleep(1)
+            housekeeping()
+
+        exited = [name for name, process in PUBLISHERS.items() if not process.is_alive()]
+        if exited:
+            logging.error("Publisher processes exited: %s. Exiting for container restart.",
+                          ", ".join(exited))
+            sys.exit(1)
 
         if LAST_BLE_RECEIVE is None:
             # Still waiting for first message
@@ -307,6 +773,18 @@ exits to allow container restart.
                 time_since_last,
                 WATCHDOG_TIMEOUT
             )
+
+def housekeeping():
+    """Do the periodic work that must not wait for the next reading.
+
+    Called every second from the watchdog, and by publisher processes while idle.
+    """
+    if FLEET is not None and FLEET.pending is not None:
+        apply_fleet_config()
+    update_availability()
+    for publisher in list(CLIENTS.values()):
+        ruuvi_outbound.flush_due(publisher)
+
 async def main():
     """Main async function for Bluetooth scanning.
 
@@ -324,14 +802,20 @@ async def main():
     # Start the watchdog task
     watchdog_task = asyncio.create_task(bluetooth_watchdog())
 
+    if LOAD_GENERATOR is not None:
+        logging.warning("Using the load generator with %d virtual tags instead of Bluetooth",
+                        len(LOAD_GENERATOR.tags))
+        source = LOAD_GENERATOR.readings()
+    else:
+        source = RuuviTagSensor.get_data_async()
     try:
-        async for found_data in RuuviTagSensor.get_data_async():
-            now = datetime.datetime.now(tz=datetime.timezone.utc)
-            LAST_BLE_RECEIVE = now
+        async for found_data in source:
+            reading = ruuvi_reading.Reading(found_data[0], found_data[1])
+            LAST_BLE_RECEIVE = reading.now
 
-            logging.debug("MAC: %s", found_data[0])
-            logging.debug("Data: %s", found_data[1])
-            handle_data(found_data)
+            logging.debug("MAC: %s", reading.mac)
+            logging.debug("Data: %s", reading.data)
+            capture(reading)
     finally:
         watchdog_task.cancel()
         try:
@@ -339,14 +823,174 @@ async def main():
         except asyncio.CancelledError:
             pass
 
+def capture(found_data, received=None):
+    """Pass a reading to the publisher processes, or handle it here, see handle_data()."""
+    if RING is None:
+        handle_data(found_data, received)
+        return
+    STARTUP.mark("first_reading")  # For /healthz, served by this process
+    reading = ruuvi_reading.from_found(found_data, received)
+    RING.put(reading.mac, reading.data, reading.received)
+
+def publisher_tick(idle):
+    """Share the number of connected brokers, and do the housekeeping while idle."""
+    CONNECTED.value = len(connected_brokers())
+    if idle:
+        housekeeping()
+
+def setup_logging():
+    """Switch to queued logging configured from settings.py.
+
+    Returns:
+        logging.handlers.QueueListener: The background log writer.
+    """
+    listener = ruuvi_logging.setup_logging(
+        level=get_setting('log_level', logging.INFO),
+        json_output=get_setting('log_json', False),
+        rate_limits={**DEFAULT_LOG_RATE_LIMITS, **get_setting('log_rate_limits', {})},
+        sample_rates=get_setting('log_sample_rates', {})
+    )
+    atexit.register(listener.stop)
+    return listener
+
+def setup_profiling_signals():
+    """Request profiling with SIGUSR1 and SIGUSR2, see ruuvi_profiling.
+
+    The capture process passes the signals on to its publisher processes.
+    """
+    ruuvi_profiling.install_signals(PROFILER, PUBLISHERS)
+
+def connected_brokers():
+    """Return the names of the brokers with a live connection."""
+    return [broker for broker, publisher in CLIENTS.items()
+            if ruuvi_outbound.unwrap(publisher).is_connected()]
+
+def health_status():
+    """Liveness for /healthz: BLE data has arrived within WATCHDOG_TIMEOUT.
+
+    Fails for up to STARTUP_GRACE seconds until the first reading.
+
+    Returns:
+        tuple: True if alive, and the details.
+    """
+    age = None
+    if LAST_BLE_RECEIVE is not None:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        age = round((now - LAST_BLE_RECEIVE).total_seconds(), 1)
+    return ruuvi_health.liveness(STARTUP, age, WATCHDOG_TIMEOUT, STARTUP_GRACE)
+
+def readiness_status():
+    """Readiness for /readyz: at least one broker is connected.
+
+    In the capture process of the multi-process mode: all publisher
+    processes are running and one of them has a connected broker.
+
+    Returns:
+        tuple: True if ready, and the details.
+    """
+    if PUBLISHERS:
+        import ruuvi_shm  # pylint: disable=import-outside-toplevel
+        return ruuvi_shm.readiness(PUBLISHERS, PUBLISHER_CONNECTED)
+    connected = connected_brokers()
+    return bool(connected), {"brokers": {broker: broker in connected for broker in CLIENTS}}
+
+def start_sinks():
+    """Start the sink worker threads and flush them at exit."""
+    for sink in SINKS:
+        logging.info("Starting sink %s", sink.name)
+        sink.start()
+        atexit.register(sink.close)
+
+def start_publishing(brokers, index_file=DISCOVERY_INDEX_FILE):
+    """Start the sinks, load the discovery index and connect the brokers.
+
+    Args:
+        brokers (dict): Broker configurations.
+        index_file (str): Discovery index file name in DATA_DIR.
+
+    Returns:
+        None
+    """
+    if PRIMARY:
+        start_sinks()
+    if FLEET is not None:
+        restore_fleet_config()
+    if DISCOVERY_INDEX is not None:
+        DISCOVERY_INDEX.load(os.path.join(DATA_DIR, index_file))
+    connect_brokers(brokers)
+
+def run_publisher(name, brokers, primary, index_file, ring, connected):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """Publish the readings of the ring buffer; target of a publisher process.
+
+    Args:
+        name (str): Name of the publisher.
+        brokers (dict): Broker configurations handled by this process.
+        primary (bool): Write the data files and sinks.
+        index_file (str): Discovery index file name in DATA_DIR.
+        ring (ruuvi_shm.ReadingRing): Ring buffer written by the capture process.
+        connected (multiprocessing.Value): Set to the number of connected
+            brokers, for the readiness of the capture process.
+
+    Returns:
+        None
+    """
+    global my_brokers, PRIMARY, LOAD_GENERATOR, RING, CONNECTED, BROKER_GROUP  # pylint: disable=invalid-name
+    my_brokers = brokers
+    BROKER_GROUP = set(brokers) if MULTIPROCESS.get('per_broker') else None
+    PRIMARY = primary
+    RING = ring
+    LOAD_GENERATOR = None  # Runs in the capture process
+    CONNECTED = connected
+    PUBLISHERS.clear()
+    setup_logging()
+    setup_profiling_signals()
+    logging.info("Publisher %s started for %s", name, ", ".join(brokers))
+    start_publishing(brokers, index_file)
+    import ruuvi_shm  # pylint: disable=import-outside-toplevel
+    try:
+        asyncio.run(ruuvi_shm.consume(RING, handle_data, publisher_tick, os.getppid()))
+    finally:
+        if PRIMARY:
+            for sink in SINKS:
+                sink.close()
+
+def start_publishers(brokers):
+    """Fork the publisher processes, making this the capture process.
+
+    Call before any threads are started.
+
+    Args:
+        brokers (dict): Broker configurations.
+
+    Returns:
+        None
+    """
+    global RING
+    import ruuvi_shm  # pylint: disable=import-outside-toplevel
+    RING, processes, connected = ruuvi_shm.start_publishers(
+        run_publisher, brokers, MULTIPROCESS, DISCOVERY_INDEX_FILE)
+    PUBLISHERS.update(processes)
+    PUBLISHER_CONNECTED.update(connected)
+
 if __name__ == '__main__':
-    logging.info("ruuvi2mqtt version %s", __version__)
+    STARTUP.mark("imports")
     if len(sys.argv) > 1 and sys.argv[1] == '-s':
         SEND_SINGLE_VALUES = True  # pylint: disable=invalid-name
-    connect_brokers(my_brokers)
+    if MULTIPROCESS is not None:
+        start_publishers(my_brokers)
+    setup_logging()
+    ruuvi_health.serve(HEALTH_PORT, {"/healthz": health_status, "/readyz": readiness_status})
+    setup_profiling_signals()
+    logging.info("ruuvi2mqtt version %s", __version__)
+    if MULTIPROCESS is None:
+        start_publishing(my_brokers)
+    else:
+        logging.info("Capturing for publisher processes %s", ", ".join(PUBLISHERS))
+    STARTUP.mark("brokers")
     try:
         # RuuviTagSensor.get_data(handle_data)
         asyncio.run(main())
     except (RuntimeError, NotImplementedError) as exc:
         logging.warning("async not working, trying get_datas: %s", exc)
-        RuuviTagSensor.get_datas(handle_data)
+        RuuviTagSensor.get_datas(capture)
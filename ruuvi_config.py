@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_config
+
+Configuration loader shared by the gateway and the web interface.
+
+Settings are read from settings.toml, settings.json or, for compatibility,
+settings.py, validated, and normalized: MAC addresses are upper case with
+colons. The lookup structures used for every reading are built once when
+the configuration is loaded.
+"""
+
+import ast
+import json
+import os
+import pprint
+import re
+
+import ruuvi_derived
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+CONFIG_NAMES = ("settings.toml", "settings.json", "settings.py")
+CONFIG_ENV = "RUUVI2MQTT_CONFIG"
+# The Docker data volume first: the image links /data/settings.py into the
+# app directory, which would otherwise hide settings.toml and settings.json
+SEARCH_DIRECTORIES = ("/data", os.path.dirname(os.path.abspath(__file__)))
+REQUIRED = ("my_brokers", "my_ruuvis")
+MAC_PATTERN = re.compile(r"^[0-9A-F]{2}([:-]?)[0-9A-F]{2}(\1[0-9A-F]{2}){4}$")
+TOPIC_RESERVED = ("/", "+", "#")
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+
+class ConfigError(ValueError):
+    """The configuration is missing or invalid."""
+
+
+def _positive(value):
+    return value > 0
+
+
+def _non_negative(value):
+    return value >= 0
+
+
+def _fraction(value):
+    return 0 <= value <= 1
+
+
+def _strings(value):
+    return all(isinstance(item, str) for item in value)
+
+
+def _metrics(value):
+    return all(isinstance(name, str) and name in ruuvi_derived.METRICS for name in value)
+
+
+NUMBER = (int, float)
+
+# name: (accepted types, extra check)
+OPTIONAL = {
+    "single_fields": (list, None),
+    "log_level": (str, lambda value: value in LOG_LEVELS),
+    "log_json": (bool, None),
+    "log_rate_limits": (dict, None),
+    "log_sample_rates": (dict, None),
+    "data_dir": (str, None),
+    "tag_timeout": (NUMBER, _positive),
+    "derived_metrics": (list, _metrics),
+    "discovery_mode": (str, lambda value: value in ("sensor", "device")),
+    "discovery_diff": (bool, None),
+    "max_unknown_tags": (int, _non_negative),
+    "unknown_tag_ttl": (NUMBER, _positive),
+    "cleanup_evicted_discovery": (bool, None),
+    "metrics_interval": (NUMBER, _positive),
+    "sinks": (list, None),
+    "link_stats_interval": (NUMBER, _non_negative),
+    "link_stats_window": (int, _positive),
+    "latency_tracing": (bool, None),
+    "latency_in_payload": (bool, None),
+    "load_generator": (dict, None),
+    "health_port": (int, lambda value: 0 <= value <= 65535),
+    "startup_grace": (NUMBER, _non_negative),
+    "ruuvis_file": (str, None),
+    "multiprocess": (dict, None),
+    "snapshot": (dict, None),
+    "fleet": (dict, None),
+}
+
+BROKER_OPTIONS = {
+    "host": (str, lambda value: bool(value.strip())),
+    "port": (int, lambda value: 0 < value < 65536),
+    "conflate": (bool, None),
+    "max_in_flight": (int, _positive),
+    "batch": (dict, None),
+    "qos": (int, lambda value: value in (0, 1, 2)),
+}
+
+# Options of the settings that are passed on as keyword arguments; other
+# keys are reported instead of failing at startup with a TypeError
+NESTED_OPTIONS = {
+    "snapshot": {
+        "fields": (list, _strings),
+        "interval": (NUMBER, _positive),
+        "debounce": (NUMBER, _non_negative),
+    },
+    "load_generator": {
+        "tags": (int, _positive),
+        "rate": (NUMBER, _positive),
+        "jitter": (NUMBER, _fraction),
+        "loss": (NUMBER, lambda value: 0 <= value < 1),
+        "drift": (NUMBER, _non_negative),
+        "seed": (int, None),
+    },
+    "multiprocess": {
+        "slots": (int, _positive),
+        "per_broker": (bool, None),
+    },
+    "fleet": {
+        "broker": (str, None),
+        "topic": (str, lambda value: bool(value.strip())),
+    },
+}
+
+BATCH_OPTIONS = {
+    "interval": (NUMBER, _positive),
+    "max_messages": (int, _positive),
+    "compression": (str, lambda value: value in ("gzip", "zstd")),
+}
+
+SINK_REQUIRED = {"file": ("path",), "influx": ("url",)}  # type -> required options
+SINK_COMMON_OPTIONS = {
+    "type": (str, None),
+    "name": (str, None),
+    "batch_size": (int, _positive),
+    "flush_interval": (NUMBER, _positive),
+    "retries": (int, _non_negative),
+    "retry_delay": (NUMBER, _non_negative),
+    "queue_size": (int, _positive),
+}
+# type -> options, as accepted by the sink classes of ruuvi_sinks
+SINK_OPTIONS = {
+    "file": {
+        **SINK_COMMON_OPTIONS,
+        "path": (str, None),
+    },
+    "influx": {
+        **SINK_COMMON_OPTIONS,
+        "url": (str, lambda value: value.split("://")[0] in ("udp", "http", "https")),
+        "token": (str, None),
+        "measurement": (str, None),
+    },
+}
+
+
+def normalize_mac(mac):
+    """Return a MAC address in upper case with colons.
+
+    Args:
+        mac (str): MAC address with colons, dashes or no separators.
+
+    Returns:
+        str: Such as "AA:BB:CC:DD:EE:FF".
+
+    Raises:
+        ConfigError: If mac is not a MAC address.
+    """
+    if not isinstance(mac, str) or not MAC_PATTERN.match(mac.strip().upper()):
+        raise ConfigError(f"Invalid MAC address {mac!r}")
+    digits = re.sub(r"[:-]", "", mac.strip().upper())
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+def _type_ok(value, types):
+    if isinstance(value, bool) and not (types is bool or
+                                        (isinstance(types, tuple) and bool in types)):
+        return False
+    return isinstance(value, types)
+
+
+def _check(name, value, types, check, errors):
+    if not _type_ok(value, types):
+        errors.append(f"{name}: expected {getattr(types, '__name__', 'number')}, "
+                      f"got {value!r}")
+    elif check is not None and not check(value):
+        errors.append(f"{name}: invalid value {value!r}")
+
+
+def _check_options(name, options, schema, errors):
+    for option, value in options.items():
+        if option not in schema:
+            errors.append(f"{name}: unknown option {option!r}")
+        else:
+            _check(f"{name}.{option}", value, *schema[option], errors)
+
+
+def _validate_sinks(sinks, errors):
+    for index, sink in enumerate(sinks):
+        name = f"sinks[{index}]"
+        if not isinstance(sink, dict):
+            errors.append(f"{name}: expected a mapping")
+            continue
+        if sink.get("type") not in SINK_OPTIONS:
+            errors.append(f"{name}: type must be one of {', '.join(SINK_OPTIONS)}")
+            continue
+        for option in SINK_REQUIRED[sink["type"]]:
+            if option not in sink:
+                errors.append(f"{name}: {option} is required")
+        _check_options(name, sink, SINK_OPTIONS[sink["type"]], errors)
+
+
+def _validate_brokers(brokers, errors):
+    if not isinstance(brokers, dict) or not brokers:
+        errors.append("my_brokers: expected a non-empty mapping of broker names")
+        return {}
+    for name, broker in brokers.items():
+        if not isinstance(broker, dict):
+            errors.append(f"my_brokers.{name}: expected a mapping")
+            continue
+        for option in ("host", "port"):
+            if option not in broker:
+                errors.append(f"my_brokers.{name}: {option} is required")
+        for option, value in broker.items():
+            if option in BROKER_OPTIONS:
+                _check(f"my_brokers.{name}.{option}", value, *BROKER_OPTIONS[option], errors)
+        if isinstance(broker.get("batch"), dict):
+            _check_options(f"my_brokers.{name}.batch", broker["batch"], BATCH_OPTIONS, errors)
+    return brokers
+
+
+def _validate_ruuvis(ruuvis, errors):
+    if not isinstance(ruuvis, dict):
+        errors.append("my_ruuvis: expected a mapping of MAC address to room")
+        return {}
+    normalized = {}
+    for mac, room in ruuvis.items():
+        try:
+            key = normalize_mac(mac)
+        except ConfigError as exc:
+            errors.append(f"my_ruuvis: {exc}")
+            continue
+        if not isinstance(room, str) or not room.strip():
+            errors.append(f"my_ruuvis.{mac}: room must be a non-empty string")
+            continue
+        if any(char in room for char in TOPIC_RESERVED):
+            errors.append(f"my_ruuvis.{mac}: room {room!r} must not contain / + or #")
+            continue
+        if key in normalized:
+            errors.append(f"my_ruuvis: {mac} is configured twice")
+            continue
+        normalized[key] = room
+    return normalized
+
+
+def validate(values):
+    """Validate and normalize raw settings.
+
+    Args:
+        values (dict): Setting name -> value, as loaded from a file.
+
+    Returns:
+        dict: The settings with normalized MAC addresses.
+
+    Raises:
+        ConfigError: Listing every problem found.
+    """
+    errors = []
+    for name in REQUIRED:
+        if name not in values:
+            errors.append(f"{name} is required")
+    result = dict(values)
+    result["my_brokers"] = _validate_brokers(values.get("my_brokers", {}), errors)
+    result["my_ruuvis"] = _validate_ruuvis(values.get("my_ruuvis", {}), errors)
+    for name, value in values.items():
+        if name in OPTIONAL:
+            _check(name, value, *OPTIONAL[name], errors)
+        if name in NESTED_OPTIONS and isinstance(value, dict):
+            _check_options(name, value, NESTED_OPTIONS[name], errors)
+    if isinstance(values.get("sinks"), list):
+        _validate_sinks(values["sinks"], errors)
+    fleet = values.get("fleet")
+    if isinstance(fleet, dict) and fleet and fleet.get("broker") not in result["my_brokers"]:
+        errors.append(f"fleet.broker: {fleet.get('broker')!r} is not in my_brokers")
+    if errors:
+        raise ConfigError("Invalid configuration: " + "; ".join(errors))
+    return result
+
+
+def read(path):
+    """Read raw settings from a TOML, JSON or Python file.
+
+    settings.py is executed, as it always has been, and its public names
+    are the settings.
+
+    Args:
+        path (str): Configuration file.
+
+    Returns:
+        dict: Setting name -> value.
+
+    Raises:
+        ConfigError: If the file cannot be read or parsed.
+    """
+    extension = os.path.splitext(path)[1]
+    try:
+        if extension == ".toml":
+            if tomllib is None:
+                raise ConfigError(f"{path}: TOML needs Python 3.11 or newer")
+            with open(path, "rb") as file_handle:
+                return tomllib.load(file_handle)
+        with open(path, "r", encoding="utf-8") as file_handle:
+            content = file_handle.read()
+        if extension == ".json":
+            values = json.loads(content)
+            if not isinstance(values, dict):
+                raise ConfigError(f"{path}: expected a JSON object")
+            return values
+        exec_globals = {}
+        exec(compile(content, path, "exec"), exec_globals)  # pylint: disable=exec-used
+    except ConfigError:
+        raise
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        # settings.py is code: report whatever it raises, such as an ImportError
+        raise ConfigError(f"{path}: {exc}") from exc
+    return {name: value for name, value in exec_globals.items()
+            if not name.startswith("_") and not callable(value)
+            and not isinstance(value, type(os))}
+
+
+def find(directories=None):
+    """Return the configuration file to use.
+
+    The RUUVI2MQTT_CONFIG environment variable wins; otherwise the first of
+    CONFIG_NAMES found in the directories.
+
+    Args:
+        directories (list): Directories to search, SEARCH_DIRECTORIES if None.
+
+    Raises:
+        ConfigError: If there is no configuration file.
+    """
+    if directories is None:
+        directories = SEARCH_DIRECTORIES
+    if os.environ.get(CONFIG_ENV):
+        return os.environ[CONFIG_ENV]
+    for directory in directories:
+        for name in CONFIG_NAMES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                return path
+    raise ConfigError(f"No {', '.join(CONFIG_NAMES)} found in {', '.join(directories)}")
+
+
+def data_dir(values):
+    """Return the gateway's data directory.
+
+    Args:
+        values: The settings, a dict or a Config.
+
+    Returns:
+        str: data_dir, or the Docker data volume when present, or ".".
+    """
+    return values.get("data_dir", "/data" if os.path.isdir("/data") else ".")
+
+
+def _is_literal(value):
+    """Return True if the value survives repr() and ast.literal_eval()."""
+    try:
+        return ast.literal_eval(repr(value)) == value
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return False
+
+
+def write(path, values):
+    """Write settings in the format of the file they were read from.
+
+    Only plain literals are written: names settings.py computes from
+    imports or helpers, such as a datetime or a compiled pattern, would
+    make the file unloadable and are left out.
+
+    Args:
+        path (str): settings.py or settings.json.
+        values (dict): Setting name -> value; my_brokers and my_ruuvis are
+            written first.
+
+    Raises:
+        ConfigError: For TOML, which the standard library cannot write;
+            edit settings.toml by hand.
+        OSError: If the file cannot be written.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == ".toml":
+        raise ConfigError(f"{path}: TOML settings are read-only, edit the file by hand")
+    ordered = {name: values[name] for name in REQUIRED if name in values}
+    ordered.update((name, value) for name, value in values.items() if _is_literal(value))
+    with open(path, "w", encoding="utf-8") as file_handle:
+        if extension == ".json":
+            json.dump(ordered, file_handle, indent=2, ensure_ascii=False)
+            file_handle.write("\n")
+            return
+        for index, (name, value) in enumerate(ordered.items()):
+            if index:
+                file_handle.write("\n")
+            file_handle.write(f"{name} = {pprint.pformat(value, sort_dicts=False)}\n")
+
+
+class Config:  # pylint: disable=too-few-public-methods
+    """Validated settings with the lookups of the hot path precompiled.
+
+    Attributes:
+        brokers (dict): Broker name -> options.
+        ruuvis (dict): Normalized MAC address -> room.
+        rooms (frozenset): Configured rooms.
+        topics (dict): Room -> state topic.
+        discovery_prefixes (tuple): Discovery object id prefixes of the
+            configured rooms, for str.startswith().
+    """
+
+    def __init__(self, values, path=None):
+        values = validate(values)
+        self.path = path
+        self.values = values
+        self.brokers = values["my_brokers"]
+        self.ruuvis = values["my_ruuvis"]
+        self.rooms = frozenset(self.ruuvis.values())
+        self.topics = {room: f"home/{room}" for room in self.rooms}
+        self.discovery_prefixes = tuple(f"{room}_" for room in sorted(self.rooms))
+
+    def get(self, name, default=None):
+        """Return an optional setting or the default."""
+        return self.values.get(name, default)
+
+
+def load(path):
+    """Read, merge ruuvis_file into my_ruuvis, and validate a configuration.
+
+    Args:
+        path (str): Configuration file.
+
+    Returns:
+        Config: The loaded configuration.
+
+    Raises:
+        ConfigError: If the configuration cannot be read or is invalid.
+    """
+    values = read(path)
+    ruuvis_file = values.get("ruuvis_file")
+    if isinstance(ruuvis_file, str):
+        ruuvis_path = os.path.join(os.path.dirname(os.path.abspath(path)), ruuvis_file)
+        values["my_ruuvis"] = _merge_ruuvis(values.get("my_ruuvis", {}), _read_json(ruuvis_path))
+    return Config(values, path)
+
+
+def _merge_ruuvis(configured, extra):
+    """Add tags from ruuvis_file that are not in my_ruuvis."""
+    known = set()
+    for mac in configured:
+        try:
+            known.add(normalize_mac(mac))
+        except ConfigError:
+            pass  # Reported by validate()
+    merged = dict(configured)
+    for mac, room in extra.items():
+        if normalize_mac(mac) not in known:
+            merged[mac] = room
+    return merged
+
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as file_handle:
+            values = json.load(file_handle)
+    except (OSError, ValueError) as exc:
+        raise ConfigError(f"{path}: {exc}") from exc
+    if not isinstance(values, dict):
+        raise ConfigError(f"{path}: expected a JSON object")
+    return values
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_derived
+
+Derived metrics computed at the gateway from temperature, humidity and
+pressure, so consumers do not need a template sensor per tag.
+"""
+
+import math
+
+# Magnus formula coefficients over water (Sonntag 1990)
+MAGNUS_A = 17.62
+MAGNUS_B = 243.12  # °C
+MAGNUS_C = 6.112  # hPa
+KELVIN = 273.15
+R_DRY = 287.058  # J/(kg K)
+R_VAPOUR = 461.495  # J/(kg K)
+
+# name: (inputs, discovery device class, unit)
+METRICS = {
+    "dew_point": (("temperature", "humidity"), "temperature", "°C"),
+    "absolute_humidity": (("temperature", "humidity"), None, "g/m³"),
+    "vpd": (("temperature", "humidity"), "pressure", "kPa"),
+    "air_density": (("temperature", "humidity", "pressure"), None, "kg/m³"),
+}
+DECIMALS = 2
+
+
+def compute(names, temperature, humidity, pressure=None):
+    """Compute derived metrics sharing the intermediate results.
+
+    Args:
+        names (iterable): Metric names from METRICS.
+        temperature (float): Temperature in °C.
+        humidity (float): Relative humidity in %.
+        pressure (float): Air pressure in hPa, needed for air_density.
+
+    Returns:
+        dict: Metric name -> value. Metrics whose inputs are missing or out
+        of range are left out.
+    """
+    results = {}
+    if temperature is None or humidity is None or humidity <= 0:
+        return results
+    saturation = MAGNUS_C * math.exp(MAGNUS_A * temperature / (MAGNUS_B + temperature))
+    vapour = saturation * humidity / 100  # hPa
+    kelvin = temperature + KELVIN
+    for name in names:
+        if name == "dew_point":
+            gamma = math.log(humidity / 100) + MAGNUS_A * temperature / (MAGNUS_B + temperature)
+            value = MAGNUS_B * gamma / (MAGNUS_A - gamma)
+        elif name == "absolute_humidity":
+            value = 100 * vapour / (R_VAPOUR * kelvin) * 1000
+        elif name == "vpd":
+            value = (saturation - vapour) / 10
+        elif name == "air_density":
+            if pressure is None:
+                continue
+            value = ((pressure - vapour) * 100 / (R_DRY * kelvin)
+                     + vapour * 100 / (R_VAPOUR * kelvin))
+        else:
+            continue
+        results[name] = round(value, DECIMALS)
+    return results
+
+
+class Enricher:
+    """Add derived metrics to readings, cached per tag.
+
+    Metrics are recomputed only when the inputs of a tag have changed
+    since its previous reading.
+    """
+
+    def __init__(self, names):
+        unknown = [name for name in names if name not in METRICS]
+        if unknown:
+            raise ValueError(
+                f"Unknown derived metrics {unknown}, available: {sorted(METRICS)}"
+            )
+        self.names = tuple(names)
+        self.cache = {}
+
+    def __bool__(self):
+        return bool(self.names)
+
+    def enrich(self, mac, jdata):
+        """Add the derived metrics of one reading to its data dictionary.
+
+        Args:
+            mac (str): MAC address of the tag.
+            jdata (dict): Decoded sensor data, updated in place.
+
+        Returns:
+            dict: The derived metrics that were added.
+        """
+        inputs = (jdata.get("temperature"), jdata.get("humidity"), jdata.get("pressure"))
+        cached = self.cache.get(mac)
+        if cached is not None and cached[0] == inputs:
+            results = cached[1]
+        else:
+            results = compute(self.names, *inputs)
+            self.cache[mac] = (inputs, results)
+        jdata.update(results)
+        return results
+
+    def forget(self, mac):
+        """Drop the cached metrics of a tag."""
+        self.cache.pop(mac, None)
+
+    def discovery_sensors(self):
+        """Return discovery entries of the enabled metrics.
+
+        Returns:
+            dict: Metric name -> {"class": device class, "unit": unit}.
+        """
+        return {
+            name: {"class": METRICS[name][1], "unit": METRICS[name][2]}
+            for name in self.names
+        }
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_discovery
+
+Digest index of the retained Home Assistant discovery configs held by each
+broker, so unchanged configs are not published again.
+
+After connecting, the gateway subscribes to the discovery topics and the
+broker replays its retained configs, which are recorded with observe().
+Until the sync window has passed, the index persisted by the previous run
+is trusted; afterwards topics the broker did not replay are dropped so
+they get published again.
+
+The discovery configs themselves are built by sensor_configs(), one
+message per sensor, and device_configs(), one message per tag.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+SYNC_WINDOW = 5  # Seconds to wait for retained configs after connecting
+# Retained configs subscribed to for the DiscoveryIndex
+CONFIG_TOPICS = ("homeassistant/sensor/+/config", "homeassistant/device/+/config")
+DEVICE = {"manufacturer": "Ruuvi", "model": "Ruuvitag"}
+LINK_SENSORS = {
+    "link_loss": {"class": None, "unit": "%", "topic": "link"},
+    "link_rssi_mean": {"class": "signal_strength", "unit": "dBm", "topic": "link"},
+}
+
+
+def digest(payload):
+    """Return the digest of a serialized discovery payload."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def sensors(hostname, extra=None, link=False):
+    """Return the sensors announced in discovery.
+
+    Args:
+        hostname (str): Gateway name, part of the RSSI sensor key.
+        extra (dict): Further sensors, such as the derived metrics.
+        link (bool): Include the link statistics, for tags that send a
+            measurement sequence number.
+
+    Returns:
+        dict: Sensor key -> {"class": device class, "unit": unit, and
+        "topic" for sensors not on the state topic}.
+    """
+    sendvals = {
+        "temperature": {"class": "temperature", "unit": "°C"},
+        "humidity": {"class": "humidity", "unit": "%"},
+        "pressure": {"class": "pressure", "unit": "hPa"},
+        "battery": {"class": "voltage", "unit": "mV"},
+        "acceleration": {"class": None, "unit": "mG"},
+        "acceleration_x": {"class": None, "unit": "mG"},
+        "acceleration_y": {"class": None, "unit": "mG"},
+        "acceleration_z": {"class": None, "unit": "mG"},
+        f"rssi_{hostname}": {"class": None, "unit": "dBm"},
+        "movement_counter": {"class": None, "unit": "times"}
+    }
+    sendvals.update(extra or {})
+    if link:
+        sendvals.update(LINK_SENSORS)
+    return sendvals
+
+
+def _component(room, mac, sensor_key, sensor_data):
+    """Return the discovery fields of one sensor of a room."""
+    component = {
+        "unit_of_measurement": f"{sensor_data['unit']}",
+        "value_template": "{{ value_json." + sensor_key + " }}",
+        "unique_id": f"ruuvi{mac}{sensor_key}",
+        "object_id": f"{room}_{sensor_key}",
+        "name": f"{sensor_key}"
+    }
+    if sensor_data['class'] is not None:
+        component["device_class"] = f"{sensor_data['class']}"
+    if sensor_data.get('topic'):
+        component["state_topic"] = f"home/{room}/{sensor_data['topic']}"
+        component["entity_category"] = "diagnostic"
+    return component
+
+
+def sensor_configs(room, mac, sensor_map, availability_topic):
+    """Build one sensor discovery config per sensor.
+
+    Args:
+        room (str): The room identifier.
+        mac (str): MAC address of the tag.
+        sensor_map (dict): Sensors from sensors().
+        availability_topic (str): Availability topic of the room.
+
+    Returns:
+        list: (topic, payload) tuples.
+    """
+    configs = []
+    for sensor_key, sensor_data in sensor_map.items():
+        payload = {"state_topic": f"home/{room}", "availability_topic": availability_topic}
+        payload.update(_component(room, mac, sensor_key, sensor_data))
+        payload["device"] = {"identifiers": [f"{room}"], "name": f"{room}", **DEVICE}
+        configs.append((f"homeassistant/sensor/{room}_{sensor_key}/config", payload))
+    return configs
+
+
+def device_configs(room, mac, sensor_map, availability_topic, version):
+    """Build a single device discovery config with all sensors as components.
+
+    The state and availability topics are shared by all components.
+
+    Args:
+        room (str): The room identifier.
+        mac (str): MAC address of the tag.
+        sensor_map (dict): Sensors from sensors().
+        availability_topic (str): Availability topic of the room.
+        version (str): Gateway version, for the origin.
+
+    Returns:
+        list: One (topic, payload) tuple.
+    """
+    components = {
+        f"{room}_{sensor_key}": {"platform": "sensor",
+                                 **_component(room, mac, sensor_key, sensor_data)}
+        for sensor_key, sensor_data in sensor_map.items()
+    }
+    payload = {
+        "device": {"identifiers": [f"{room}"], "name": f"{room}", **DEVICE},
+        "origin": {"name": "ruuvi2mqtt", "sw_version": version},
+        "state_topic": f"home/{room}",
+        "availability_topic": availability_topic,
+        "components": components
+    }
+    return [(f"homeassistant/device/{room}/config", payload)]
+
+
+def is_own_topic(topic, rooms, prefixes):
+    """Check if a discovery topic belongs to one of the gateway's tags.
+
+    Args:
+        topic (str): Topic such as homeassistant/sensor/<room>_<key>/config.
+        rooms (frozenset): Configured rooms.
+        prefixes (tuple): Object id prefixes of the configured rooms.
+
+    Returns:
+        bool: True for topics of configured rooms and auto-named tags.
+    """
+    parts = topic.split("/")
+    if len(parts) != 4:
+        return False
+    object_id = parts[2]
+    if object_id.startswith("Ruuvi-"):
+        return True
+    if parts[1] == "device":
+        return object_id in rooms
+    return object_id.startswith(prefixes)
+
+
+def publish(configs, clients, index=None):
+    """Publish discovery configs retained, skipping those a broker holds.
+
+    Args:
+        configs (list): (topic, payload) tuples.
+        clients (dict): Broker name -> client or publisher.
+        index (DiscoveryIndex): Configs held by the brokers, None to
+            publish everything.
+
+    Returns:
+        int: Number of messages published.
+    """
+    published = 0
+    for topic, payload in configs:
+        my_data = json.dumps(payload).replace("'", '"')
+        value = digest(my_data)
+        for broker, client in clients.items():
+            if index is not None:
+                if not index.needs_publish(broker, topic, value):
+                    continue
+                index.record(broker, topic, value)
+            logging.debug("%s: %s", topic, my_data)
+            client.publish(topic, my_data, retain=True)
+            published += 1
+    if published and index is not None:
+        index.save()
+    return published
+
+
+def clear(topics, clients, index=None):
+    """Clear retained topics with empty messages and forget them in the index.
+
+    Args:
+        topics (list): Discovery and other retained topics.
+        clients (dict): Broker name -> client or publisher.
+        index (DiscoveryIndex): Configs held by the brokers, or None.
+
+    Returns:
+        None
+    """
+    for broker, client in clients.items():
+        for topic in topics:
+            client.publish(topic, "", retain=True)
+            if index is not None:
+                index.observe(broker, topic, b"")
+    if index is not None:
+        index.save()
+
+
+class DiscoveryIndex:
+    """Per-broker digests of retained discovery configs."""
+
+    def __init__(self, sync_window=SYNC_WINDOW, clock=time.monotonic):
+        self.sync_window = sync_window
+        self.clock = clock
+        self.path = None
+        self.digests = {}  # broker -> {topic: digest}
+        self.syncing = {}  # broker -> (deadline, topics seen since connect)
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        """Load the index persisted by a previous run and save to path later.
+
+        Args:
+            path (str): JSON file of the index. Missing or broken files are
+                ignored.
+
+        Returns:
+            None
+        """
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as file_handle:
+                digests = json.load(file_handle)
+        except (OSError, ValueError) as exc:
+            logging.info("No discovery index loaded from %s: %s", path, exc)
+            return
+        with self.lock:
+            self.digests = {broker: dict(topics) for broker, topics in digests.items()}
+        logging.info("Loaded discovery index for %d brokers from %s",
+                     len(self.digests), path)
+
+    def save(self):
+        """Write the index atomically if it has changed.
+
+        Returns:
+            None
+        """
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            data = json.dumps(self.digests)
+            self.dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as file_handle:
+                file_handle.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            logging.warning("Could not save discovery index %s: %s", self.path, exc)
+
+    def begin_sync(self, broker):
+        """Start collecting the retained configs replayed by a broker."""
+        with self.lock:
+            self.syncing[broker] = (self.clock() + self.sync_window, set())
+
+    def observe(self, broker, topic, payload):
+        """Record a discovery config received from a broker.
+
+        Args:
+            broker (str): Broker name.
+            topic (str): Discovery topic.
+            payload (bytes): Retained payload, empty when it was cleared.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            topics = self.digests.setdefault(broker, {})
+            if payload:
+                value = digest(payload)
+                if topics.get(topic) != value:
+                    topics[topic] = value
+                    self.dirty = True
+            elif topics.pop(topic, None) is not None:
+                self.dirty = True
+            sync = self.syncing.get(broker)
+            if sync is not None:
+                sync[1].add(topic)
+
+    def needs_publish(self, broker, topic, value):
+        """Check if the broker lacks this exact discovery config."""
+        return self.digests.get(broker, {}).get(topic) != value
+
+    def record(self, broker, topic, value):
+        """Record a discovery config published to a broker."""
+        with self.lock:
+            self.digests.setdefault(broker, {})[topic] = value
+            self.dirty = True
+            sync = self.syncing.get(broker)
+            if sync is not None:
+                sync[1].add(topic)
+
+    def finish_sync(self):
+        """Finish the syncs whose window has passed.
+
+        Topics that the broker did not replay are removed from the index.
+
+        Returns:
+            int: Number of removed topics. When nonzero, discovery should
+            be resent.
+        """
+        if not self.syncing:
+            return 0
+        now = self.clock()
+        removed = 0
+        with self.lock:
+            for broker, (deadline, seen) in list(self.syncing.items()):
+                if now < deadline:
+                    continue
+                del self.syncing[broker]
+                topics = self.digests.setdefault(broker, {})
+                for topic in [topic for topic in topics if topic not in seen]:
+                    del topics[topic]
+                    removed += 1
+                logging.info("Discovery sync with %s done: %d configs on broker",
+                             broker, len(topics))
+            if removed:
+                self.dirty = True
+        return removed
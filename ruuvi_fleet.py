@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_fleet
+
+Configuration shared by a fleet of gateways through a retained, versioned
+MQTT message. The message holds my_brokers and/or my_ruuvis as a whole;
+gateways apply only what differs from their current configuration and
+acknowledge the version on their status topic.
+"""
+
+import json
+import logging
+import os
+import time
+
+import ruuvi_config
+
+DEFAULT_TOPIC = "ruuvi2mqtt/fleet/config"
+STATUS_TOPIC = "ruuvi2mqtt/{gateway}/config/status"
+FLEET_KEYS = ("my_brokers", "my_ruuvis")
+
+
+def encode(version, brokers=None, ruuvis=None):
+    """Serialize a fleet configuration.
+
+    Args:
+        version (int): Version, higher than any published before.
+        brokers (dict): my_brokers for all gateways, unchanged if None.
+        ruuvis (dict): my_ruuvis for all gateways, unchanged if None.
+
+    Returns:
+        str: JSON payload for the fleet topic.
+    """
+    message = {"version": version}
+    if brokers is not None:
+        message["my_brokers"] = brokers
+    if ruuvis is not None:
+        message["my_ruuvis"] = ruuvis
+    return json.dumps(message, ensure_ascii=False)
+
+
+def parse(payload):
+    """Parse a fleet configuration message.
+
+    Args:
+        payload (bytes): JSON payload of the fleet topic.
+
+    Returns:
+        tuple: Version and a dict of the settings in FLEET_KEYS it holds.
+
+    Raises:
+        ruuvi_config.ConfigError: If the message is malformed.
+    """
+    try:
+        message = json.loads(payload)
+    except ValueError as exc:
+        raise ruuvi_config.ConfigError(f"Fleet configuration is not JSON: {exc}") from exc
+    if not isinstance(message, dict):
+        raise ruuvi_config.ConfigError("Fleet configuration must be a JSON object")
+    version = message.get("version")
+    if not isinstance(version, int) or isinstance(version, bool) or version < 0:
+        raise ruuvi_config.ConfigError(f"Invalid fleet configuration version {version!r}")
+    return version, {key: message[key] for key in FLEET_KEYS if key in message}
+
+
+def build(values, current, keep=None):
+    """Return the configuration with the fleet settings applied.
+
+    Args:
+        values (dict): Settings from parse().
+        current (ruuvi_config.Config): The configuration in use.
+        keep (str): Broker that must stay configured, the one the fleet
+            configuration is received from.
+
+    Returns:
+        ruuvi_config.Config: Validated new configuration.
+
+    Raises:
+        ruuvi_config.ConfigError: If the result is invalid.
+    """
+    merged = dict(current.values)
+    merged.update(values)
+    config = ruuvi_config.Config(merged, current.path)
+    if keep is not None and keep not in config.brokers:
+        raise ruuvi_config.ConfigError(f"Fleet broker {keep} cannot be removed")
+    return config
+
+
+def changes(old, new):
+    """Compare two configurations.
+
+    Args:
+        old (ruuvi_config.Config): The configuration in use.
+        new (ruuvi_config.Config): The configuration to switch to.
+
+    Returns:
+        dict: "moved" maps the MAC addresses whose room changed to (old
+        room, new room), None when not configured; "brokers_added",
+        "brokers_removed" and "brokers_changed" list broker names.
+    """
+    moved = {}
+    for mac in set(old.ruuvis) | set(new.ruuvis):
+        if old.ruuvis.get(mac) != new.ruuvis.get(mac):
+            moved[mac] = (old.ruuvis.get(mac), new.ruuvis.get(mac))
+    return {
+        "moved": moved,
+        "brokers_added": sorted(set(new.brokers) - set(old.brokers)),
+        "brokers_removed": sorted(set(old.brokers) - set(new.brokers)),
+        "brokers_changed": sorted(name for name in set(old.brokers) & set(new.brokers)
+                                  if old.brokers[name] != new.brokers[name]),
+    }
+
+
+def status(version, gateway, error=None, applied=None):
+    """Serialize the acknowledgement of a fleet configuration.
+
+    Args:
+        version (int): Version received, None if it could not be parsed.
+        gateway (str): Name of the gateway.
+        error (str): Why the configuration was rejected, None if applied.
+        applied (dict): Result of changes() for an applied configuration.
+
+    Returns:
+        str: JSON payload for the status topic.
+    """
+    message = {"gateway": gateway, "version": version,
+               "status": "rejected" if error else "applied", "ts": int(time.time())}
+    if error:
+        message["error"] = error
+    if applied is not None:
+        message["moved"] = len(applied["moved"])
+        for key in ("brokers_added", "brokers_removed", "brokers_changed"):
+            if applied[key]:
+                message[key] = applied[key]
+    return json.dumps(message)
+
+
+def save(path, version, values):
+    """Write the applied fleet configuration atomically."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file_handle:
+        json.dump({"version": version, **values}, file_handle, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """Read a fleet configuration written by save().
+
+    Returns:
+        tuple: Version and settings as from parse(), or None if there is
+        no valid file.
+    """
+    try:
+        with open(path, "rb") as file_handle:
+            return parse(file_handle.read())
+    except (OSError, ruuvi_config.ConfigError):
+        return None
+
+
+
+class FleetSync:
+    """Fleet configuration of one gateway.
+
+    Messages are received on the MQTT network thread and only kept; they
+    are applied on the main thread by apply(), between readings.
+    """
+
+    def __init__(self, gateway, options, path):
+        """Create the sync.
+
+        Args:
+            gateway (str): Name of the gateway.
+            options (dict): The fleet setting: broker and topic.
+            path (str): File of the applied configuration, see save().
+        """
+        self.gateway = gateway
+        self.broker = options["broker"]
+        self.topic = options.get("topic", DEFAULT_TOPIC)
+        self.status_topic = STATUS_TOPIC.format(gateway=gateway)
+        self.path = path
+        self.version = None  # Version of the applied configuration
+        self.pending = None  # Payload received, applied by apply()
+
+    def receive(self, payload):
+        """Keep a message of the fleet topic for apply()."""
+        logging.info("Received fleet configuration, %d bytes", len(payload))
+        self.pending = payload
+
+    def apply(self, current, switch):
+        """Apply the configuration received last.
+
+        Versions up to the applied one are ignored.
+
+        Args:
+            current (ruuvi_config.Config): The configuration in use.
+            switch: Function switching to a ruuvi_config.Config and
+                returning the changes(), called for a valid configuration.
+
+        Returns:
+            str: Acknowledgement for status_topic, or None if nothing new
+            was received.
+        """
+        payload, self.pending = self.pending, None
+        if payload is None:
+            return None
+        version = None
+        try:
+            version, values = parse(payload)
+            if self.version is not None and version <= self.version:
+                logging.info("Fleet configuration %d already applied", version)
+                return None
+            config = build(values, current, keep=self.broker)
+        except ruuvi_config.ConfigError as exc:
+            logging.error("Rejected fleet configuration %s: %s", version, exc)
+            return status(version, self.gateway, error=str(exc))
+        applied = switch(config)
+        self.version = version
+        logging.info("Applied fleet configuration %d: %d tags moved, brokers %s",
+                     version, len(applied["moved"]),
+                     {key: applied[key] for key in ("brokers_added", "brokers_removed",
+                                                    "brokers_changed")})
+        try:
+            save(self.path, version, values)
+        except OSError as exc:
+            logging.warning("Could not save fleet configuration: %s", exc)
+        return status(version, self.gateway, applied=applied)
+
+    def restore(self, current):
+        """Return the configuration with the tags of the saved configuration.
+
+        Used before connecting, so a restart does not announce tags in
+        their old rooms. The retained message is applied again after
+        connecting, which then changes only what differs.
+
+        Args:
+            current (ruuvi_config.Config): The configuration in use.
+
+        Returns:
+            ruuvi_config.Config: The configuration to use, or None if no
+            tag mapping was saved or it is no longer valid.
+        """
+        saved = load(self.path)
+        if saved is None or "my_ruuvis" not in saved[1]:
+            return None
+        try:
+            config = build({"my_ruuvis": saved[1]["my_ruuvis"]}, current)
+        except ruuvi_config.ConfigError as exc:
+            logging.warning("Ignoring saved fleet configuration: %s", exc)
+            return None
+        logging.info("Using tags of fleet configuration %d", saved[0])
+        return config
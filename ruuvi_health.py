@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_health
+
+Startup timing and a small HTTP server for health probes:
+
+    /healthz   liveness: the scanner is receiving BLE data, failing while
+               the process starts until the first reading
+    /readyz    readiness: at least one broker is connected
+
+Each check is a function returning (ok, details); the details are sent as
+JSON with status 200 when ok, otherwise 503.
+"""
+
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+STARTUP_GRACE = 60  # Seconds /healthz waits for the first reading
+
+
+def process_age():
+    """Return seconds since the process was started, or None if unknown.
+
+    Read from /proc, so the time before Python started importing is
+    included.
+    """
+    try:
+        with open("/proc/self/stat", encoding="ascii") as file_handle:
+            start_ticks = int(file_handle.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="ascii") as file_handle:
+            uptime = float(file_handle.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+class StartupTimer:
+    """Record when startup milestones are reached.
+
+    Times are counted from process start when /proc is available, from
+    the creation of the timer otherwise.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        age = process_age()
+        self.origin = clock() - (age or 0.0)
+        self.marks = {}
+        self.done = False
+
+    def mark(self, name):
+        """Record a milestone once, in milliseconds since start."""
+        if name not in self.marks:
+            self.marks[name] = round((self.clock() - self.origin) * 1000, 1)
+
+    def finish(self, name):
+        """Record the last milestone and log the breakdown."""
+        self.mark(name)
+        self.done = True
+        logging.info("Startup: %s", ", ".join(f"{key} {value:.0f} ms"
+                                             for key, value in self.marks.items()))
+
+    def summary(self):
+        """Return the milestones in milliseconds since start."""
+        return dict(self.marks)
+
+    def elapsed(self):
+        """Return seconds since start."""
+        return self.clock() - self.origin
+
+
+def liveness(startup, last_age, timeout, grace=STARTUP_GRACE):
+    """Check that BLE data has arrived within the timeout.
+
+    Until the first reading is marked, the check fails as "starting" for
+    up to grace seconds, so a startup probe waits for BLE data.
+
+    Args:
+        startup (StartupTimer): Milestones of the process.
+        last_age (float): Seconds since the last BLE data, None if none yet.
+        timeout (float): Maximum age of the last BLE data.
+        grace (float): Seconds to wait for the first reading.
+
+    Returns:
+        tuple: True if alive, and the details.
+    """
+    details = {"last_ble_age": last_age, "startup_ms": startup.summary()}
+    if "first_reading" not in startup.marks and startup.elapsed() < grace:
+        return False, {"status": "starting", **details}
+    alive = last_age is None or last_age <= timeout
+    return alive, {"status": "ok" if alive else "stale", **details}
+
+
+def serve(port, checks):
+    """Start a HealthServer unless the port is 0.
+
+    Args:
+        port (int): TCP port, 0 disables the probes.
+        checks (dict): Path -> function returning (ok, details).
+
+    Returns:
+        HealthServer: The started server, or None if disabled or the port
+        cannot be bound.
+    """
+    if not port:
+        return None
+    try:
+        server = HealthServer(port, checks)
+    except OSError as exc:
+        logging.warning("Could not start health probes on port %d: %s", port, exc)
+        return None
+    server.start()
+    return server
+
+
+class HealthServer:
+    """Serve health checks over HTTP on a daemon thread."""
+
+    def __init__(self, port, checks, host=""):
+        """Create the server.
+
+        Args:
+            port (int): TCP port, 0 picks a free one.
+            checks (dict): Path -> function returning (ok, details).
+            host (str): Address to bind, all interfaces by default.
+        """
+        handler = type("HealthHandler", (_HealthHandler,), {"checks": checks})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        """Start serving in the background."""
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="health", daemon=True)
+        self.thread.start()
+        logging.info("Health probes on port %d", self.port)
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _HealthHandler(http.server.BaseHTTPRequestHandler):
+    checks = {}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Run the check of the path and answer 200 or 503."""
+        check = self.checks.get(self.path.split("?", 1)[0])
+        if check is None:
+            self.send_error(404)
+            return
+        try:
+            healthy, details = check()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            healthy, details = False, {"error": str(exc)}
+        body = json.dumps(details).encode("utf-8")
+        self.send_response(200 if healthy else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("Health probe: " + format, *args)
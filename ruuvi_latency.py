@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_latency
+
+Latency tracing of readings from BLE receive to broker acknowledgement.
+
+Times are measured from the moment a reading is received from the
+scanner to when handle_data() starts (enqueue), the payload is serialized,
+the publish calls have returned, and paho's on_publish fires for each
+broker (ack). With QoS 1 on_publish is called on the broker's PUBACK,
+with QoS 0 when the message has been written to the socket.
+
+Run as a script to measure publish latency against a test broker:
+
+    python3 ruuvi_latency.py -H localhost --count 1000 --qos 1 --max-p99-ms 50
+"""
+
+import array
+import json
+import math
+import sys
+import threading
+import time
+
+MIN_MS = 0.01  # Lower bound of the first bucket
+BUCKETS_PER_OCTAVE = 4  # About 19 % resolution
+BUCKETS = 96  # Up to about 16 minutes
+MAX_PENDING = 10000  # Unacknowledged messages tracked per broker
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram with constant memory."""
+
+    def __init__(self):
+        self.counts = array.array('L', [0] * BUCKETS)
+        self.count = 0
+        self.max_ms = 0.0
+
+    def add(self, seconds):
+        """Add one latency measurement."""
+        ms = seconds * 1000
+        if ms <= MIN_MS:
+            index = 0
+        else:
+            index = min(int(BUCKETS_PER_OCTAVE * math.log2(ms / MIN_MS)), BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding a percentile, in ms."""
+        if not self.count:
+            return None
+        rank = math.ceil(percent / 100 * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                upper = MIN_MS * 2 ** ((index + 1) / BUCKETS_PER_OCTAVE)
+                return round(min(upper, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def summary(self):
+        """Return count, p50, p95, p99 and max in milliseconds."""
+        return {
+            "count": self.count,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+        }
+
+
+class LatencyTracer:
+    """Collect per-stage and per-broker latency histograms.
+
+    stage() is called from the scanner thread and acked() from the paho
+    network threads, so the shared state is guarded by a lock.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.histograms = {}
+        self.pending = {}  # broker -> {mid: receive time}
+        self.early = {}  # broker -> {mid: ack time} for acks before sent()
+        self.lock = threading.Lock()
+
+    def stage(self, name, received):
+        """Record the time from receive to now for a stage."""
+        self._add(name, self.clock() - received)
+
+    def sent(self, broker, mid, received):
+        """Remember a published message until its acknowledgement."""
+        with self.lock:
+            acked = self.early.get(broker, {}).pop(mid, None)
+            if acked is None:
+                pending = self.pending.setdefault(broker, {})
+                pending[mid] = received
+                if len(pending) > MAX_PENDING:
+                    del pending[next(iter(pending))]
+                return
+        self._add(f"ack:{broker}", acked - received)
+
+    def acked(self, broker, mid):
+        """Record the acknowledgement of a message, called from on_publish."""
+        now = self.clock()
+        with self.lock:
+            received = self.pending.get(broker, {}).pop(mid, None)
+            if received is None:
+                early = self.early.setdefault(broker, {})
+                early[mid] = now
+                if len(early) > MAX_PENDING:
+                    del early[next(iter(early))]
+                return
+        self._add(f"ack:{broker}", now - received)
+
+    def summary(self, reset=True):
+        """Return the histogram summaries per stage.
+
+        Args:
+            reset (bool): Start new histograms for the next interval.
+
+        Returns:
+            dict: Stage -> count, p50, p95, p99 and max in milliseconds.
+        """
+        with self.lock:
+            histograms = self.histograms
+            if reset:
+                self.histograms = {}
+        return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+    def _add(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+
+def run_benchmark(client, tracer, count, qos, interval, topic="home/_latency"):
+    """Publish synthetic readings and return the latency summary.
+
+    Args:
+        client (mqtt.Client): Connected client whose on_publish feeds tracer.
+        tracer (LatencyTracer): Tracer to record in.
+        count (int): Number of messages.
+        qos (int): QoS of the messages.
+        interval (float): Seconds between messages.
+        topic (str): Topic to publish to.
+
+    Returns:
+        dict: The tracer summary.
+    """
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    payload = json.dumps({"temperature": 21.5, "humidity": 40.0, "pressure": 1013.2})
+    for _ in range(count):
+        received = tracer.clock()
+        info = client.publish(topic, payload, qos=qos)
+        tracer.stage("publish", received)
+        tracer.sent("benchmark", info.mid, received)
+        if interval:
+            time.sleep(interval)
+    deadline = time.monotonic() + 10
+    while tracer.pending.get("benchmark") and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return tracer.summary()
+
+
+def main():
+    """Measure publish latency against a broker and print the summary."""
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    from paho.mqtt.client import Client, CallbackAPIVersion
+
+    parser = argparse.ArgumentParser(description="Measure MQTT publish latency")
+    parser.add_argument("-H", "--host", default="localhost", help="MQTT broker host")
+    parser.add_argument("-p", "--port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--count", type=int, default=1000, help="messages to publish")
+    parser.add_argument("--qos", type=int, default=1, choices=(0, 1, 2))
+    parser.add_argument("--interval", type=float, default=0.001,
+                        help="seconds between messages")
+    parser.add_argument("--max-p99-ms", type=float,
+                        help="exit with status 1 if the ack p99 is above this")
+    args = parser.parse_args()
+
+    tracer = LatencyTracer()
+    client = Client(CallbackAPIVersion.VERSION2, "ruuvi2mqtt-latency")
+    client.on_publish = lambda client, userdata, mid, *rest: tracer.acked("benchmark", mid)
+    client.connect(args.host, args.port, 60)
+    client.loop_start()
+    try:
+        summary = run_benchmark(client, tracer, args.count, args.qos, args.interval)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+    print(json.dumps(summary, indent=2))
+    p99 = summary.get("ack:benchmark", {}).get("p99_ms")
+    if args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms):
+        print(f"ack p99 {p99} ms is above {args.max_p99_ms} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
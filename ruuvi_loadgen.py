@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_loadgen
+
+Synthetic RuuviTag data source for stress testing without radios.
+
+N virtual tags send data format 5 (RAWv2) advertisements at a configurable
+rate with jitter, slowly drifting values and random packet loss. Every
+advertisement is encoded to raw bytes and decoded with the ruuvitag_sensor
+decoder, so decoding costs the same as with real tags. readings() yields
+(mac, data) like RuuviTagSensor.get_data_async().
+
+When the consumer cannot keep up, advertisements fall behind their
+schedule; the lag is reported by stats().
+"""
+
+import asyncio
+import heapq
+import random
+import struct
+import time
+
+from ruuvitag_sensor.decoder import Df5Decoder
+
+DF5_FORMAT = ">BhHHhhhHBH6B"
+MAC_PREFIX = (0xF2, 0x00)  # Static random address range, not used by real tags
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class VirtualTag:  # pylint: disable=too-many-instance-attributes
+    """One simulated tag with drifting sensor values."""
+
+    def __init__(self, index, rng, drift):
+        self.rng = rng
+        self.drift = drift
+        address = (*MAC_PREFIX, (index >> 24) & 0xFF, (index >> 16) & 0xFF,
+                   (index >> 8) & 0xFF, index & 0xFF)
+        self.address = address
+        self.mac = ":".join(f"{byte:02X}" for byte in address)
+        self.temperature = rng.uniform(15, 25)
+        self.humidity = rng.uniform(30, 60)
+        self.pressure = rng.uniform(990, 1030)
+        self.battery = rng.randint(2900, 3100)
+        self.rssi = rng.uniform(-95, -60)
+        self.movement = 0
+        self.sequence = rng.randrange(65536)
+
+    def advance(self):
+        """Move to the next measurement."""
+        rng = self.rng
+        self.temperature = _clamp(self.temperature + rng.gauss(0, self.drift), -40, 85)
+        self.humidity = _clamp(self.humidity + rng.gauss(0, self.drift * 2), 0, 100)
+        self.pressure = _clamp(self.pressure + rng.gauss(0, self.drift), 500, 1155)
+        if rng.random() < 0.01:
+            self.movement = (self.movement + 1) % 256
+        self.sequence = (self.sequence + 1) % 65536
+
+    def encode(self):
+        """Return the advertisement as hex data followed by the RSSI byte."""
+        rng = self.rng
+        raw = struct.pack(
+            DF5_FORMAT, 5,
+            round(self.temperature * 200),
+            round(self.humidity * 400),
+            round(self.pressure * 100) - 50000,
+            rng.randint(-20, 20), rng.randint(-20, 20), 1000 + rng.randint(-20, 20),
+            (self.battery - 1600) << 5 | (4 + 40) // 2,
+            self.movement,
+            self.sequence,
+            *self.address
+        )
+        rssi = round(_clamp(self.rssi + rng.gauss(0, 3), -127, 0))
+        return raw.hex() + f"{rssi & 0xFF:02x}"
+
+
+class LoadGenerator:  # pylint: disable=too-many-instance-attributes
+    """Schedule advertisements of many virtual tags."""
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, tags=100, rate=0.78, jitter=0.1, loss=0.0, drift=0.02,
+                 seed=None, clock=time.monotonic):
+        """Create the virtual tags.
+
+        Args:
+            tags (int): Number of virtual tags.
+            rate (float): Advertisements per second per tag. Real tags send
+                one every 1285 ms by default.
+            jitter (float): Random variation of the interval, as a fraction.
+            loss (float): Probability that an advertisement is lost.
+            drift (float): Standard deviation of the value change per step.
+            seed (int): Random seed for repeatable runs.
+            clock (callable): Monotonic clock in seconds.
+        """
+        self.rng = random.Random(seed)
+        self.tags = [VirtualTag(index, self.rng, drift) for index in range(tags)]
+        self.interval = 1 / rate
+        self.jitter = jitter
+        self.loss = loss
+        self.clock = clock
+        self.decoder = Df5Decoder()
+        self.sent = 0
+        self.lost = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def _next_interval(self):
+        return self.interval * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    async def readings(self, duration=None):
+        """Yield (mac, data) tuples like RuuviTagSensor.get_data_async().
+
+        Args:
+            duration (float): Stop after this many seconds, run forever if None.
+        """
+        start = self.clock()
+        heap = [(start + self.rng.uniform(0, self.interval), index)
+                for index in range(len(self.tags))]
+        heapq.heapify(heap)
+        while heap:
+            due, index = heap[0]
+            if duration is not None and due - start > duration:
+                return
+            now = self.clock()
+            if due > now:
+                await asyncio.sleep(due - now)
+            else:
+                await asyncio.sleep(0)  # Let other tasks run while behind
+            heapq.heapreplace(heap, (due + self._next_interval(), index))
+            self.lag = max(self.clock() - due, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            tag = self.tags[index]
+            tag.advance()
+            if self.rng.random() < self.loss:
+                self.lost += 1
+                continue
+            data = self.decoder.decode_data(tag.encode())
+            self.sent += 1
+            yield tag.mac, data
+
+    def stats(self):
+        """Return generator statistics.
+
+        Returns:
+            dict: Tag count, sent and lost advertisements and schedule lag.
+        """
+        return {
+            "tags": len(self.tags),
+            "sent": self.sent,
+            "lost": self.lost,
+            "lag_ms": round(self.lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+        }
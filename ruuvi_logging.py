@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_logging
+
+Non-blocking logging for ruuvi2mqtt. The calling thread only puts records
+on a queue; a background listener thread does the actual writing. Noisy
+messages can be rate limited or sampled before they are queued.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+QUEUE_SIZE = 10000  # Records dropped instead of blocking when full
+MAX_RATE_LIMIT_KEYS = 4096
+
+
+def _first_arg(record):
+    """Return the first positional logging argument of a record or None."""
+    if isinstance(record.args, tuple) and record.args:
+        return record.args[0]
+    return None
+
+
+class RateLimitFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Pass a message at most once per interval.
+
+    Limits are keyed by the message template. Records sharing the template
+    and the first argument (e.g. a MAC address) share one window, so
+    different tags are limited independently. The number of suppressed
+    records is attached to the next passed record as ``suppressed``.
+    """
+
+    def __init__(self, limits, clock=time.monotonic):
+        super().__init__()
+        self.limits = dict(limits)
+        self.clock = clock
+        self.last_passed = {}
+        self.suppressed = {}
+
+    def filter(self, record):
+        interval = self.limits.get(record.msg)
+        if interval is None:
+            return True
+        key = (record.msg, _first_arg(record))
+        now = self.clock()
+        last = self.last_passed.get(key)
+        if last is not None and now - last < interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        if len(self.last_passed) >= MAX_RATE_LIMIT_KEYS:
+            self._prune(now)
+        self.last_passed[key] = now
+        count = self.suppressed.pop(key, 0)
+        if count:
+            record.suppressed = count
+        return True
+
+    def _prune(self, now):
+        """Forget keys whose window has already closed."""
+        for key, last in list(self.last_passed.items()):
+            if now - last >= self.limits[key[0]]:
+                del self.last_passed[key]
+                self.suppressed.pop(key, None)
+
+
+class SampleFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Pass every n:th record of a message template."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self.counters = {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.msg)
+        if rate is None or rate <= 1:
+            return True
+        count = self.counters.get(record.msg, 0)
+        self.counters[record.msg] = count + 1
+        return count % rate == 0
+
+
+class TextFormatter(logging.Formatter):
+    """Format records as text lines, noting records suppressed by rate limits."""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            text += f" ({suppressed} suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "time": self.formatTime(record, LOG_DATEFMT),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        suppressed = getattr(record, 'suppressed', None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking on a full queue."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def dropped():
+    """Return the number of records dropped on a full queue since setup_logging()."""
+    return sum(handler.dropped for handler in logging.getLogger().handlers
+               if isinstance(handler, DroppingQueueHandler))
+
+
+def setup_logging(level=logging.INFO, json_output=False, rate_limits=None,
+                  sample_rates=None, stream=None):
+    """Route root logger output through a queue to a background writer.
+
+    Existing root handlers are replaced.
+
+    Args:
+        level (int): Root logger level.
+        json_output (bool): Write structured JSON lines instead of text.
+        rate_limits (dict): Message template -> minimum seconds between records.
+        sample_rates (dict): Message template -> pass every n:th record.
+        stream: Output stream, stderr by default.
+
+    Returns:
+        logging.handlers.QueueListener: The started listener. Call stop()
+        on exit to flush pending records.
+    """
+    if json_output:
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter(LOG_FORMAT, LOG_DATEFMT)
+    writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    writer.setFormatter(formatter)
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    if rate_limits:
+        handler.addFilter(RateLimitFilter(rate_limits))
+    if sample_rates:
+        handler.addFilter(SampleFilter(sample_rates))
+
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, writer)
+    listener.start()
+    return listener
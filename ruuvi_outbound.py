@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_outbound
+
+Outbound delivery modes placed between handle_data() and the MQTT clients.
+The publishers here have the same publish() signature as paho's Client,
+so they can replace a client in CLIENTS.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+
+from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_MAX_IN_FLIGHT = 100
+DEFAULT_BATCH_INTERVAL = 10  # seconds
+DEFAULT_BATCH_MESSAGES = 100
+BATCH_TOPIC = "home/_batch/{gateway}"
+# Fields published one per topic in single value mode (-s)
+SINGLE_FIELDS = (
+    "temperature", "humidity", "pressure", "battery", "movement_counter"
+)
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Raised while unpacking corrupt or malformed batches, reported as ValueError
+UNPACK_ERRORS = (OSError, EOFError, KeyError, TypeError, AttributeError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+
+class ConflatingPublisher:
+    """Publish to one client, conflating per topic while it is behind.
+
+    While fewer than max_in_flight messages are waiting to be written to
+    the socket, messages are passed straight to the client. When the
+    broker connection is slow or down, only the newest pending message per
+    topic is kept, in a slot map ordered by first arrival, and delivered
+    as capacity frees up. Memory stays bounded by the number of topics.
+    """
+
+    def __init__(self, client, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.in_flight = collections.deque()
+        self.pending = collections.OrderedDict()
+        self.conflated = 0
+        self.acked = False  # Set by on_publish(), cleared by flush()
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish now, or queue as the newest message of the topic.
+
+        Returns:
+            mqtt.MQTTMessageInfo: Info of the sent message, or None when
+            the message was queued.
+        """
+        with self.lock:
+            self._reap()
+            queue = bool(self.pending) or not self._has_capacity()
+            if queue:
+                if topic in self.pending:
+                    self.conflated += 1
+                self.pending[topic] = (payload, qos, retain)
+        if not queue:
+            return self._send(topic, (payload, qos, retain))
+        self.flush()
+        return None
+
+    def flush(self):
+        """Deliver pending messages as far as capacity allows.
+
+        The lock is not held while calling the client: paho's network
+        thread holds its own message lock while it calls on_publish().
+        """
+        self.acked = False
+        while True:
+            with self.lock:
+                self._reap()
+                if not self.pending or not self._has_capacity():
+                    return
+                topic, message = self.pending.popitem(last=False)
+            self._send(topic, message)
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        # pylint: disable=unused-argument,too-many-arguments,too-many-positional-arguments
+        """paho on_publish callback: mark that capacity frees up.
+
+        Runs on the network thread before paho marks the message published,
+        so nothing is sent or reaped here; see flush_due().
+        """
+        self.acked = True
+
+    def metrics(self):
+        """Return conflation statistics.
+
+        Returns:
+            dict: Pending, in flight and conflated message counts.
+        """
+        return {
+            "pending": len(self.pending),
+            "in_flight": len(self.in_flight),
+            "conflated": self.conflated,
+        }
+
+    def _has_capacity(self):
+        return len(self.in_flight) < self.max_in_flight and self.client.is_connected()
+
+    def _reap(self):
+        in_flight = self.in_flight
+        while in_flight and (in_flight[0].rc != MQTT_ERR_SUCCESS or in_flight[0].is_published()):
+            in_flight.popleft()
+
+    def _send(self, topic, message):
+        payload, qos, retain = message
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc == MQTT_ERR_SUCCESS:
+            with self.lock:
+                self.in_flight.append(info)
+        else:
+            logging.debug("Publish to %s failed: %s", topic, info.rc)
+        return info
+
+
+def _decode_json(payload):
+    """Return payload as a JSON object if it is one, else None."""
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+    if isinstance(payload, str) and payload.startswith("{"):
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+    return None
+
+
+def pack_batch(gateway, messages, compression="gzip"):
+    """Pack messages into one compressed batch payload.
+
+    JSON object payloads are delta encoded: after the first message of a
+    topic, only the keys that changed ("d") or were removed ("x") are
+    stored. Other payloads are stored as they are ("r").
+
+    Args:
+        gateway (str): Name of the sending gateway.
+        messages (list): (topic, payload) tuples in publish order.
+        compression (str): "gzip" or "zstd".
+
+    Returns:
+        bytes: The compressed batch.
+    """
+    previous = {}
+    entries = []
+    for topic, payload in messages:
+        data = _decode_json(payload)
+        if data is None:
+            if isinstance(payload, (bytes, bytearray)):
+                payload = payload.decode('utf-8')
+            entries.append({"t": topic, "r": payload})
+            previous.pop(topic, None)
+            continue
+        last = previous.get(topic)
+        if last is None:
+            entries.append({"t": topic, "p": data})
+        else:
+            entry = {"t": topic,
+                     "d": {k: v for k, v in data.items() if k not in last or last[k] != v}}
+            removed = [k for k in last if k not in data]
+            if removed:
+                entry["x"] = removed
+            entries.append(entry)
+        previous[topic] = data
+    raw = json.dumps({"v": 1, "gateway": gateway, "messages": entries},
+                     separators=(",", ":")).encode('utf-8')
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(raw)
+    return gzip.compress(raw, mtime=0)
+
+
+def unpack_batch(payload):
+    """Unpack a batch made by pack_batch() back into messages.
+
+    Args:
+        payload (bytes): The compressed batch.
+
+    Returns:
+        tuple: Gateway name and a list of (topic, payload string) tuples.
+
+    Raises:
+        ValueError: If the batch is corrupt or malformed.
+    """
+    try:
+        return _unpack_batch(payload)
+    except UNPACK_ERRORS as exc:
+        raise ValueError(f"Malformed batch: {exc!r}") from exc
+
+
+def _unpack_batch(payload):
+    if payload.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd batch received but zstandard is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif payload.startswith(GZIP_MAGIC):
+        raw = gzip.decompress(payload)
+    else:
+        raise ValueError("Unknown batch compression")
+    batch = json.loads(raw)
+    state = {}
+    messages = []
+    for entry in batch["messages"]:
+        topic = entry["t"]
+        if "r" in entry:
+            state.pop(topic, None)
+            messages.append((topic, entry["r"]))
+            continue
+        if "p" in entry:
+            data = entry["p"]
+        else:
+            data = dict(state[topic])
+            data.update(entry["d"])
+            for key in entry.get("x", ()):
+                data.pop(key, None)
+        state[topic] = data
+        messages.append((topic, json.dumps(data)))
+    return batch["gateway"], messages
+
+
+class BatchingPublisher:  # pylint: disable=too-many-instance-attributes
+    """Collect non-retained messages and publish them as compressed batches.
+
+    A batch is sent to home/_batch/<gateway> when it has max_messages
+    messages or its oldest message is interval seconds old. Retained
+    messages such as discovery and availability are passed through at once.
+    """
+
+    def __init__(self, client, gateway, interval=DEFAULT_BATCH_INTERVAL,
+                 max_messages=DEFAULT_BATCH_MESSAGES, compression="gzip",
+                 clock=time.monotonic):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if compression not in ("gzip", "zstd"):
+            raise ValueError(f"Unknown batch compression {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd batch compression needs the zstandard package")
+        self.client = client
+        self.gateway = gateway
+        self.topic = BATCH_TOPIC.format(gateway=gateway)
+        self.interval = interval
+        self.max_messages = max_messages
+        self.compression = compression
+        self.clock = clock
+        self.messages = []
+        self.started = None
+        self.batches = 0
+        self.batched_messages = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Add a message to the batch, or publish it directly if retained."""
+        if retain:
+            return self.client.publish(topic, payload, qos=qos, retain=retain)
+        now = self.clock()
+        if not self.messages:
+            self.started = now
+        self.messages.append((topic, payload))
+        self.raw_bytes += len(payload) if payload else 0
+        if len(self.messages) >= self.max_messages or now - self.started >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Publish the collected messages as one batch."""
+        if not self.messages:
+            return None
+        batch = pack_batch(self.gateway, self.messages, self.compression)
+        self.batches += 1
+        self.batched_messages += len(self.messages)
+        self.sent_bytes += len(batch)
+        logging.debug("Sending batch of %d messages, %d bytes", len(self.messages), len(batch))
+        self.messages = []
+        return self.client.publish(self.topic, batch)
+
+    def flush_due(self):
+        """Publish the batch if its oldest message is interval seconds old.
+
+        Call periodically, so a batch goes out on time when no further
+        message arrives.
+        """
+        if self.messages and self.clock() - self.started >= self.interval:
+            self.flush()
+
+    def metrics(self):
+        """Return batching statistics.
+
+        Returns:
+            dict: Batch, message and byte counts, merged with the
+            statistics of a conflating client underneath.
+        """
+        metrics = {
+            "batches": self.batches,
+            "batched_messages": self.batched_messages,
+            "raw_bytes": self.raw_bytes,
+            "sent_bytes": self.sent_bytes,
+        }
+        if isinstance(self.client, ConflatingPublisher):
+            metrics.update(self.client.metrics())
+        return metrics
+
+
+PUBLISHERS = (ConflatingPublisher, BatchingPublisher)
+
+
+def wrap(client, options, gateway):
+    """Put the publishers a broker is configured with in front of its client.
+
+    Args:
+        client (mqtt.Client): Client of the broker.
+        options (dict): Broker settings; conflate, max_in_flight and batch
+            are used.
+        gateway (str): Name of the gateway, for batches.
+
+    Returns:
+        The outermost publisher, or the client if there is none.
+    """
+    publisher = client
+    if options.get("conflate"):
+        # Keep only the newest message per topic while the broker is behind
+        publisher = ConflatingPublisher(client,
+                                        options.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT))
+    batch = options.get("batch")
+    if batch:
+        # Send readings as compressed batches, e.g. over a metered uplink
+        publisher = BatchingPublisher(
+            publisher, gateway,
+            interval=batch.get("interval", DEFAULT_BATCH_INTERVAL),
+            max_messages=batch.get("max_messages", DEFAULT_BATCH_MESSAGES),
+            compression=batch.get("compression", "gzip")
+        )
+    return publisher
+
+
+def publisher_metrics(publishers):
+    """Return the metrics of the publishers of wrap() by broker.
+
+    Args:
+        publishers (dict): Broker name -> outermost publisher, or client.
+
+    Returns:
+        dict: Broker name -> metrics, for the brokers with a publisher.
+    """
+    return {broker: publisher.metrics() for broker, publisher in publishers.items()
+            if isinstance(publisher, PUBLISHERS)}
+
+
+def unwrap(publisher):
+    """Return the paho Client under the publishers of wrap()."""
+    while isinstance(publisher, PUBLISHERS):
+        publisher = publisher.client
+    return publisher
+
+
+def acknowledge(publisher, *args):
+    """Pass an on_publish callback to the conflating publishers of wrap().
+
+    Args:
+        publisher: The outermost publisher of a broker, or its client.
+        *args: Arguments of the callback.
+
+    Returns:
+        None
+    """
+    while isinstance(publisher, PUBLISHERS):
+        if isinstance(publisher, ConflatingPublisher):
+            publisher.on_publish(*args)
+        publisher = publisher.client
+
+
+def flush_due(publisher):
+    """Send what the publishers of wrap() hold, if it may go out.
+
+    Call on the main thread, e.g. periodically: a batch goes out once it is
+    interval seconds old, and pending messages of a conflating publisher
+    when an acknowledgement freed capacity or nothing is in flight.
+
+    Args:
+        publisher: The outermost publisher of a broker, or its client.
+
+    Returns:
+        None
+    """
+    while isinstance(publisher, PUBLISHERS):
+        if isinstance(publisher, BatchingPublisher):
+            publisher.flush_due()
+        elif publisher.pending and (publisher.acked or not publisher.in_flight):
+            publisher.flush()
+        publisher = publisher.client
+
+
+def close(publisher):
+    """Send a pending batch, disconnect and stop the network thread.
+
+    Args:
+        publisher: The outermost publisher of a broker, or its client.
+
+    Returns:
+        None
+    """
+    if isinstance(publisher, BatchingPublisher):
+        publisher.flush()
+    client = unwrap(publisher)
+    client.disconnect()
+    client.loop_stop()
+
+
+class SingleValues:
+    """Last single values published per broker, so unchanged ones are skipped.
+
+    Args:
+        fields (iterable): Fields published one per topic.
+    """
+
+    def __init__(self, fields=SINGLE_FIELDS):
+        self.fields = tuple(fields)
+        self.last = {}  # broker -> {(room, key): last published value}
+
+    def changed(self, broker, jdata):
+        """Return the fields of a reading that changed since the last call.
+
+        The returned values are remembered as published to the broker.
+
+        Args:
+            broker (str): Name of the broker.
+            jdata (dict): The reading, with its room.
+
+        Returns:
+            list: Keys whose value is new or changed.
+        """
+        last_values = self.last.setdefault(broker, {})
+        room = jdata['room']
+        changed = []
+        for key in self.fields:
+            value = jdata.get(key)
+            if value is None or last_values.get((room, key)) == value:
+                continue
+            last_values[(room, key)] = value
+            changed.append(key)
+        return changed
+
+    def forget_room(self, room):
+        """Publish the values of a room again on its next reading."""
+        for last_values in self.last.values():
+            for key in [key for key in last_values if key[0] == room]:
+                del last_values[key]
+
+    def forget(self, broker=None):
+        """Publish all values of a broker, or of all brokers, again."""
+        if broker is None:
+            self.last.clear()
+        else:
+            self.last.pop(broker, None)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_probe
+
+Check that a set of RuuviTags can be heard, for commissioning and health
+checks. Unlike ruuvi_single.py, all tags are looked for in one scan, which
+ends as soon as every tag has been seen.
+
+Usage:
+    python ruuvi_probe.py AA:BB:CC:DD:EE:FF 11:22:33:44:55:66
+    python ruuvi_probe.py --all --timeout 20
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+import ruuvi_config
+
+DEFAULT_TIMEOUT = 30  # seconds
+
+
+async def _collect(source, wanted, found, start, clock):
+    async for mac, data in source:
+        try:
+            mac = ruuvi_config.normalize_mac(mac)
+        except ruuvi_config.ConfigError:
+            continue
+        if mac not in wanted or mac in found:
+            continue
+        found[mac] = {
+            "first_packet_s": round(clock() - start, 3),
+            "rssi": data.get("rssi"),
+            "data": data,
+        }
+        if len(found) == len(wanted):
+            return
+
+
+async def probe(macs, source, timeout=DEFAULT_TIMEOUT, clock=time.monotonic):
+    """Scan until every tag has been seen or the timeout has passed.
+
+    Args:
+        macs (iterable): Normalized MAC addresses to look for.
+        source: Async iterator of (mac, data) tuples like
+            RuuviTagSensor.get_data_async().
+        timeout (float): Seconds to scan at most.
+        clock (callable): Monotonic clock in seconds.
+
+    Returns:
+        dict: MAC address -> time to first packet in seconds, RSSI and
+        decoded data, for the tags that were seen.
+    """
+    wanted = set(macs)
+    found = {}
+    start = clock()
+    if wanted:
+        try:
+            await asyncio.wait_for(_collect(source, wanted, found, start, clock), timeout)
+        except asyncio.TimeoutError:
+            pass
+    aclose = getattr(source, "aclose", None)
+    if aclose is not None:
+        await aclose()
+    return found
+
+
+def report(macs, found, rooms=None, elapsed=None):
+    """Build the JSON report of a probe.
+
+    Args:
+        macs (iterable): MAC addresses that were looked for, in order.
+        found (dict): Result of probe().
+        rooms (dict): MAC address -> room, for labelling.
+        elapsed (float): Duration of the scan in seconds.
+
+    Returns:
+        dict: Found tags with their room, missing MAC addresses and the
+        scan duration.
+    """
+    rooms = rooms or {}
+    tags = {}
+    for mac in macs:
+        if mac in found:
+            tags[mac] = dict(found[mac], room=rooms.get(mac))
+    return {
+        "found": tags,
+        "missing": [mac for mac in macs if mac not in found],
+        "elapsed_s": round(elapsed, 3) if elapsed is not None else None,
+    }
+
+
+def main():
+    """Probe the tags given on the command line or in the configuration."""
+    # pylint: disable=import-outside-toplevel
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check that RuuviTags can be heard")
+    parser.add_argument("macs", nargs="*", help="MAC addresses of the tags")
+    parser.add_argument("--all", action="store_true", help="probe every tag in my_ruuvis")
+    parser.add_argument("--config", help="configuration file, found as by ruuvi2mqtt if unset")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds to scan at most")
+    args = parser.parse_args()
+
+    rooms = {}
+    try:
+        if args.all or args.config:
+            config = ruuvi_config.load(args.config or ruuvi_config.find())
+            rooms = config.ruuvis
+        macs = [ruuvi_config.normalize_mac(mac) for mac in args.macs]
+    except ruuvi_config.ConfigError as exc:
+        parser.error(str(exc))
+    if args.all:
+        macs += [mac for mac in rooms if mac not in macs]
+    if not macs:
+        parser.error("give MAC addresses or --all")
+
+    from ruuvitag_sensor.ruuvi import RuuviTagSensor
+
+    start = time.monotonic()
+    found = asyncio.run(probe(macs, RuuviTagSensor.get_data_async(macs), args.timeout))
+    result = report(macs, found, rooms, time.monotonic() - start)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if result["missing"]:
+        print("Not received: " + " ".join(
+            f"{mac} ({rooms[mac]})" if mac in rooms else mac for mac in result["missing"]
+        ), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
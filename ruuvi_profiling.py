@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_profiling
+
+Runtime togglable profiling for ruuvi2mqtt. Commands can arrive from any
+thread (signal handler, MQTT network thread) but are only queued there;
+they are started, stopped and dumped from the scanner thread by poll(), so
+cProfile sees the thread that handles the BLE data.
+
+Commands:
+    cpu [seconds]      cProfile the scanner thread
+    memory [seconds]   tracemalloc snapshot of the top allocators
+    timers [seconds]   per-stage timers (handle_data, serialize, publish)
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import signal
+import time
+import tracemalloc
+
+DEFAULT_SECONDS = 30
+TOP_ENTRIES = 40
+TRACEMALLOC_FRAMES = 10
+# Raised by a session that cannot start or dump, e.g. another profiler is
+# active or the output directory is not writable; the session is dropped
+SESSION_ERRORS = (OSError, ValueError, RuntimeError)
+_NO_TIMER = contextlib.nullcontext()
+
+
+def install_signals(profiler, processes=None):
+    """Request profiling with SIGUSR1 (cpu) and SIGUSR2 (memory and timers).
+
+    Args:
+        profiler (Profiler): Profiler of this process.
+        processes (dict): Name -> multiprocessing.Process; the signals are
+            passed on to them instead, for a process that handles no
+            readings.
+
+    Returns:
+        None
+    """
+    def request_cpu(signum, frame):  # pylint: disable=unused-argument
+        profiler.request("cpu")
+
+    def request_memory(signum, frame):  # pylint: disable=unused-argument
+        profiler.request("memory")
+        profiler.request("timers")
+
+    def forward(signum, frame):  # pylint: disable=unused-argument
+        for process in processes.values():
+            try:
+                os.kill(process.pid, signum)
+            except OSError as exc:
+                logging.warning("Could not signal %s: %s", process.name, exc)
+
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    if processes:
+        signal.signal(signal.SIGUSR1, forward)
+        signal.signal(signal.SIGUSR2, forward)
+    else:
+        signal.signal(signal.SIGUSR1, request_cpu)
+        signal.signal(signal.SIGUSR2, request_memory)
+
+
+class StageTimers:
+    """Accumulate call count, total and maximum time per processing stage."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+
+    def add(self, stage, seconds):
+        """Add one measurement for a stage."""
+        stat = self.stats.get(stage)
+        if stat is None:
+            self.stats[stage] = [1, seconds, seconds]
+        else:
+            stat[0] += 1
+            stat[1] += seconds
+            if seconds > stat[2]:
+                stat[2] = seconds
+
+    @contextlib.contextmanager
+    def _measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def stage(self, stage):
+        """Return a context manager timing a stage, a no-op when disabled."""
+        if not self.enabled:
+            return _NO_TIMER
+        return self._measure(stage)
+
+    def summary(self):
+        """Return the statistics in milliseconds as a dict."""
+        return {
+            stage: {
+                "count": count,
+                "total_ms": total * 1000,
+                "mean_ms": total * 1000 / count,
+                "max_ms": maximum * 1000,
+            }
+            for stage, (count, total, maximum) in self.stats.items()
+        }
+
+
+class Profiler:
+    """Run profiling sessions requested at runtime and dump the results."""
+
+    def __init__(self, output_dir, name="ruuvi2mqtt", clock=time.monotonic):
+        self.output_dir = output_dir
+        self.name = name
+        self.clock = clock
+        self.timers = StageTimers()
+        self.pending = collections.deque()
+        self.deadlines = {}
+        self._cpu_profile = None
+
+    def request(self, command):
+        """Queue a command such as "cpu 30". Safe to call from any thread.
+
+        Args:
+            command (str): Command name and optional duration in seconds.
+
+        Returns:
+            bool: True if the command was understood and queued.
+        """
+        parts = command.split()
+        if not parts or parts[0] not in ("cpu", "memory", "timers"):
+            logging.warning("Unknown profiling command: %s", command)
+            return False
+        try:
+            seconds = float(parts[1]) if len(parts) > 1 else DEFAULT_SECONDS
+        except ValueError:
+            logging.warning("Bad profiling duration: %s", command)
+            return False
+        self.pending.append((parts[0], seconds))
+        return True
+
+    def poll(self):
+        """Start queued sessions and finish expired ones.
+
+        Called from the scanner thread for every reading; cheap when idle.
+        A session that fails is logged and dropped, it never raises.
+        """
+        if not self.pending and not self.deadlines:
+            return
+        now = self.clock()
+        while self.pending:
+            kind, seconds = self.pending.popleft()
+            if kind not in self.deadlines:
+                try:
+                    self._start(kind)
+                except SESSION_ERRORS as exc:
+                    self._abort(kind, exc)
+                    continue
+            self.deadlines[kind] = now + seconds
+        for kind, deadline in list(self.deadlines.items()):
+            if now >= deadline:
+                del self.deadlines[kind]
+                try:
+                    self._stop(kind)
+                except SESSION_ERRORS as exc:
+                    self._abort(kind, exc)
+
+    def _abort(self, kind, exc):
+        logging.error("Profiling %s failed: %s", kind, exc)
+        self.deadlines.pop(kind, None)
+        if kind == "cpu":
+            if self._cpu_profile is not None:
+                self._cpu_profile.disable()
+                self._cpu_profile = None
+        elif kind == "memory":
+            tracemalloc.stop()
+        else:
+            self.timers.enabled = False
+
+    def _start(self, kind):
+        logging.info("Profiling started: %s", kind)
+        if kind == "cpu":
+            import cProfile  # pylint: disable=import-outside-toplevel
+            self._cpu_profile = cProfile.Profile()
+            self._cpu_profile.enable()
+        elif kind == "memory":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+        else:
+            self.timers.stats = {}
+            self.timers.enabled = True
+
+    def _stop(self, kind):
+        if kind == "cpu":
+            import io  # pylint: disable=import-outside-toplevel
+            import pstats  # pylint: disable=import-outside-toplevel
+            self._cpu_profile.disable()
+            path = self._path("cpu", "pstats")
+            self._cpu_profile.dump_stats(path)
+            report = io.StringIO()
+            stats = pstats.Stats(self._cpu_profile, stream=report)
+            stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+            self._cpu_profile = None
+            self._write(self._path("cpu", "txt"), report.getvalue())
+        elif kind == "memory":
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            lines = [str(stat) for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]]
+            path = self._path("memory", "txt")
+            self._write(path, "\n".join(lines) + "\n")
+        else:
+            self.timers.enabled = False
+            path = self._path("timers", "json")
+            self._write(path, json.dumps(self.timers.summary(), indent=2))
+        logging.info("Profiling finished: %s, results in %s", kind, path)
+
+    def _path(self, kind, extension):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.output_dir, f"{self.name}-{kind}-{stamp}.{extension}")
+
+    @staticmethod
+    def _write(path, text):
+        with open(path, "w", encoding="utf-8") as file_handle:
+            file_handle.write(text)
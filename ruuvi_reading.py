@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_reading
+
+Reading record passed through the gateway for every advertisement.
+
+The decoded dict of ruuvitag_sensor is kept as it is. The fields the
+gateway adds (room, client, timestamps, RSSI per gateway) are slots, the
+clocks are read once, and the state payload is serialized from the slots
+without copying them into the dict. A dict with all fields is only built
+for consumers that need one, such as sinks and single value mode.
+
+Run as a script to compare it with updating the decoded dict:
+    python ruuvi_reading.py --count 20000
+"""
+
+import datetime
+import json
+import time
+
+_dumps = json.dumps
+# Whole second and its ISO 8601 text, shared by all readings. Read and
+# replaced as one tuple, as the sink threads call iso_time() too
+_ISO_SECOND = (None, "")
+_PREFIXES = {}  # (room, client) -> serialized room, client and rssi_<client> key
+MAX_PREFIXES = 4096
+
+
+def iso_time(timestamp):
+    """Return a Unix time like datetime.isoformat() of an aware UTC datetime.
+
+    The text of the whole second is reused while it does not change.
+    """
+    global _ISO_SECOND  # pylint: disable=global-statement
+    second = int(timestamp // 1)
+    cached_second, text = _ISO_SECOND
+    if cached_second != second:
+        text = datetime.datetime.fromtimestamp(
+            second, tz=datetime.timezone.utc).isoformat()[:-6]
+        _ISO_SECOND = (second, text)
+    micro = min(round((timestamp - second) * 1e6), 999999)
+    if micro:
+        return f"{text}.{micro:06d}+00:00"
+    return text + "+00:00"
+
+
+def _prefix(room, client):
+    prefix = _PREFIXES.get((room, client))
+    if prefix is None:
+        if len(_PREFIXES) >= MAX_PREFIXES:
+            _PREFIXES.clear()
+        prefix = (f'"room": {_dumps(room)}, "client": {_dumps(client)}, ',
+                  f'{_dumps("rssi_" + str(client))}: ')
+        _PREFIXES[(room, client)] = prefix
+    return prefix
+
+
+class Reading:  # pylint: disable=too-many-instance-attributes
+    """One received advertisement and the fields added by the gateway.
+
+    Attributes:
+        mac (str): MAC address of the tag.
+        data (dict): Decoded sensor data, extended in place only by
+            derived metrics.
+        received (float): time.perf_counter() when the data was received.
+        timestamp (float): Unix time when the data was received.
+        room (str): The room identifier, set when it is known.
+        client (str): Name of the gateway.
+        extra (dict): Other added fields, such as latency_ms, or None.
+    """
+
+    __slots__ = ("mac", "data", "received", "timestamp", "room", "client", "extra", "_dict")
+
+    def __init__(self, mac, data, received=None, timestamp=None):
+        self.mac = mac
+        self.data = data
+        self.received = time.perf_counter() if received is None else received
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.room = None
+        self.client = None
+        self.extra = None
+        self._dict = None
+
+    @property
+    def now(self):
+        """Receive time as an aware UTC datetime.
+
+        Created on each access and not kept, so queued readings stay small.
+        """
+        return datetime.datetime.fromtimestamp(self.timestamp, tz=datetime.timezone.utc)
+
+    def add(self, key, value):
+        """Add a field, serialized after the gateway fields."""
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+        self._dict = None
+
+    def as_dict(self):
+        """Return all fields as one dict, built once per reading.
+
+        Returns:
+            dict: Decoded data with room, client, ts, ts_iso,
+            rssi_<client> and the extra fields.
+        """
+        if self._dict is None:
+            values = dict(self.data)
+            values["room"] = self.room
+            values["client"] = self.client
+            values["ts"] = self.timestamp
+            values["ts_iso"] = iso_time(self.timestamp)
+            values[f"rssi_{self.client}"] = self.data.get("rssi")
+            if self.extra:
+                values.update(self.extra)
+            self._dict = values
+        return self._dict
+
+    def payload(self):
+        """Serialize the reading as the JSON state payload.
+
+        Returns:
+            str: The same object as json.dumps(self.as_dict()).
+        """
+        body = _dumps(self.data)
+        room_client, rssi_key = _prefix(self.room, self.client)
+        rssi = self.data.get("rssi")
+        tail = (f'{room_client}"ts": {self.timestamp!r}, "ts_iso": "{iso_time(self.timestamp)}", '
+                f'{rssi_key}{rssi if isinstance(rssi, int) else _dumps(rssi)}')
+        if self.extra:
+            tail += ", " + _dumps(self.extra)[1:-1]
+        if body == "{}":
+            return "{" + tail + "}"
+        return body[:-1] + ", " + tail + "}"
+
+
+def from_found(found_data, received=None):
+    """Return found_data as a Reading.
+
+    Args:
+        found_data: A Reading, or a (mac, data) tuple as yielded by
+            RuuviTagSensor.get_data_async().
+        received (float): time.perf_counter() when the data was received,
+            now if None.
+
+    Returns:
+        Reading: The reading.
+    """
+    if isinstance(found_data, Reading):
+        return found_data
+    return Reading(found_data[0], found_data[1], received)
+
+
+def _dict_path(mac, data, room, client):
+    """The previous per-packet handling, for comparison in benchmark()."""
+    received = time.perf_counter()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)  # In main()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)  # In handle_data()
+    data.update({"room": room})
+    data.update({"client": client})
+    data.update({"ts": now.timestamp()})
+    data.update({"ts_iso": now.isoformat()})
+    data.update({f"rssi_{client}": data['rssi']})
+    payload = json.dumps(data).replace("'", '"')
+    return data, mac, received, payload  # The dict is what sinks queued
+
+
+def _reading_path(mac, data, room, client):
+    reading = Reading(mac, data)
+    _ = reading.now  # Used for the periodic checks
+    reading.room = room
+    reading.client = client
+    return reading, reading.payload()  # The reading is what sinks queue
+
+
+def benchmark(count=20000, tags=50, backlog=1000):  # pylint: disable=too-many-locals
+    """Compare per-packet handling with dicts and with Reading records.
+
+    Args:
+        count (int): Packets to handle per variant for the timing.
+        tags (int): Distinct simulated tags.
+        backlog (int): Readings held at once, as in a sink queue while its
+            destination is down.
+
+    Returns:
+        dict: Per variant: microseconds per packet, bytes allocated at the
+        peak of handling one packet, and bytes held per queued reading.
+    """
+    # pylint: disable=import-outside-toplevel
+    import random
+    import tracemalloc
+    import ruuvi_loadgen
+
+    rng = random.Random(1)
+    decoder = ruuvi_loadgen.Df5Decoder()
+    packets = []
+    for index in range(tags):
+        tag = ruuvi_loadgen.VirtualTag(index, rng, 0.05)
+        packets.append((tag.mac, decoder.decode_data(tag.encode()), f"room-{index}"))
+    results = {}
+    for name, handle in (("dict", _dict_path), ("reading", _reading_path)):
+        start = time.perf_counter()
+        for index in range(count):
+            mac, data, room = packets[index % tags]
+            handle(mac, dict(data), room, "gateway")  # The decoder makes a fresh dict
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        transient = 0
+        for index in range(tags):
+            mac, data, room = packets[index]
+            data = dict(data)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            handle(mac, data, room, "gateway")
+            transient += tracemalloc.get_traced_memory()[1] - current
+        held = []
+        current = tracemalloc.get_traced_memory()[0]
+        for index in range(backlog):
+            mac, data, room = packets[index % tags]
+            held.append(handle(mac, dict(data), room, "gateway")[0])
+        retained = tracemalloc.get_traced_memory()[0] - current
+        tracemalloc.stop()
+        results[name] = {
+            "us_per_packet": round(elapsed / count * 1e6, 2),
+            "transient_bytes_per_packet": round(transient / tags),
+            "bytes_per_queued_reading": round(retained / backlog),
+        }
+    return results
+
+
+def main():
+    """Print the benchmark() results."""
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(description="Benchmark reading records")
+    parser.add_argument("--count", type=int, default=20000, help="packets per variant")
+    parser.add_argument("--tags", type=int, default=50, help="simulated tags")
+    parser.add_argument("--backlog", type=int, default=1000, help="readings held at once")
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.count, args.tags, args.backlog), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_shm
+
+Ring buffer of fixed-size reading records in shared memory, used to split
+the gateway into a capture process and publisher processes.
+
+There is one writer, the capture process. Each reader keeps its own
+cursor, so every publisher sees every reading. A reader that falls more
+than a ring behind skips to the oldest record still held and counts the
+skipped ones as dropped; the writer never waits for readers.
+
+Each slot starts with its sequence number, which the writer clears before
+and sets after writing the record. A reader accepts a record only if the
+sequence number is the expected one both before and after copying it.
+"""
+
+import asyncio
+import atexit
+import logging
+import math
+import multiprocessing
+import os
+import struct
+from multiprocessing import shared_memory
+
+DEFAULT_SLOTS = 4096
+POLL_INTERVAL = 0.01  # Seconds between polls while the ring is empty
+
+# Decoded fields carried in a record: name -> type of the value. Fields of
+# data formats 3, 5, 6 and E1; others are dropped.
+FIELDS = {
+    "temperature": float,
+    "humidity": float,
+    "pressure": float,
+    "acceleration": float,
+    "acceleration_x": int,
+    "acceleration_y": int,
+    "acceleration_z": int,
+    "tx_power": int,
+    "battery": int,
+    "movement_counter": int,
+    "measurement_sequence_number": int,
+    "rssi": int,
+    "pm_1": float,
+    "pm_2_5": float,
+    "pm_4": float,
+    "pm_10": float,
+    "co2": float,
+    "voc": float,
+    "nox": float,
+    "luminosity": float,
+    "calibration_in_progress": bool,
+}
+FIELD_NAMES = tuple(FIELDS)
+
+HEADER = struct.Struct("<QQ")  # records written, slots
+SEQUENCE = struct.Struct("<Q")
+# sequence, MAC, data format, whether the data had a "mac" key, receive time, values
+RECORD = struct.Struct(f"<Q6s4s?xd{len(FIELDS)}d")
+
+
+def start_publishers(target, brokers, options, index_file):
+    """Create the ring buffer and start the publisher processes with fork.
+
+    Call before any threads are started. With per_broker each broker has
+    its own process and discovery index file. The first publisher is the
+    primary one.
+
+    Args:
+        target: Function run in each process as target(name, brokers,
+            primary, index_file, ring, connected).
+        brokers (dict): Broker configurations.
+        options (dict): The multiprocess setting.
+        index_file (str): Discovery index file name of a single publisher.
+
+    Returns:
+        tuple: The ring buffer, the daemon processes by name, and by name
+        the shared int each process sets to its number of connected brokers.
+    """
+    ring = ReadingRing(options.get('slots', DEFAULT_SLOTS))
+    atexit.register(ring.close, unlink=True)
+    if options.get('per_broker'):
+        groups = {broker: {broker: brokers[broker]} for broker in brokers}
+    else:
+        groups = {"publisher": brokers}
+    root, ext = os.path.splitext(index_file)
+    context = multiprocessing.get_context('fork')
+    processes = {}
+    connected = {}
+    for index, (name, group) in enumerate(groups.items()):
+        connected[name] = context.Value('i', 0, lock=False)
+        args = (name, group, index == 0,
+                f"{root}-{name}{ext}" if len(groups) > 1 else index_file,
+                ring, connected[name])
+        processes[name] = context.Process(target=target, name=f"ruuvi2mqtt-{name}",
+                                          args=args, daemon=True)
+        processes[name].start()
+    return ring, processes, connected
+
+
+async def consume(ring, handle, tick, parent=None, interval=POLL_INTERVAL):
+    """Pass the readings of the ring buffer to handle(); run in a publisher.
+
+    Args:
+        ring (ReadingRing): Ring buffer shared with the capture process.
+        handle: Called as handle((mac, data), received) for each reading.
+        tick: Called after each poll as tick(idle), idle being True if
+            the ring had no new readings.
+        parent (int): Process id of the capture process; stop when it is gone.
+        interval (float): Seconds to sleep while the ring is empty.
+
+    Returns:
+        None
+    """
+    while True:
+        readings = ring.get()
+        tick(not readings)
+        if not readings:
+            if parent is not None and os.getppid() != parent:
+                logging.error("Capture process exited, stopping publisher")
+                return
+            await asyncio.sleep(interval)
+            continue
+        for mac, data, received in readings:
+            handle((mac, data), received)
+
+
+def readiness(processes, connected):
+    """Check that all publisher processes run and one has a connected broker.
+
+    Args:
+        processes (dict): Name -> multiprocessing.Process.
+        connected (dict): Name -> shared number of connected brokers.
+
+    Returns:
+        tuple: True if ready, and the details.
+    """
+    publishers = {
+        name: {"alive": process.is_alive(), "brokers_connected": connected[name].value}
+        for name, process in processes.items()
+    }
+    ready = (all(state["alive"] for state in publishers.values()) and
+             any(state["brokers_connected"] for state in publishers.values()))
+    return ready, {"publishers": publishers}
+
+
+def pack_mac(mac):
+    """Return a MAC address such as "AA:BB:CC:DD:EE:FF" as 6 bytes."""
+    return bytes.fromhex(mac.replace(":", "").replace("-", ""))
+
+
+def unpack_mac(raw):
+    """Return 6 bytes as a MAC address such as "AA:BB:CC:DD:EE:FF"."""
+    return ":".join(f"{byte:02X}" for byte in raw)
+
+
+class ReadingRing:
+    """Single writer, many readers ring of readings in shared memory.
+
+    Create the ring before forking; the child processes use the inherited
+    object and each gets its own cursor.
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS):
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=HEADER.size + slots * RECORD.size)
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, 0, slots)
+        self.written = 0  # Writer side
+        self.cursor = 0  # Reader side
+        self.dropped = 0
+
+    @property
+    def name(self):
+        """Name of the shared memory block."""
+        return self.shm.name
+
+    def head(self):
+        """Return the number of records written so far."""
+        return HEADER.unpack_from(self.buf, 0)[0]
+
+    def put(self, mac, data, received):
+        """Write one reading, overwriting the oldest when the ring is full.
+
+        Args:
+            mac (str): MAC address of the tag.
+            data (dict): Decoded sensor data.
+            received (float): time.perf_counter() when the data was received.
+
+        Returns:
+            None
+        """
+        index = self.written
+        offset = HEADER.size + (index % self.slots) * RECORD.size
+        values = []
+        for name in FIELD_NAMES:
+            value = data.get(name)
+            values.append(math.nan if value is None else float(value))
+        data_format = str(data.get("data_format", "")).encode("ascii")[:4]
+        SEQUENCE.pack_into(self.buf, offset, 0)
+        RECORD.pack_into(self.buf, offset, 0, pack_mac(mac), data_format,
+                         "mac" in data, received, *values)
+        SEQUENCE.pack_into(self.buf, offset, index + 1)
+        self.written = index + 1
+        HEADER.pack_into(self.buf, 0, self.written, self.slots)
+
+    def get(self, limit=None):
+        """Return the readings written since the previous call.
+
+        Args:
+            limit (int): Return at most this many readings.
+
+        Returns:
+            list: (mac, data, received) tuples in write order.
+        """
+        head = self.head()
+        if head - self.cursor > self.slots:
+            self.dropped += head - self.slots - self.cursor
+            self.cursor = head - self.slots
+        if limit is not None:
+            head = min(head, self.cursor + limit)
+        readings = []
+        for index in range(self.cursor, head):
+            offset = HEADER.size + (index % self.slots) * RECORD.size
+            record = RECORD.unpack_from(self.buf, offset)
+            if record[0] != index + 1 or SEQUENCE.unpack_from(self.buf, offset)[0] != index + 1:
+                self.dropped += 1  # Overwritten while reading
+                continue
+            readings.append(self._decode(record))
+        self.cursor = head
+        return readings
+
+    @staticmethod
+    def _decode(record):
+        mac = unpack_mac(record[1])
+        data_format = record[2].rstrip(b"\0").decode("ascii")
+        data = {}
+        if data_format:
+            data["data_format"] = int(data_format) if data_format.isdigit() else data_format
+        for name, value in zip(FIELD_NAMES, record[5:]):
+            if not math.isnan(value):
+                data[name] = FIELDS[name](value)
+        if record[3]:
+            data["mac"] = mac.replace(":", "").lower()
+        return mac, data, record[4]
+
+    def metrics(self):
+        """Return the reader statistics.
+
+        Returns:
+            dict: Records written, records behind the writer and dropped
+            records of this reader.
+        """
+        head = self.head()
+        return {"written": head, "behind": head - self.cursor, "dropped": self.dropped}
+
+    def close(self, unlink=False):
+        """Release the shared memory, removing it if unlink is True."""
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_sinks
+
+Additional destinations for readings besides the MQTT brokers, such as a
+local file or InfluxDB line protocol over UDP or HTTP.
+
+Each sink has a bounded queue and its own worker thread that batches,
+formats and sends readings, so a slow destination never blocks the
+scanner thread. When the queue is full, new readings are dropped and
+counted.
+"""
+
+import abc
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 5  # seconds
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1  # seconds, doubled after every failed attempt
+DEFAULT_QUEUE_SIZE = 10000
+MAX_DATAGRAM = 1400  # bytes, fits in one Ethernet frame
+MEASUREMENT = "ruuvi"
+TAG_KEYS = ("room", "mac", "client")
+SKIPPED_FIELDS = ("ts", "ts_iso")
+# format() errors skip the reading; send() errors fail the attempt
+FORMAT_ERRORS = (TypeError, ValueError, KeyError, AttributeError)
+SEND_ERRORS = (OSError, http.client.HTTPException)
+_STOP = object()
+
+
+class Sink(abc.ABC):
+    """Batching sink running on its own thread.
+
+    Subclasses implement format() for one reading and send() for a batch
+    of formatted readings. send() raises OSError or HTTPException on
+    failure, and the batch is retried with exponential backoff. The worker
+    thread only stops on close(); readings that cannot be formatted or
+    sent are counted as failed.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
+    def __init__(self, name, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, retries=DEFAULT_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, queue_size=DEFAULT_QUEUE_SIZE):
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, reading):
+        """Queue a reading without blocking.
+
+        Args:
+            reading: ruuvi_reading.Reading, or a dict of decoded and
+                enriched sensor data. A Reading is queued as it is and
+                only turned into a dict by the worker thread.
+
+        Returns:
+            bool: False if the queue was full and the reading was dropped.
+        """
+        try:
+            self.queue.put_nowait(reading)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def start(self):
+        """Start the worker thread."""
+        self.thread = threading.Thread(target=self._run, name=f"sink-{self.name}",
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self, timeout=5):
+        """Flush the queued readings and stop the worker thread."""
+        if self.thread is None:
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def metrics(self):
+        """Return delivery statistics.
+
+        Returns:
+            dict: Sent, dropped, failed and queued reading counts.
+        """
+        return {
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self.queue.qsize(),
+        }
+
+    @abc.abstractmethod
+    def format(self, reading):
+        """Format one reading for send()."""
+
+    @abc.abstractmethod
+    def send(self, lines):
+        """Send a batch of formatted readings, raising OSError on failure."""
+
+    def flush(self, batch):
+        """Format and send a batch, retrying failed attempts.
+
+        Returns:
+            bool: True if the batch was sent.
+        """
+        lines = []
+        for reading in batch:
+            try:
+                lines.append(self.format(
+                    reading if isinstance(reading, dict) else reading.as_dict()))
+            except FORMAT_ERRORS as exc:
+                logging.warning("Sink %s skipped a reading it could not format: %r",
+                                self.name, exc)
+                self.failed += 1
+        if not lines:
+            return False
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.send(lines)
+            except SEND_ERRORS as exc:
+                logging.warning("Sink %s failed to send %d readings (attempt %d): %s",
+                                self.name, len(lines), attempt + 1, exc)
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+                continue
+            self.sent += len(lines)
+            return True
+        self.failed += len(lines)
+        return False
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                reading = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                reading = None
+            if reading is _STOP:
+                if batch:
+                    self._flush_safely(batch)
+                return
+            if reading is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(reading)
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush_safely(batch)
+                batch = []
+                deadline = None
+
+    def _flush_safely(self, batch):
+        try:
+            self.flush(batch)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # A bug in a sink must not stop its worker and silently drop readings
+            logging.exception("Sink %s failed to flush %d readings", self.name, len(batch))
+            self.failed += len(batch)
+
+
+class FileSink(Sink):
+    """Append readings to a file as JSON lines."""
+
+    def __init__(self, name, path, **options):
+        super().__init__(name, **options)
+        self.path = path
+
+    def format(self, reading):
+        return json.dumps(reading)
+
+    def send(self, lines):
+        with open(self.path, "a", encoding="utf-8") as file_handle:
+            file_handle.write("\n".join(lines) + "\n")
+
+
+def _escape_tag(value):
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace(
+        "=", "\\=").replace(" ", "\\ ")
+
+
+def _field_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, str):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return None
+
+
+def line_protocol(reading, measurement=MEASUREMENT):
+    """Format a reading as one InfluxDB line protocol line.
+
+    Args:
+        reading (dict): Sensor data with room, mac and client as tags and
+            ts (epoch seconds) as the timestamp.
+        measurement (str): Measurement name.
+
+    Returns:
+        str: The line, or None if the reading has no fields.
+    """
+    tags = "".join(
+        f",{key}={_escape_tag(reading[key])}"
+        for key in TAG_KEYS if reading.get(key) not in (None, "")
+    )
+    fields = []
+    for key, value in reading.items():
+        if key in TAG_KEYS or key in SKIPPED_FIELDS:
+            continue
+        value = _field_value(value)
+        if value is not None:
+            fields.append(f"{_escape_tag(key)}={value}")
+    if not fields:
+        return None
+    line = f"{_escape_tag(measurement)}{tags} {','.join(fields)}"
+    if reading.get("ts") is not None:
+        line += f" {int(reading['ts'] * 1e9)}"
+    return line
+
+
+class InfluxSink(Sink):
+    """Write readings as InfluxDB line protocol over UDP or HTTP.
+
+    The url is either udp://host:port or the full HTTP write endpoint,
+    e.g. http://influx:8086/api/v2/write?org=home&bucket=ruuvi&precision=ns
+    """
+
+    def __init__(self, name, url, token=None, measurement=MEASUREMENT, **options):
+        super().__init__(name, **options)
+        self.url = url
+        self.token = token
+        self.measurement = measurement
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == "udp":
+            self.address = (parsed.hostname, parsed.port or 8089)
+        elif parsed.scheme in ("http", "https"):
+            self.address = None
+        else:
+            raise ValueError(f"Unsupported InfluxDB url {url}")
+
+    def format(self, reading):
+        return line_protocol(reading, self.measurement)
+
+    def send(self, lines):
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+        if self.address is not None:
+            self._send_udp(lines)
+            return
+        request = urllib.request.Request(self.url, data="\n".join(lines).encode("utf-8"),
+                                         method="POST")
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        if self.token:
+            request.add_header("Authorization", f"Token {self.token}")
+        with urllib.request.urlopen(request, timeout=10):
+            pass
+
+    def _send_udp(self, lines):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            datagram = b""
+            for line in lines:
+                data = line.encode("utf-8") + b"\n"
+                if datagram and len(datagram) + len(data) > MAX_DATAGRAM:
+                    sock.sendto(datagram, self.address)
+                    datagram = b""
+                datagram += data
+            sock.sendto(datagram, self.address)
+
+
+SINK_TYPES = {"file": FileSink, "influx": InfluxSink}
+
+
+def create_sinks(configs, data_dir="."):
+    """Create sinks from the sinks setting.
+
+    Args:
+        configs (list): One dict per sink with "type" ("file" or "influx"),
+            an optional "name" and the options of that sink type.
+        data_dir (str): Directory of relative file sink paths.
+
+    Returns:
+        list: The sinks, not yet started.
+    """
+    sinks = []
+    for config in configs:
+        options = dict(config)
+        sink_type = options.pop("type", None)
+        if sink_type not in SINK_TYPES:
+            raise ValueError(f"Unknown sink type {sink_type}, available: {sorted(SINK_TYPES)}")
+        name = options.pop("name", sink_type)
+        if sink_type == "file":
+            options["path"] = os.path.join(data_dir, options["path"])
+        sinks.append(SINK_TYPES[sink_type](name, **options))
+    return sinks
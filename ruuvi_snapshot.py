@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_snapshot
+
+Latest values of all tags, published as one retained message so a
+consumer gets the complete current state on subscribe.
+"""
+
+import json
+import time
+
+SNAPSHOT_TOPIC = "home/_snapshot/{gateway}"
+DEFAULT_FIELDS = ("temperature", "humidity", "pressure", "battery", "movement_counter", "rssi")
+DEFAULT_INTERVAL = 300  # seconds, republished at least this often
+DEFAULT_DEBOUNCE = 10  # seconds, published at most this often
+# Changes of these fields alone do not trigger a publish before the interval
+NOISY_FIELDS = frozenset(("rssi",))
+
+
+class SnapshotTable:  # pylint: disable=too-many-instance-attributes
+    """Latest-value table of all tags.
+
+    The snapshot is due when a tag was added, removed or changed a value
+    and debounce seconds have passed since the previous one, or after
+    interval seconds regardless.
+    """
+
+    def __init__(self, gateway, fields=DEFAULT_FIELDS, interval=DEFAULT_INTERVAL,
+                 debounce=DEFAULT_DEBOUNCE, clock=time.monotonic):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.topic = SNAPSHOT_TOPIC.format(gateway=gateway)
+        self.gateway = gateway
+        self.fields = tuple(fields)
+        self.interval = interval
+        self.debounce = debounce
+        self.clock = clock
+        self.entries = {}  # room -> compact entry
+        self.changed = False
+        self.published = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, room, mac, jdata, timestamp):
+        """Record the latest reading of a tag.
+
+        Args:
+            room (str): The room identifier.
+            mac (str): MAC address of the tag.
+            jdata (dict): Sensor data of the reading.
+            timestamp (float): Unix time of the reading.
+
+        Returns:
+            None
+        """
+        entry = {"mac": mac, "ts": int(timestamp)}
+        for field in self.fields:
+            value = jdata.get(field)
+            if value is not None:
+                entry[field] = value
+        previous = self.entries.get(room)
+        if previous is None or any(
+                previous.get(field) != entry.get(field)
+                for field in self.fields if field not in NOISY_FIELDS):
+            self.changed = True
+        self.entries[room] = entry
+
+    def remove(self, room):
+        """Drop a tag from the table."""
+        if self.entries.pop(room, None) is not None:
+            self.changed = True
+
+    def due(self, now=None):
+        """Check if the snapshot should be published now."""
+        if now is None:
+            now = self.clock()
+        if self.published is None:
+            return bool(self.entries)
+        elapsed = now - self.published
+        return elapsed >= self.interval or (self.changed and elapsed >= self.debounce)
+
+    def payload(self, now=None):
+        """Serialize the snapshot and mark it published.
+
+        Args:
+            now (float): Current clock value, read from the clock if None.
+
+        Returns:
+            str: Compact JSON with the gateway, time and one entry per room.
+        """
+        self.published = self.clock() if now is None else now
+        self.changed = False
+        return json.dumps({"gateway": self.gateway, "ts": int(time.time()),
+                           "tags": self.entries}, separators=(",", ":"))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_tags
+
+Per-tag bookkeeping for ruuvi2mqtt.
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import json
+import os
+import time
+
+
+class StalenessTracker:
+    """Track which tags have timed out using a heap of deadlines.
+
+    Seeing a tag only updates its last seen time. Each online tag has one
+    scheduled deadline in the heap, which is moved forward lazily when it
+    comes due, so expire() costs O(due entries) instead of a scan over all
+    tags on every call.
+    """
+
+    def __init__(self, timeout, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.last_seen = {}
+        self.scheduled = {}
+        self.heap = []
+        # Targets that need all online tags again, e.g. reconnected brokers;
+        # added from other threads, taken with resends()
+        self.resend = set()
+
+    def __contains__(self, key):
+        return key in self.last_seen
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def touch(self, key, now=None):
+        """Mark a tag as seen.
+
+        Args:
+            key: Tag identifier.
+            now (float): Current clock value, read from the clock if None.
+
+        Returns:
+            bool: True if the tag was not online before.
+        """
+        if now is None:
+            now = self.clock()
+        came_online = key not in self.last_seen
+        self.last_seen[key] = now
+        if came_online:
+            self._schedule(key, now + self.timeout)
+        return came_online
+
+    def online(self):
+        """Return the keys of the tags currently online."""
+        return list(self.last_seen)
+
+    def request_resend(self, *targets):
+        """Queue targets that need the online tags again, see resends()."""
+        self.resend.update(targets)
+
+    def resends(self):
+        """Return and clear the targets of request_resend()."""
+        targets = []
+        while self.resend:
+            targets.append(self.resend.pop())
+        return targets
+
+    def remove(self, key):
+        """Stop tracking a tag without reporting it as expired."""
+        self.last_seen.pop(key, None)
+        self.scheduled.pop(key, None)
+
+    def expire(self, now=None):
+        """Remove and return the tags not seen within the timeout.
+
+        Args:
+            now (float): Current clock value, read from the clock if None.
+
+        Returns:
+            list: Keys of the tags that went offline.
+        """
+        if now is None:
+            now = self.clock()
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self.scheduled.get(key) != deadline:
+                continue  # Removed, or rescheduled after coming back online
+            deadline = self.last_seen[key] + self.timeout
+            if deadline <= now:
+                del self.last_seen[key]
+                del self.scheduled[key]
+                expired.append(key)
+            else:
+                self._schedule(key, deadline)
+        return expired
+
+    def _schedule(self, key, deadline):
+        self.scheduled[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+
+SEQUENCE_MODULO = 65536  # measurement_sequence_number is 16 bits
+MAX_GAP = 1000  # Larger jumps are taken as a tag restart, not as loss
+GAP_BUCKETS = (1, 2, 4, 8, 16)  # Upper bounds; the last bucket is open
+GAP_LABELS = ("1", "2", "3-4", "5-8", "9-16", "17+")
+
+
+class Interval:  # pylint: disable=too-few-public-methods
+    """Tell when a periodic task, e.g. a report, is due.
+
+    Args:
+        seconds (float): Seconds between runs; 0 disables the task.
+        first (bool): Run on the first check instead of one interval later.
+    """
+
+    def __init__(self, seconds, first=False):
+        self.seconds = seconds
+        self.first = first
+        self.last = None
+
+    def due(self, now):
+        """Check if the task is due, and if so count it as run.
+
+        Args:
+            now (datetime.datetime): Current time.
+
+        Returns:
+            bool: True if the task should run now.
+        """
+        if not self.seconds:
+            return False
+        if self.last is None:
+            self.last = now
+            return self.first
+        if (now - self.last).total_seconds() < self.seconds:
+            return False
+        self.last = now
+        return True
+
+
+class LinkStats:
+    """Packet loss and RSSI statistics of one tag.
+
+    Loss is counted from gaps in measurement_sequence_number since the
+    last snapshot. RSSI is kept in a ring of the latest window packets.
+    """
+
+    __slots__ = ("last_seq", "received", "expected", "duplicates", "gaps",
+                 "rssi", "rssi_count")
+
+    def __init__(self, window=256):
+        self.last_seq = None
+        self.received = 0
+        self.expected = 0
+        self.duplicates = 0
+        self.gaps = array.array('L', [0] * len(GAP_LABELS))
+        self.rssi = array.array('b', bytes(window))
+        self.rssi_count = 0
+
+    def add(self, seq, rssi=None):
+        """Record a received packet.
+
+        Args:
+            seq (int): measurement_sequence_number of the packet.
+            rssi (int): Signal strength of the packet.
+
+        Returns:
+            None
+        """
+        if self.last_seq is None:
+            gap = 1
+        else:
+            gap = (seq - self.last_seq) % SEQUENCE_MODULO
+            if gap == 0:
+                self.duplicates += 1
+                return
+            if gap > MAX_GAP:
+                gap = 1
+            self.gaps[bisect.bisect_left(GAP_BUCKETS, gap)] += 1
+        self.last_seq = seq
+        self.received += 1
+        self.expected += gap
+        if rssi is not None:
+            self.rssi[self.rssi_count % len(self.rssi)] = max(-128, min(127, rssi))
+            self.rssi_count += 1
+
+    def snapshot(self, reset=True):
+        """Return the statistics as a dict.
+
+        Args:
+            reset (bool): Start counting packets again, keeping the RSSI ring.
+
+        Returns:
+            dict: Received, expected and duplicate packets, loss in percent,
+            gap histogram and RSSI mean and percentiles. The loss is left
+            out until two packets of the tag were compared.
+        """
+        stats = {
+            "link_received": self.received,
+            "link_expected": self.expected,
+            "link_duplicates": self.duplicates,
+            "link_gaps": dict(zip(GAP_LABELS, self.gaps)),
+        }
+        if any(self.gaps):
+            stats["link_loss"] = round(100 * (1 - self.received / self.expected), 1)
+        samples = sorted(self.rssi[:min(self.rssi_count, len(self.rssi))])
+        if samples:
+            stats["link_rssi_mean"] = round(sum(samples) / len(samples), 1)
+            for percentile in (10, 50, 90):
+                index = round(percentile / 100 * (len(samples) - 1))
+                stats[f"link_rssi_p{percentile}"] = samples[index]
+        if reset:
+            self.received = 0
+            self.expected = 0
+            self.duplicates = 0
+            self.gaps = array.array('L', [0] * len(GAP_LABELS))
+        return stats
+
+
+class TagRecord:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """Bookkeeping of one tag."""
+
+    __slots__ = ("mac", "room", "configured", "first_seen", "last_seen",
+                 "best_rssi", "packets", "link")
+
+    def __init__(self, mac, room, configured, now):
+        self.mac = mac
+        self.room = room
+        self.configured = configured
+        self.first_seen = now
+        self.last_seen = now
+        self.best_rssi = None
+        self.packets = 0
+        self.link = None
+
+
+class TagRegistry:
+    """Registry of seen tags with bounded room for unconfigured ones.
+
+    Configured tags are kept for good. Unconfigured (transient) tags are
+    kept in least recently seen order and evicted when there are more than
+    capacity of them or they have not been seen for ttl seconds. Tags that
+    send sequence numbers get LinkStats with an RSSI ring of link_window
+    packets, unless it is 0.
+    """
+
+    def __init__(self, capacity=256, ttl=3600, clock=time.monotonic, link_window=256):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.link_window = link_window
+        self.configured = {}
+        self.transient = collections.OrderedDict()
+        self.unknown_changed = False
+
+    def __len__(self):
+        return len(self.configured) + len(self.transient)
+
+    def get(self, mac):
+        """Return the record of a tag or None."""
+        record = self.configured.get(mac)
+        if record is None:
+            record = self.transient.get(mac)
+        return record
+
+    def records(self):
+        """Return the records of all tags, configured ones first."""
+        return list(self.configured.values()) + list(self.transient.values())
+
+    def touch(self, mac, room, configured, rssi=None, now=None, seq=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """Record a reading of a tag.
+
+        Args:
+            mac (str): MAC address of the tag.
+            room (str): The room identifier.
+            configured (bool): True if the tag is in my_ruuvis.
+            rssi (int): Signal strength of the reading.
+            now (float): Current clock value, read from the clock if None.
+            seq (int): measurement_sequence_number of the reading.
+
+        Returns:
+            TagRecord: The record of the tag.
+        """
+        if now is None:
+            now = self.clock()
+        records = self.configured if configured else self.transient
+        record = records.get(mac)
+        if record is None:
+            # A tag may have been added to or removed from my_ruuvis
+            other = self.transient if configured else self.configured
+            record = other.pop(mac, None)
+            if record is None:
+                record = TagRecord(mac, room, configured, now)
+            record.configured = configured
+            records[mac] = record
+        elif not configured:
+            self.transient.move_to_end(mac)
+        record.room = room  # A configured tag may have moved to another room
+        record.last_seen = now
+        record.packets += 1
+        if rssi is not None and (record.best_rssi is None or rssi > record.best_rssi):
+            record.best_rssi = rssi
+        if seq is not None and self.link_window:
+            if record.link is None:
+                record.link = LinkStats(self.link_window)
+            record.link.add(seq, rssi)
+        if not configured:
+            self.unknown_changed = True
+        return record
+
+    def link_reports(self):
+        """Return the link statistics of all tags, counting packets anew.
+
+        Returns:
+            list: (room, LinkStats.snapshot()) of the tags that sent
+            sequence numbers.
+        """
+        return [(record.room, record.link.snapshot()) for record in self.records()
+                if record.link is not None]
+
+    def evict(self, now=None):
+        """Remove and return transient tags over capacity or past their ttl.
+
+        Args:
+            now (float): Current clock value, read from the clock if None.
+
+        Returns:
+            list: Evicted TagRecord objects.
+        """
+        if now is None:
+            now = self.clock()
+        evicted = []
+        transient = self.transient
+        while transient:
+            oldest = next(iter(transient.values()))
+            if len(transient) <= self.capacity and now - oldest.last_seen < self.ttl:
+                break
+            transient.popitem(last=False)
+            evicted.append(oldest)
+        if evicted:
+            self.unknown_changed = True
+        return evicted
+
+    def unknown_tags(self):
+        """Return the unconfigured tags with wall clock times.
+
+        Returns:
+            list: One dict per tag, most recently seen last.
+        """
+        offset = time.time() - self.clock()
+        return [
+            {
+                "mac": record.mac,
+                "room": record.room,
+                "first_seen": round(record.first_seen + offset, 1),
+                "last_seen": round(record.last_seen + offset, 1),
+                "best_rssi": record.best_rssi,
+                "packets": record.packets,
+            }
+            for record in self.transient.values()
+        ]
+
+    def save_unknown(self, path):
+        """Write the unconfigured tags atomically as JSON if they changed.
+
+        Args:
+            path (str): Target file, replaced in one step.
+
+        Returns:
+            bool: True if the file was written.
+        """
+        if not self.unknown_changed:
+            return False
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file_handle:
+            json.dump(self.unknown_tags(), file_handle, indent=2)
+        os.replace(tmp_path, path)
+        self.unknown_changed = False
+        return True
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ruuvi_unbatch
+
+Consumer for the batched uplink: subscribes to home/_batch/+ on a broker,
+unpacks each batch and republishes the messages to their own topics, so
+consumers of home/<room> do not need to know about batching.
+
+Usage: python3 ruuvi_unbatch.py [-H host] [-p port]
+"""
+
+import argparse
+import logging
+import socket
+
+from paho.mqtt.client import Client, CallbackAPIVersion
+
+import ruuvi_outbound
+
+BATCH_SUBSCRIPTION = ruuvi_outbound.BATCH_TOPIC.format(gateway="+")
+
+
+def republish(client, payload):
+    """Unpack one batch and publish its messages.
+
+    Args:
+        client (mqtt.Client): Client to publish with.
+        payload (bytes): The compressed batch.
+
+    Returns:
+        int: Number of republished messages.
+    """
+    try:
+        gateway, messages = ruuvi_outbound.unpack_batch(payload)
+    except ValueError as exc:
+        logging.warning("Could not unpack batch: %s", exc)
+        return 0
+    for topic, message in messages:
+        client.publish(topic, message)
+    logging.info("Republished %d messages from %s", len(messages), gateway)
+    return len(messages)
+
+
+def on_connect(client, userdata, flags, reason_code, properties):
+    # pylint: disable=unused-argument,too-many-arguments,too-many-positional-arguments
+    """Subscribe to the batch topics after connecting."""
+    logging.info("Connected with result code %s", reason_code)
+    client.subscribe(BATCH_SUBSCRIPTION)
+
+
+def on_message(client, userdata, msg):  # pylint: disable=unused-argument
+    """Republish a received batch."""
+    republish(client, msg.payload)
+
+
+def main():
+    """Run the consumer until interrupted."""
+    parser = argparse.ArgumentParser(description="Unpack batches sent by ruuvi2mqtt")
+    parser.add_argument("-H", "--host", default="localhost", help="MQTT broker host")
+    parser.add_argument("-p", "--port", type=int, default=1883, help="MQTT broker port")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    client = Client(CallbackAPIVersion.VERSION2, f"{socket.gethostname()}-ruuviunbatch")
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.host, args.port, 60)
+    client.loop_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+my_brokers = {
+  "local": { "host": "192.168.7.186", "port": 1883 },
+  "remote": { "host": "192.168.7.129", "port": 1883 }
+}
+
+my_ruuvis = {
+  "DD:17:F3:D7:86:CE": "pool",
+  "EA:D5:76:69:70:99": "broken-tag",
+  "EC:67:46:36:EA:60": "sauna",
+  "FE:87:0F:93:69:AA": "biergarten",
+  "E8:28:93:CE:5A:E8": "greenhouse",
+  "D5:43:48:93:FE:F0": "fridge",
+  "C5:7D:4C:65:9D:60": "car-interior",
+  "E2:9D:53:95:0E:8B": "living-room",
+  "D1:48:D2:7D:3D:02": "freezer",
+  "E8:0D:4B:5D:BD:D8": "balcony"
+}
+
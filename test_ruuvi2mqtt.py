@@ -1,14 +1,39 @@
+import asyncio
 import json
+import multiprocessing
+import os
+import tempfile
+import time
 import unittest
 import datetime
-from unittest.mock import patch, MagicMock, Mock, mock_open
+from unittest.mock import patch, MagicMock, Mock
 import ruuvi2mqtt
+import ruuvi_config
+import ruuvi_derived
+import ruuvi_discovery
+import ruuvi_fleet
+import ruuvi_health
+import ruuvi_latency
+import ruuvi_loadgen
+import ruuvi_logging
+import ruuvi_outbound
+import ruuvi_shm
+import ruuvi_snapshot
+import ruuvi_tags
 
 # filepath: /home/rpi/work/ruuvi2mqtt/test_ruuvi2mqtt.py
 
+TEST_CONFIG = ruuvi_config.Config({
+    'my_brokers': {'broker1': {'host': 'localhost', 'port': 1883}},
+    'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'living_room'},
+})
+
 
 class TestPublishDiscoveryConfig(unittest.TestCase):
 
+    def setUp(self):
+        ruuvi2mqtt.DISCOVERY_INDEX = ruuvi_discovery.DiscoveryIndex()
+
     @patch('ruuvi2mqtt.CLIENTS')
     @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
     @patch('ruuvi2mqtt.MYHOSTNAME', 'testhost')
@@ -51,9 +76,150 @@ class TestPublishDiscoveryConfig(unittest.TestCase):
                 self.assertTrue(kwargs.get('retain', False),
                                f"Discovery message should have retain=True: {args[0]}")
 
+    @patch('ruuvi2mqtt.CLIENTS')
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.ENRICHER', ruuvi_derived.Enricher(['dew_point']))
+    @patch('ruuvi2mqtt.logging')
+    def test_publish_discovery_config_derived_metrics(self, mock_logging, mock_clients):
+        """Test that enabled derived metrics get discovery entries."""
+        mock_clients['broker1'] = MagicMock()
+        found_data = ('AA:BB:CC:DD:EE:FF', {'mac': 'AA:BB:CC:DD:EE:FF'})
+
+        ruuvi2mqtt.publish_discovery_config('living_room', found_data)
+
+        topics = [call[0][0] for call in mock_clients['broker1'].publish.call_args_list]
+        self.assertIn('homeassistant/sensor/living_room_dew_point/config', topics)
+
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+class TestDiscoveryGoldenFiles(unittest.TestCase):
+    """Compare generated discovery payloads with files in testdata/.
+
+    Run with UPDATE_GOLDEN=1 to rewrite the files after an intended change.
+    """
+
+    def assert_golden(self, name, configs):
+        path = os.path.join(GOLDEN_DIR, name)
+        generated = [{'topic': topic, 'payload': payload} for topic, payload in configs]
+        if os.environ.get('UPDATE_GOLDEN'):
+            with open(path, 'w', encoding='utf-8') as file_handle:
+                json.dump(generated, file_handle, indent=2, ensure_ascii=False)
+                file_handle.write('\n')
+        with open(path, encoding='utf-8') as file_handle:
+            self.assertEqual(generated, json.load(file_handle))
+
+    def test_sensor_discovery_golden(self):
+        """Test the per-sensor discovery payloads."""
+        self.assert_golden(
+            'discovery_sensor.json',
+            ruuvi_discovery.sensor_configs('living_room', 'AA:BB:CC:DD:EE:FF',
+                                           ruuvi_discovery.sensors('testhost', link=True),
+                                           'home/living_room/availability'))
+
+    def test_device_discovery_golden(self):
+        """Test the single-message device discovery payload."""
+        self.assert_golden(
+            'discovery_device.json',
+            ruuvi_discovery.device_configs('living_room', 'AA:BB:CC:DD:EE:FF',
+                                           ruuvi_discovery.sensors('testhost', link=True),
+                                           'home/living_room/availability',
+                                           '2026.1.13-5-g1a2b3c'))
+
+    @patch('ruuvi2mqtt.LINK_STATS_INTERVAL', 300)
+    @patch('ruuvi2mqtt.DISCOVERY_MODE', 'sensor')
+    def test_link_sensors_need_sequence_number(self):
+        """Test that link sensors are announced only for tags with a sequence number."""
+        mac = 'AA:BB:CC:DD:EE:FF'
+        without = [topic for topic, _ in ruuvi2mqtt.discovery_configs('sauna', mac)]
+        with_seq = [topic for topic, _ in ruuvi2mqtt.discovery_configs('sauna', mac, True)]
+        self.assertNotIn('homeassistant/sensor/sauna_link_loss/config', without)
+        self.assertIn('homeassistant/sensor/sauna_link_loss/config', with_seq)
+
+    @patch('ruuvi2mqtt.CLIENTS')
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.DISCOVERY_MODE', 'device')
+    @patch('ruuvi2mqtt.logging')
+    def test_device_mode_publishes_one_message(self, mock_logging, mock_clients):
+        """Test that device mode publishes one retained message per room."""
+        mock_clients['broker1'] = MagicMock()
+        found_data = ('AA:BB:CC:DD:EE:FF', {'mac': 'AA:BB:CC:DD:EE:FF'})
+
+        ruuvi2mqtt.publish_discovery_config('living_room', found_data)
+
+        mock_clients['broker1'].publish.assert_called_once()
+        args, kwargs = mock_clients['broker1'].publish.call_args
+        self.assertEqual(args[0], 'homeassistant/device/living_room/config')
+        self.assertTrue(kwargs.get('retain', False))
+
+
+class TestDiffDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        ruuvi2mqtt.DISCOVERY_INDEX = ruuvi_discovery.DiscoveryIndex()
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
+    @patch('ruuvi2mqtt.logging')
+    def test_unchanged_configs_are_skipped(self, mock_logging):
+        """Test that configs already on a broker are not published again."""
+        ruuvi2mqtt.CLIENTS = {'broker1': MagicMock(), 'broker2': MagicMock()}
+        found_data = ('AA:BB:CC:DD:EE:FF', {'mac': 'AA:BB:CC:DD:EE:FF'})
+
+        ruuvi2mqtt.publish_discovery_config('living_room', found_data)
+        sent = ruuvi2mqtt.CLIENTS['broker1'].publish.call_count
+        self.assertGreater(sent, 0)
+
+        # broker2 lost one retained config
+        topic = 'homeassistant/sensor/living_room_temperature/config'
+        ruuvi2mqtt.DISCOVERY_INDEX.observe('broker2', topic, b'')
+        for client in ruuvi2mqtt.CLIENTS.values():
+            client.publish.reset_mock()
+
+        ruuvi2mqtt.publish_discovery_config('living_room', found_data)
+
+        ruuvi2mqtt.CLIENTS['broker1'].publish.assert_not_called()
+        ruuvi2mqtt.CLIENTS['broker2'].publish.assert_called_once()
+        self.assertEqual(ruuvi2mqtt.CLIENTS['broker2'].publish.call_args[0][0], topic)
+
+    @patch('ruuvi2mqtt.CONFIG', TEST_CONFIG)
+    @patch('ruuvi2mqtt.force_rediscovery')
+    @patch('ruuvi2mqtt.logging')
+    def test_on_message_records_own_retained_configs(self, mock_logging,
+                                                     mock_force_rediscovery):
+        """Test that replayed retained configs of our tags are indexed."""
+        own = 'homeassistant/sensor/living_room_temperature/config'
+        other = 'homeassistant/sensor/shelly_power/config'
+        for topic in (own, other):
+            mock_msg = MagicMock()
+            mock_msg.topic = topic
+            mock_msg.payload = b'{"name": "x"}'
+            ruuvi2mqtt.on_message(MagicMock(), 'broker1', mock_msg)
+
+        digests = ruuvi2mqtt.DISCOVERY_INDEX.digests['broker1']
+        self.assertEqual(list(digests), [own])
+        mock_force_rediscovery.assert_not_called()
+        mock_logging.info.assert_not_called()
+
+    @patch('ruuvi2mqtt.CONFIG', TEST_CONFIG)
+    def test_is_own_discovery_topic(self):
+        """Test recognizing discovery topics of our tags."""
+        self.assertTrue(ruuvi2mqtt.is_own_discovery_topic(
+            'homeassistant/sensor/living_room_humidity/config'))
+        self.assertTrue(ruuvi2mqtt.is_own_discovery_topic(
+            'homeassistant/sensor/Ruuvi-AABBCCDDEEFF_humidity/config'))
+        self.assertTrue(ruuvi2mqtt.is_own_discovery_topic(
+            'homeassistant/device/living_room/config'))
+        self.assertFalse(ruuvi2mqtt.is_own_discovery_topic(
+            'homeassistant/sensor/kitchen_humidity/config'))
+
 
 class TestHomeAssistantRestart(unittest.TestCase):
 
+    def tearDown(self):
+        # on_connect starts a discovery sync that must not leak into other tests
+        ruuvi2mqtt.DISCOVERY_INDEX = ruuvi_discovery.DiscoveryIndex()
+
     @patch('ruuvi2mqtt.force_rediscovery')
     @patch('ruuvi2mqtt.logging')
     def test_on_message_homeassistant_restart(self, mock_logging, mock_force_rediscovery):
@@ -93,6 +259,21 @@ class TestHomeAssistantRestart(unittest.TestCase):
         # Verify force_rediscovery was NOT called
         mock_force_rediscovery.assert_not_called()
 
+    @patch('ruuvi2mqtt.force_rediscovery')
+    @patch('ruuvi2mqtt.PROFILER')
+    @patch('ruuvi2mqtt.logging')
+    def test_on_message_profile_command(self, mock_logging, mock_profiler,
+                                        mock_force_rediscovery):
+        """Test that messages on the profile topic are passed to the profiler."""
+        mock_msg = MagicMock()
+        mock_msg.topic = ruuvi2mqtt.PROFILE_TOPIC
+        mock_msg.payload.decode.return_value = "cpu 10"
+
+        ruuvi2mqtt.on_message(MagicMock(), None, mock_msg)
+
+        mock_profiler.request.assert_called_once_with("cpu 10")
+        mock_force_rediscovery.assert_not_called()
+
     @patch('ruuvi2mqtt.logging')
     def test_on_connect_clears_found_ruuvis(self, mock_logging):
         """Test that FOUND_RUUVIS is cleared when connecting to broker."""
@@ -113,7 +294,8 @@ class TestHomeAssistantRestart(unittest.TestCase):
                         "FOUND_RUUVIS should be cleared on broker connect")
 
         # Verify subscription
-        mock_client.subscribe.assert_called_once_with("homeassistant/status")
+        mock_client.subscribe.assert_any_call("homeassistant/status")
+        mock_client.subscribe.assert_any_call(ruuvi2mqtt.PROFILE_TOPIC)
 
         # Verify logging
         mock_logging.info.assert_any_call("MQTT Connection successful")
@@ -287,13 +469,13 @@ class TestHandleDataPeriodicResend(unittest.TestCase):
     @patch('ruuvi2mqtt.my_brokers', ['broker1'])
     @patch('ruuvi2mqtt.my_ruuvis', {'AA:BB:CC:DD:EE:FF': 'living_room'})
     @patch('ruuvi2mqtt.logging')
-    def test_handle_data_tracks_last_data_time(self, mock_logging, mock_clients,
-                                                mock_publish_discovery, mock_force_rediscovery):
-        """Test that handle_data tracks last data time for each sensor."""
+    def test_handle_data_tracks_last_seen(self, mock_logging, mock_clients,
+                                          mock_publish_discovery, mock_force_rediscovery):
+        """Test that handle_data records when each sensor was last seen."""
         ruuvi_module = ruuvi2mqtt
 
         # Set up initial state
-        ruuvi_module.LAST_DATA_TIME = {}
+        ruuvi_module.TAGS = ruuvi_tags.TagRegistry()
         ruuvi_module.LAST_DISCOVERY_RESEND = datetime.datetime.now(tz=datetime.timezone.utc)
         ruuvi_module.FOUND_RUUVIS = ['living_room']
         mock_clients['broker1'] = MagicMock()
@@ -306,25 +488,35 @@ class TestHandleDataPeriodicResend(unittest.TestCase):
         })
 
         # Call handle_data
-        before = datetime.datetime.now(tz=datetime.timezone.utc)
+        before = time.monotonic()
         ruuvi2mqtt.handle_data(found_data)
-        after = datetime.datetime.now(tz=datetime.timezone.utc)
+        after = time.monotonic()
 
-        # Verify last_data_time was set for this MAC
-        self.assertIn(mac, ruuvi_module.LAST_DATA_TIME)
-        self.assertGreaterEqual(ruuvi_module.LAST_DATA_TIME[mac], before)
-        self.assertLessEqual(ruuvi_module.LAST_DATA_TIME[mac], after)
+        # Verify last_seen was set for this MAC
+        record = ruuvi_module.TAGS.get(mac)
+        self.assertIsNotNone(record)
+        self.assertGreaterEqual(record.last_seen, before)
+        self.assertLessEqual(record.last_seen, after)
+        ruuvi_module.TAGS = ruuvi_tags.TagRegistry()
 
 
 class TestHandleDataUnknownSensor(unittest.TestCase):
 
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        ruuvi2mqtt.TAGS = ruuvi_tags.TagRegistry()
+        ruuvi2mqtt.UNKNOWN_TAGS_TIMER.last = None
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        ruuvi2mqtt.TAGS = ruuvi_tags.TagRegistry()
+
     @patch('ruuvi2mqtt.publish_discovery_config')
     @patch('ruuvi2mqtt.CLIENTS')
     @patch('ruuvi2mqtt.my_brokers', ['broker1'])
     @patch('ruuvi2mqtt.my_ruuvis', {})  # Empty - sensor not configured
     @patch('ruuvi2mqtt.logging')
-    @patch('builtins.open', new_callable=mock_open)
-    def test_handle_unknown_sensor_creates_topic(self, mock_file, mock_logging, mock_clients, mock_publish_discovery):
+    def test_handle_unknown_sensor_creates_topic(self, mock_logging, mock_clients, mock_publish_discovery):
         """Test that unknown sensors get auto-generated topic names."""
         ruuvi_module = ruuvi2mqtt
 
@@ -341,7 +533,8 @@ class TestHandleDataUnknownSensor(unittest.TestCase):
         })
 
         # Call handle_data
-        ruuvi2mqtt.handle_data(found_data)
+        with patch('ruuvi2mqtt.DATA_DIR', self.tmpdir.name):
+            ruuvi2mqtt.handle_data(found_data)
 
         # Verify auto-generated room name
         expected_room = 'Ruuvi-AABBCCDDEEFF'
@@ -354,8 +547,36 @@ class TestHandleDataUnknownSensor(unittest.TestCase):
         # Verify warning was logged
         mock_logging.warning.assert_called_with("Not found %s. Using topic home/%s", mac, expected_room)
 
-        # Verify data was written to detected_ruuvis.txt
-        mock_file.assert_called_with("detected_ruuvis.txt", "a", encoding="utf-8")
+        # Verify the tag was written to detected_ruuvis.json
+        path = os.path.join(self.tmpdir.name, 'detected_ruuvis.json')
+        with open(path, encoding='utf-8') as file_handle:
+            detected = json.load(file_handle)
+        self.assertEqual(len(detected), 1)
+        self.assertEqual(detected[0]['mac'], mac)
+        self.assertEqual(detected[0]['room'], expected_room)
+        self.assertEqual(detected[0]['best_rssi'], -70)
+        self.assertEqual(detected[0]['packets'], 1)
+
+    @patch('ruuvi2mqtt.publish_discovery_config')
+    @patch('ruuvi2mqtt.CLIENTS')
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.my_ruuvis', {})
+    @patch('ruuvi2mqtt.logging')
+    def test_unknown_sensor_statistics(self, mock_logging, mock_clients, mock_publish_discovery):
+        """Test that repeated sightings update one index entry."""
+        ruuvi2mqtt.LAST_DISCOVERY_RESEND = datetime.datetime.now(tz=datetime.timezone.utc)
+        mock_clients['broker1'] = MagicMock()
+        mac = 'AA:BB:CC:DD:EE:FF'
+
+        with patch('ruuvi2mqtt.DATA_DIR', self.tmpdir.name):
+            for rssi in (-80, -60, -75):
+                ruuvi2mqtt.handle_data((mac, {'mac': mac, 'rssi': rssi}))
+
+        record = ruuvi2mqtt.TAGS.get(mac)
+        self.assertEqual(record.packets, 3)
+        self.assertEqual(record.best_rssi, -60)
+        # Saved once, further changes wait for the save interval
+        self.assertTrue(ruuvi2mqtt.TAGS.unknown_changed)
 
 
 class TestSendSingle(unittest.TestCase):
@@ -380,7 +601,75 @@ class TestSendSingle(unittest.TestCase):
         mock_client.publish.assert_called_once_with('living_room/temperature', 22.5)
 
         # Verify logging
-        mock_logging.info.assert_called_with("%s: %s", 'living_room/temperature', 22.5)
+        mock_logging.debug.assert_called_with("%s: %s", 'living_room/temperature', 22.5)
+
+
+class TestSendSingleValues(unittest.TestCase):
+
+    @patch('ruuvi2mqtt.SINGLE_VALUES', ruuvi_outbound.SingleValues(('temperature', 'humidity')))
+    @patch('ruuvi2mqtt.logging')
+    def test_send_single_values_projects_fields(self, mock_logging):
+        """Test that only the configured fields are published."""
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+        jdata = {
+            'room': 'living_room',
+            'temperature': 22.5,
+            'humidity': 45,
+            'ts': 1700000000.0,
+            'mac': 'AA:BB:CC:DD:EE:FF'
+        }
+
+        sent = ruuvi2mqtt.send_single_values(jdata, 'broker1')
+
+        self.assertEqual(sent, ['temperature', 'humidity'])
+        mock_client.publish.assert_any_call('living_room/temperature', 22.5)
+        mock_client.publish.assert_any_call('living_room/humidity', 45)
+        self.assertEqual(mock_client.publish.call_count, 2)
+
+        # One log line for the whole batch
+        mock_logging.info.assert_called_once_with(
+            "%s: sent %d single values to %s: %s",
+            'living_room', 2, 'broker1', 'temperature, humidity')
+
+    @patch('ruuvi2mqtt.SINGLE_VALUES', ruuvi_outbound.SingleValues(('temperature', 'humidity')))
+    @patch('ruuvi2mqtt.logging')
+    def test_send_single_values_skips_unchanged(self, mock_logging):
+        """Test that unchanged values are not republished."""
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+        jdata = {'room': 'living_room', 'temperature': 22.5, 'humidity': 45}
+
+        ruuvi2mqtt.send_single_values(jdata, 'broker1')
+        mock_client.publish.reset_mock()
+        mock_logging.info.reset_mock()
+
+        jdata = {'room': 'living_room', 'temperature': 22.6, 'humidity': 45}
+        sent = ruuvi2mqtt.send_single_values(jdata, 'broker1')
+
+        self.assertEqual(sent, ['temperature'])
+        mock_client.publish.assert_called_once_with('living_room/temperature', 22.6)
+
+        # Nothing changed: nothing published, nothing logged
+        mock_client.publish.reset_mock()
+        mock_logging.info.reset_mock()
+        self.assertEqual(ruuvi2mqtt.send_single_values(jdata, 'broker1'), [])
+        mock_client.publish.assert_not_called()
+        mock_logging.info.assert_not_called()
+
+    @patch('ruuvi2mqtt.SINGLE_VALUES', ruuvi_outbound.SingleValues(('temperature',)))
+    @patch('ruuvi2mqtt.logging')
+    def test_force_rediscovery_resets_single_values(self, mock_logging):
+        """Test that force_rediscovery makes single values publish again."""
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+        jdata = {'room': 'living_room', 'temperature': 22.5}
+
+        ruuvi2mqtt.send_single_values(jdata, 'broker1')
+        ruuvi2mqtt.force_rediscovery()
+        ruuvi2mqtt.send_single_values(jdata, 'broker1')
+
+        self.assertEqual(mock_client.publish.call_count, 2)
 
 
 class TestOnDisconnect(unittest.TestCase):
@@ -449,6 +738,164 @@ class TestConnectBrokers(unittest.TestCase):
         self.assertIn('broker1', result)
         self.assertIn('broker2', result)
 
+    @patch('ruuvi2mqtt.Client')
+    @patch('ruuvi2mqtt.logging')
+    def test_connect_brokers_conflate(self, mock_logging, mock_mqtt_client_class):
+        """Test that brokers with conflate get a conflating publisher."""
+        mock_client_instance = MagicMock()
+        mock_mqtt_client_class.return_value = mock_client_instance
+        ruuvi2mqtt.CLIENTS = {}
+
+        result = ruuvi2mqtt.connect_brokers({
+            'remote': {'host': 'remote.example', 'port': 1883, 'conflate': True}
+        })
+
+        self.assertIsInstance(result['remote'], ruuvi_outbound.ConflatingPublisher)
+        self.assertIs(result['remote'].client, mock_client_instance)
+        self.assertEqual(mock_client_instance.on_publish, ruuvi2mqtt.on_publish)
+
+    @patch('ruuvi2mqtt.Client')
+    @patch('ruuvi2mqtt.logging')
+    def test_connect_brokers_batch(self, mock_logging, mock_mqtt_client_class):
+        """Test that brokers with a batch profile get a batching publisher."""
+        mock_client_instance = MagicMock()
+        mock_mqtt_client_class.return_value = mock_client_instance
+        ruuvi2mqtt.CLIENTS = {}
+
+        result = ruuvi2mqtt.connect_brokers({
+            'remote': {'host': 'remote.example', 'port': 1883, 'conflate': True,
+                       'batch': {'interval': 30, 'max_messages': 500}}
+        })
+
+        publisher = result['remote']
+        self.assertIsInstance(publisher, ruuvi_outbound.BatchingPublisher)
+        self.assertIsInstance(publisher.client, ruuvi_outbound.ConflatingPublisher)
+        self.assertEqual(publisher.interval, 30)
+        self.assertEqual(publisher.max_messages, 500)
+
+
+class TestMainLoadGenerator(unittest.TestCase):
+
+    @patch('ruuvi2mqtt.handle_data')
+    @patch('ruuvi2mqtt.RuuviTagSensor')
+    def test_main_reads_load_generator(self, mock_sensor, mock_handle_data):
+        """Test that main() reads from the load generator when configured."""
+        generator = ruuvi_loadgen.LoadGenerator(tags=3, rate=100, seed=1)
+        generator.readings = lambda: ruuvi_loadgen.LoadGenerator.readings(generator, 0.05)
+
+        with patch('ruuvi2mqtt.LOAD_GENERATOR', generator):
+            asyncio.run(ruuvi2mqtt.main())
+
+        mock_sensor.get_data_async.assert_not_called()
+        self.assertEqual(mock_handle_data.call_count, generator.sent)
+        self.assertGreater(generator.sent, 0)
+
+
+class TestMultiprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = ruuvi_shm.ReadingRing(slots=8)
+        self.addCleanup(self.ring.close, unlink=True)
+
+    @patch('ruuvi2mqtt.handle_data')
+    def test_capture_writes_ring(self, mock_handle_data):
+        """Test that capture() writes to the ring instead of handling the reading."""
+        with patch('ruuvi2mqtt.RING', self.ring):
+            ruuvi2mqtt.capture(('AA:BB:CC:DD:EE:FF', {'temperature': 21.5, 'rssi': -60}), 1.0)
+        mock_handle_data.assert_not_called()
+        self.assertEqual(self.ring.get(), [
+            ('AA:BB:CC:DD:EE:FF', {'temperature': 21.5, 'rssi': -60}, 1.0)
+        ])
+
+    def test_readiness_of_capture_process(self):
+        """Test that the capture process is ready while all publishers run and one is connected."""
+        running, stopped = MagicMock(), MagicMock()
+        running.is_alive.return_value = True
+        stopped.is_alive.return_value = False
+        connected = {'local': multiprocessing.Value('i', 0),
+                     'remote': multiprocessing.Value('i', 1)}
+        with patch.dict(ruuvi2mqtt.PUBLISHERS, {'local': running}), \
+                patch.dict(ruuvi2mqtt.PUBLISHER_CONNECTED, connected):
+            self.assertFalse(ruuvi2mqtt.readiness_status()[0])
+            connected['local'].value = 1
+            self.assertEqual(ruuvi2mqtt.readiness_status(), (True, {'publishers': {
+                'local': {'alive': True, 'brokers_connected': 1}}}))
+            ruuvi2mqtt.PUBLISHERS['remote'] = stopped
+            self.assertFalse(ruuvi2mqtt.readiness_status()[0])
+
+    @patch('ruuvi2mqtt.housekeeping')
+    def test_publisher_tick(self, mock_housekeeping):
+        """Test that a publisher shares its number of connected brokers."""
+        connected = multiprocessing.Value('i', 0)
+        client = MagicMock()
+        client.is_connected.return_value = True
+        with patch('ruuvi2mqtt.CONNECTED', connected), \
+                patch('ruuvi2mqtt.CLIENTS', {'local': client}):
+            ruuvi2mqtt.publisher_tick(False)
+            mock_housekeeping.assert_not_called()
+            ruuvi2mqtt.publisher_tick(True)
+        self.assertEqual(connected.value, 1)
+        mock_housekeeping.assert_called_once_with()
+
+
+class TestHealth(unittest.TestCase):
+
+    def tearDown(self):
+        ruuvi2mqtt.LAST_BLE_RECEIVE = None
+
+    @patch('ruuvi2mqtt.STARTUP', ruuvi_health.StartupTimer())
+    def test_health_status(self):
+        """Test that the scanner is alive until BLE data is older than the timeout."""
+        ruuvi2mqtt.STARTUP.mark('first_reading')
+        self.assertTrue(ruuvi2mqtt.health_status()[0])
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        ruuvi2mqtt.LAST_BLE_RECEIVE = now - datetime.timedelta(seconds=5)
+        self.assertTrue(ruuvi2mqtt.health_status()[0])
+        ruuvi2mqtt.LAST_BLE_RECEIVE = now - datetime.timedelta(
+            seconds=ruuvi2mqtt.WATCHDOG_TIMEOUT + 1)
+        alive, details = ruuvi2mqtt.health_status()
+        self.assertFalse(alive)
+        self.assertEqual(details['status'], 'stale')
+
+    def test_readiness_status(self):
+        """Test that the gateway is ready when any broker is connected."""
+        local, remote = MagicMock(), MagicMock()
+        local.is_connected.return_value = False
+        remote.is_connected.return_value = False
+        ruuvi2mqtt.CLIENTS = {
+            'local': local,
+            'remote': ruuvi_outbound.BatchingPublisher(
+                ruuvi_outbound.ConflatingPublisher(remote), 'testhost'),
+        }
+        self.assertFalse(ruuvi2mqtt.readiness_status()[0])
+        remote.is_connected.return_value = True
+        ready, details = ruuvi2mqtt.readiness_status()
+        self.assertTrue(ready)
+        self.assertEqual(details['brokers'], {'local': False, 'remote': True})
+
+
+class TestOnPublish(unittest.TestCase):
+
+    def tearDown(self):
+        ruuvi2mqtt.TRACER = None
+
+    def test_on_publish_feeds_tracer_and_conflation(self):
+        """Test that acks reach the tracer and the conflating publisher."""
+        client = MagicMock()
+        conflating = ruuvi_outbound.ConflatingPublisher(client)
+        conflating.on_publish = MagicMock()
+        ruuvi2mqtt.CLIENTS = {
+            'remote': ruuvi_outbound.BatchingPublisher(conflating, 'testhost')
+        }
+        ruuvi2mqtt.TRACER = ruuvi_latency.LatencyTracer()
+        ruuvi2mqtt.TRACER.sent('remote', 5, ruuvi2mqtt.TRACER.clock())
+
+        ruuvi2mqtt.on_publish(client, 'remote', 5)
+
+        conflating.on_publish.assert_called_once_with(client, 'remote', 5, None, None)
+        client.publish.assert_not_called()
+        self.assertEqual(ruuvi2mqtt.TRACER.summary()['ack:remote']['count'], 1)
+
 
 class TestHandleDataPublishesToMQTT(unittest.TestCase):
 
@@ -456,6 +903,7 @@ class TestHandleDataPublishesToMQTT(unittest.TestCase):
     @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
     @patch('ruuvi2mqtt.my_ruuvis', {'AA:BB:CC:DD:EE:FF': 'living_room'})
     @patch('ruuvi2mqtt.MYHOSTNAME', 'testhost')
+    @patch('ruuvi2mqtt.SINKS', [MagicMock()])
     @patch('ruuvi2mqtt.logging')
     def test_handle_data_publishes_to_all_brokers(self, mock_logging, mock_publish_discovery):
         """Test that handle_data publishes sensor data to all configured brokers."""
@@ -464,6 +912,8 @@ class TestHandleDataPublishesToMQTT(unittest.TestCase):
         # Set up initial state
         ruuvi_module.FOUND_RUUVIS = ['living_room']
         ruuvi_module.LAST_DISCOVERY_RESEND = datetime.datetime.now(tz=datetime.timezone.utc)
+        ruuvi_module.AVAILABILITY = ruuvi_tags.StalenessTracker(300)
+        ruuvi_module.AVAILABILITY.touch('living_room')
 
         # Create mock clients - must be a real dict
         mock_client1 = MagicMock()
@@ -488,6 +938,7 @@ class TestHandleDataPublishesToMQTT(unittest.TestCase):
         # Verify both clients published data
         mock_client1.publish.assert_called_once()
         mock_client2.publish.assert_called_once()
+        ruuvi_module.SINKS[0].submit.assert_called_once()
 
         # Get the published data
         call_args1 = mock_client1.publish.call_args
@@ -509,5 +960,367 @@ class TestHandleDataPublishesToMQTT(unittest.TestCase):
         self.assertIn('rssi_testhost', data)
 
 
+
+class TestAvailability(unittest.TestCase):
+
+    def setUp(self):
+        ruuvi2mqtt.DISCOVERY_INDEX = ruuvi_discovery.DiscoveryIndex()
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.logging')
+    def test_update_availability_lists_rooms_only_for_resends(self, mock_logging):
+        """Test that the online rooms are not listed per reading without a resend."""
+        ruuvi2mqtt.AVAILABILITY = ruuvi_tags.StalenessTracker(300)
+        ruuvi2mqtt.AVAILABILITY.touch('living_room')
+        with patch.object(ruuvi2mqtt.AVAILABILITY, 'online') as mock_online, \
+                patch('ruuvi2mqtt.CLIENTS', {'broker1': MagicMock()}):
+            ruuvi2mqtt.update_availability('living_room')
+            mock_online.assert_not_called()
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.logging')
+    def test_update_availability_online_and_offline(self, mock_logging):
+        """Test that rooms go online when seen and offline after the timeout."""
+        now = [0.0]
+        ruuvi2mqtt.AVAILABILITY = ruuvi_tags.StalenessTracker(300, clock=lambda: now[0])
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+
+        ruuvi2mqtt.update_availability('living_room')
+        mock_client.publish.assert_called_once_with(
+            'home/living_room/availability', 'online', retain=True)
+
+        # Seen again: no new availability message
+        mock_client.publish.reset_mock()
+        now[0] = 100.0
+        ruuvi2mqtt.update_availability('living_room')
+        mock_client.publish.assert_not_called()
+
+        # Another room keeps reporting, living_room times out
+        now[0] = 450.0
+        ruuvi2mqtt.update_availability('sauna')
+        mock_client.publish.assert_any_call('home/sauna/availability', 'online', retain=True)
+        mock_client.publish.assert_any_call(
+            'home/living_room/availability', 'offline', retain=True)
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
+    @patch('ruuvi2mqtt.logging')
+    def test_resend_after_reconnect(self, mock_logging):
+        """Test that a reconnected broker gets the availability of all online rooms."""
+        ruuvi2mqtt.AVAILABILITY = ruuvi_tags.StalenessTracker(300, clock=lambda: 0.0)
+        ruuvi2mqtt.AVAILABILITY.touch('living_room')
+        clients = {'broker1': MagicMock(), 'broker2': MagicMock()}
+        mock_client = MagicMock()
+        mock_client.subscribe = MagicMock(return_value=(0, 1))
+
+        with patch('ruuvi2mqtt.CLIENTS', clients):
+            ruuvi2mqtt.on_connect(mock_client, 'broker2', None, 0, None)
+            ruuvi2mqtt.housekeeping()
+        clients['broker1'].publish.assert_not_called()
+        clients['broker2'].publish.assert_called_once_with(
+            'home/living_room/availability', 'online', retain=True)
+
+        clients['broker2'].publish.reset_mock()
+        with patch('ruuvi2mqtt.CLIENTS', clients):
+            ruuvi2mqtt.force_rediscovery()
+            ruuvi2mqtt.update_availability('living_room')
+        for client in clients.values():
+            client.publish.assert_called_once_with(
+                'home/living_room/availability', 'online', retain=True)
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.logging')
+    def test_expiry_without_readings(self, mock_logging):
+        """Test that housekeeping reports rooms offline when no readings arrive."""
+        now = [0.0]
+        ruuvi2mqtt.AVAILABILITY = ruuvi_tags.StalenessTracker(300, clock=lambda: now[0])
+        ruuvi2mqtt.AVAILABILITY.touch('living_room')
+        mock_client = MagicMock()
+        now[0] = 301.0
+        with patch('ruuvi2mqtt.CLIENTS', {'broker1': mock_client}):
+            ruuvi2mqtt.housekeeping()
+        mock_client.publish.assert_called_once_with(
+            'home/living_room/availability', 'offline', retain=True)
+
+    @patch('ruuvi2mqtt.CLIENTS')
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.logging')
+    def test_discovery_references_availability_topic(self, mock_logging, mock_clients):
+        """Test that discovery payloads reference the availability topic."""
+        mock_clients['broker1'] = MagicMock()
+        found_data = ('AA:BB:CC:DD:EE:FF', {'mac': 'AA:BB:CC:DD:EE:FF'})
+
+        ruuvi2mqtt.publish_discovery_config('living_room', found_data)
+
+        for call in mock_clients['broker1'].publish.call_args_list:
+            payload = json.loads(call[0][1])
+            self.assertEqual(payload['availability_topic'], 'home/living_room/availability')
+
+
+
+class TestForgetTag(unittest.TestCase):
+
+    def setUp(self):
+        ruuvi2mqtt.DISCOVERY_INDEX = ruuvi_discovery.DiscoveryIndex()
+        ruuvi2mqtt.AVAILABILITY = ruuvi_tags.StalenessTracker(300)
+        ruuvi2mqtt.CLIENTS = {'broker1': MagicMock()}
+        ruuvi2mqtt.FOUND_RUUVIS = ['Ruuvi-AABBCCDDEEFF', 'sauna']
+        ruuvi2mqtt.AVAILABILITY.touch('Ruuvi-AABBCCDDEEFF')
+        self.record = ruuvi_tags.TagRecord('AA:BB:CC:DD:EE:FF', 'Ruuvi-AABBCCDDEEFF', False, 0)
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.CLEANUP_EVICTED_DISCOVERY', False)
+    @patch('ruuvi2mqtt.logging')
+    def test_forget_tag_drops_state(self, mock_logging):
+        """Test that an evicted tag leaves no state behind."""
+        ruuvi2mqtt.forget_tag(self.record)
+
+        self.assertEqual(ruuvi2mqtt.FOUND_RUUVIS, ['sauna'])
+        self.assertNotIn('Ruuvi-AABBCCDDEEFF', ruuvi2mqtt.AVAILABILITY)
+        ruuvi2mqtt.CLIENTS['broker1'].publish.assert_called_once_with(
+            'home/Ruuvi-AABBCCDDEEFF/availability', 'offline', retain=True)
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.CLEANUP_EVICTED_DISCOVERY', True)
+    @patch('ruuvi2mqtt.logging')
+    def test_forget_tag_clears_retained_discovery(self, mock_logging):
+        """Test that retained topics of an evicted tag are cleared."""
+        ruuvi2mqtt.forget_tag(self.record)
+
+        calls = ruuvi2mqtt.CLIENTS['broker1'].publish.call_args_list
+        topics = [call[0][0] for call in calls]
+        self.assertIn('homeassistant/sensor/Ruuvi-AABBCCDDEEFF_temperature/config', topics)
+        self.assertIn('home/Ruuvi-AABBCCDDEEFF/availability', topics)
+        for call in calls:
+            self.assertEqual(call[0][1], '')
+            self.assertTrue(call[1].get('retain', False))
+
+
+class TestFleetConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmpdir.cleanup)
+        self.clients = {'broker1': MagicMock()}
+        self.tags = ruuvi_tags.TagRegistry()
+        self.tags.touch('AA:BB:CC:DD:EE:FF', 'living_room', True)
+        self.fleet = ruuvi_fleet.FleetSync('testhost', {'broker': 'broker1'},
+                                           os.path.join(self.tmpdir.name, 'fleet_config.json'))
+        for target, value in (('CONFIG', TEST_CONFIG), ('my_ruuvis', TEST_CONFIG.ruuvis),
+                              ('my_brokers', TEST_CONFIG.brokers), ('CLIENTS', self.clients),
+                              ('TAGS', self.tags), ('FOUND_RUUVIS', ['living_room']),
+                              ('FLEET', self.fleet), ('DISCOVERY_INDEX', None),
+                              ('MYHOSTNAME', 'testhost'), ('logging', MagicMock())):
+            patcher = patch(f'ruuvi2mqtt.{target}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def receive(self, version, **values):
+        self.fleet.receive(ruuvi_fleet.encode(version, **values).encode())
+        ruuvi2mqtt.apply_fleet_config()
+
+    def status(self):
+        topic, payload = self.clients['broker1'].publish.call_args[0]
+        self.assertEqual(topic, 'ruuvi2mqtt/testhost/config/status')
+        self.assertTrue(self.clients['broker1'].publish.call_args[1]['retain'])
+        return json.loads(payload)
+
+    @patch('ruuvi2mqtt.connect_brokers')
+    def test_applied_without_readings(self, mock_connect_brokers):
+        """Test that housekeeping applies a pending configuration without BLE data."""
+        self.fleet.receive(ruuvi_fleet.encode(4, ruuvis={'AA:BB:CC:DD:EE:FF': 'sauna'}).encode())
+        ruuvi2mqtt.housekeeping()
+        self.assertIsNone(self.fleet.pending)
+        self.assertEqual(ruuvi2mqtt.my_ruuvis, {'AA:BB:CC:DD:EE:FF': 'sauna'})
+        self.assertEqual(self.status()['status'], 'applied')
+
+    @patch('ruuvi2mqtt.connect_brokers')
+    def test_moved_tag(self, mock_connect_brokers):
+        """Test that a tag moved to another room leaves its old room only."""
+        self.receive(3, ruuvis={'aa:bb:cc:dd:ee:ff': 'sauna', '11:22:33:44:55:66': 'attic'})
+
+        self.assertEqual(ruuvi2mqtt.my_ruuvis, {'AA:BB:CC:DD:EE:FF': 'sauna',
+                                                '11:22:33:44:55:66': 'attic'})
+        self.assertEqual(ruuvi2mqtt.CONFIG.topics['sauna'], 'home/sauna')
+        self.assertEqual(ruuvi2mqtt.FOUND_RUUVIS, [])
+        cleared = [call[0][0] for call in self.clients['broker1'].publish.call_args_list
+                   if call[0][1] == '']
+        self.assertIn('homeassistant/sensor/living_room_temperature/config', cleared)
+        mock_connect_brokers.assert_called_once_with({})
+        self.assertEqual(self.status(), {'gateway': 'testhost', 'version': 3,
+                                         'status': 'applied', 'moved': 2,
+                                         'ts': self.status()['ts']})
+        self.assertEqual(ruuvi_fleet.load(os.path.join(self.tmpdir.name, 'fleet_config.json'))[0],
+                         3)
+
+        self.clients['broker1'].publish.reset_mock()
+        self.receive(2, ruuvis={})
+        self.clients['broker1'].publish.assert_not_called()
+        self.assertIn('11:22:33:44:55:66', ruuvi2mqtt.my_ruuvis)
+
+    @patch('ruuvi2mqtt.connect_brokers')
+    def test_brokers_added_and_removed(self, mock_connect_brokers):
+        """Test that brokers are connected and disconnected without touching tags."""
+        old = MagicMock()
+        self.clients['old'] = old
+        ruuvi2mqtt.CONFIG = ruuvi_config.Config({
+            'my_brokers': {'broker1': {'host': 'localhost', 'port': 1883},
+                           'old': {'host': 'old.example.com', 'port': 1883}},
+            'my_ruuvis': TEST_CONFIG.ruuvis,
+        })
+        brokers = {'broker1': {'host': 'localhost', 'port': 1883},
+                   'new': {'host': 'new.example.com', 'port': 1883}}
+        self.receive(1, brokers=brokers)
+
+        mock_connect_brokers.assert_called_once_with({'new': brokers['new']})
+        old.disconnect.assert_called_once()
+        self.assertNotIn('old', self.clients)
+        self.assertEqual(ruuvi2mqtt.FOUND_RUUVIS, ['living_room'])
+        self.assertEqual(self.status()['brokers_added'], ['new'])
+        self.assertEqual(self.status()['brokers_removed'], ['old'])
+        self.assertEqual(list(ruuvi2mqtt.my_brokers), ['broker1', 'new'])
+
+    @patch('ruuvi2mqtt.connect_brokers')
+    def test_tag_moved_twice(self, mock_connect_brokers):
+        """Test that the second move of a tag clears the room it moved to first."""
+        reading = ('AA:BB:CC:DD:EE:FF', {'temperature': 22.5, 'humidity': 45.0,
+                                         'pressure': 1013.25, 'rssi': -60,
+                                         'mac': 'aabbccddeeff'})
+        self.receive(1, ruuvis={'AA:BB:CC:DD:EE:FF': 'sauna'})
+        with patch('ruuvi2mqtt.publish_discovery_config'):
+            ruuvi2mqtt.handle_data(reading)
+        self.clients['broker1'].publish.reset_mock()
+        self.receive(2, ruuvis={'AA:BB:CC:DD:EE:FF': 'attic'})
+
+        cleared = [call[0][0] for call in self.clients['broker1'].publish.call_args_list
+                   if call[0][1] == '']
+        self.assertIn('homeassistant/sensor/sauna_temperature/config', cleared)
+        self.assertNotIn('homeassistant/sensor/living_room_temperature/config', cleared)
+
+    @patch('ruuvi2mqtt.BROKER_GROUP', {'broker1'})
+    @patch('ruuvi2mqtt.connect_brokers')
+    def test_per_broker_publisher(self, mock_connect_brokers):
+        """Test that a per_broker publisher keeps to its broker when one is added."""
+        brokers = {'broker1': {'host': 'localhost', 'port': 1883},
+                   'remote': {'host': 'remote.example.com', 'port': 1883}}
+        self.receive(1, brokers=brokers)
+
+        mock_connect_brokers.assert_called_once_with({})
+        self.assertEqual(list(ruuvi2mqtt.my_brokers), ['broker1'])
+        self.assertEqual(self.status()['brokers_added'], ['remote'])
+        ruuvi2mqtt.FOUND_RUUVIS.clear()
+        with patch('ruuvi2mqtt.publish_discovery_config') as mock_discovery:
+            ruuvi2mqtt.handle_data(('AA:BB:CC:DD:EE:FF', {
+                'temperature': 22.5, 'humidity': 45.0, 'pressure': 1013.25,
+                'rssi': -60, 'mac': 'aabbccddeeff'}))
+        self.assertEqual(mock_discovery.call_args[0][0], 'living_room')
+
+    def test_rejected(self):
+        """Test that invalid configurations are rejected and acknowledged as such."""
+        self.receive(5, ruuvis={'AA:BB:CC:DD:EE:FF': 'a/b'})
+        status = self.status()
+        self.assertEqual((status['version'], status['status']), (5, 'rejected'))
+        self.receive(6, brokers={'other': {'host': 'localhost', 'port': 1883}})
+        self.assertIn('cannot be removed', self.status()['error'])
+        self.assertIs(ruuvi2mqtt.CONFIG, TEST_CONFIG)
+
+    def test_restore(self):
+        """Test that the saved tag mapping is used before connecting."""
+        ruuvi_fleet.save(os.path.join(self.tmpdir.name, 'fleet_config.json'), 4,
+                         {'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna'}})
+        ruuvi2mqtt.restore_fleet_config()
+        self.assertEqual(ruuvi2mqtt.my_ruuvis, {'AA:BB:CC:DD:EE:FF': 'sauna'})
+        self.assertIsNone(self.fleet.version)
+
+    def test_on_message_queues_fleet_config(self):
+        """Test that the fleet topic is applied later on the main thread."""
+        msg = MagicMock(topic=ruuvi_fleet.DEFAULT_TOPIC, payload=b'{"version": 1}')
+        ruuvi2mqtt.on_message(None, 'broker1', msg)
+        self.assertEqual(self.fleet.pending, b'{"version": 1}')
+
+
+class TestSnapshot(unittest.TestCase):
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
+    def test_publish_snapshot_retained(self):
+        """Test that the snapshot is published retained to every broker when due."""
+        now = [0.0]
+        table = ruuvi_snapshot.SnapshotTable('testhost', clock=lambda: now[0])
+        clients = {'broker1': MagicMock(), 'broker2': MagicMock()}
+        with patch('ruuvi2mqtt.SNAPSHOT', table), patch('ruuvi2mqtt.CLIENTS', clients):
+            table.update('sauna', 'AA:BB:CC:DD:EE:FF', {'temperature': 80.0}, 1700000000.0)
+            ruuvi2mqtt.publish_snapshot()
+            now[0] = 1.0
+            table.update('sauna', 'AA:BB:CC:DD:EE:FF', {'temperature': 81.0}, 1700000001.0)
+            ruuvi2mqtt.publish_snapshot()  # Debounced
+        for client in clients.values():
+            client.publish.assert_called_once()
+            topic, payload = client.publish.call_args[0]
+            self.assertEqual(topic, 'home/_snapshot/testhost')
+            self.assertTrue(client.publish.call_args[1]['retain'])
+            self.assertEqual(json.loads(payload)['tags']['sauna']['temperature'], 80.0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.MYHOSTNAME', 'testhost')
+    def test_publish_link_stats(self):
+        """Test that link statistics are published per tag every interval."""
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+        ruuvi2mqtt.TAGS = ruuvi_tags.TagRegistry()
+        ruuvi2mqtt.LINK_STATS_TIMER.last = None
+        for seq in (1, 2, 4):
+            ruuvi2mqtt.TAGS.touch('AA', 'sauna', True, -60, seq=seq)
+        ruuvi2mqtt.TAGS.touch('BB', 'cellar', True)  # no sequence numbers
+        start = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        ruuvi2mqtt.publish_link_stats(start)
+        mock_client.publish.assert_not_called()
+
+        ruuvi2mqtt.publish_link_stats(
+            start + datetime.timedelta(seconds=ruuvi2mqtt.LINK_STATS_INTERVAL))
+        mock_client.publish.assert_called_once()
+        topic, payload = mock_client.publish.call_args[0]
+        self.assertEqual(topic, 'home/sauna/link')
+        stats = json.loads(payload)
+        self.assertEqual((stats['link_received'], stats['link_expected']), (3, 4))
+        self.assertEqual(stats['link_rssi_mean'], -60)
+        ruuvi2mqtt.TAGS = ruuvi_tags.TagRegistry()
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1'])
+    @patch('ruuvi2mqtt.MYHOSTNAME', 'testhost')
+    @patch('ruuvi2mqtt.logging')
+    def test_publish_metrics_every_interval(self, mock_logging):
+        """Test that metrics are published once per interval."""
+        mock_client = MagicMock()
+        ruuvi2mqtt.CLIENTS = {'broker1': mock_client}
+        ruuvi2mqtt.METRICS_TIMER.last = None
+        start = datetime.datetime.now(tz=datetime.timezone.utc)
+
+        ruuvi2mqtt.publish_metrics(start)
+        ruuvi2mqtt.publish_metrics(start + datetime.timedelta(seconds=30))
+        mock_client.publish.assert_not_called()
+
+        ruuvi2mqtt.publish_metrics(start + datetime.timedelta(seconds=61))
+        mock_client.publish.assert_called_once()
+        topic, payload = mock_client.publish.call_args[0]
+        self.assertEqual(topic, ruuvi2mqtt.METRICS_TOPIC)
+        self.assertEqual(json.loads(payload)['client'], 'testhost')
+
+    @patch('ruuvi2mqtt.my_brokers', ['broker1', 'broker2'])
+    def test_collect_metrics_outbound(self):
+        """Test that conflation counts are reported per conflating broker."""
+        publisher = ruuvi_outbound.ConflatingPublisher(MagicMock())
+        publisher.conflated = 5
+        ruuvi2mqtt.CLIENTS = {'broker1': publisher, 'broker2': MagicMock()}
+
+        metrics = ruuvi2mqtt.collect_metrics()
+
+        self.assertEqual(metrics['outbound'], {'broker1': publisher.metrics()})
+        self.assertEqual(metrics['log_dropped'], ruuvi_logging.dropped())
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
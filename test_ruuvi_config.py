@@ -0,0 +1,262 @@
+import datetime
+import json
+import os
+import re
+import tempfile
+import unittest
+from unittest.mock import patch
+import ruuvi_config
+
+BROKERS = {'local': {'host': 'localhost', 'port': 1883}}
+
+
+class TestNormalizeMac(unittest.TestCase):
+
+    def test_separators_and_case(self):
+        """Test that colons, dashes and bare digits normalize the same."""
+        for mac in ('aa:bb:cc:dd:ee:ff', 'AA-BB-CC-DD-EE-FF', 'aabbccddeeff'):
+            self.assertEqual(ruuvi_config.normalize_mac(mac), 'AA:BB:CC:DD:EE:FF')
+
+    def test_invalid(self):
+        """Test that malformed addresses are rejected."""
+        for mac in ('AA:BB:CC:DD:EE', 'AA:BB-CC:DD:EE:FF', 'GG:BB:CC:DD:EE:FF', 123):
+            with self.assertRaises(ruuvi_config.ConfigError):
+                ruuvi_config.normalize_mac(mac)
+
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid(self):
+        """Test that valid settings come back with normalized MACs."""
+        values = ruuvi_config.validate({
+            'my_brokers': BROKERS,
+            'my_ruuvis': {'aa-bb-cc-dd-ee-ff': 'sauna'},
+            'tag_timeout': 60,
+        })
+        self.assertEqual(values['my_ruuvis'], {'AA:BB:CC:DD:EE:FF': 'sauna'})
+        self.assertEqual(values['tag_timeout'], 60)
+
+    def test_collects_all_errors(self):
+        """Test that every problem is reported in one error."""
+        with self.assertRaises(ruuvi_config.ConfigError) as context:
+            ruuvi_config.validate({
+                'my_brokers': {'local': {'host': 'localhost', 'port': 70000}},
+                'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'a/b', 'nope': 'sauna'},
+                'health_port': True,
+            })
+        message = str(context.exception)
+        for part in ('my_brokers.local.port', 'a/b', "'nope'", 'health_port'):
+            self.assertIn(part, message)
+
+    def test_duplicate_mac(self):
+        """Test that one tag written two ways is rejected."""
+        with self.assertRaises(ruuvi_config.ConfigError):
+            ruuvi_config.validate({
+                'my_brokers': BROKERS,
+                'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna', 'aabbccddeeff': 'attic'},
+            })
+
+    def test_fleet_broker(self):
+        """Test that the fleet broker must be one of my_brokers."""
+        values = {'my_brokers': BROKERS, 'my_ruuvis': {}, 'fleet': {'broker': 'local'}}
+        self.assertEqual(ruuvi_config.validate(values)['fleet'], {'broker': 'local'})
+        values['fleet'] = {'broker': 'central'}
+        with self.assertRaises(ruuvi_config.ConfigError):
+            ruuvi_config.validate(values)
+
+    def test_nested_options(self):
+        """Test that the options of nested settings are checked by key and type."""
+        with self.assertRaises(ruuvi_config.ConfigError) as context:
+            ruuvi_config.validate({
+                'my_brokers': {'local': {'host': 'localhost', 'port': 1883,
+                                         'batch': {'compression': 'lz4'}}},
+                'my_ruuvis': {},
+                'snapshot': {'bogus': 1, 'interval': '5m'},
+                'load_generator': {'tags': 'many'},
+                'multiprocess': {'slots': 0},
+                'sinks': [{'type': 'file'}, {'type': 'influx', 'url': 'ftp://x'}, 'file'],
+            })
+        message = str(context.exception)
+        for part in ("snapshot: unknown option 'bogus'", 'snapshot.interval',
+                     'load_generator.tags', 'multiprocess.slots',
+                     'my_brokers.local.batch.compression', 'sinks[0]: path is required',
+                     'sinks[1].url', 'sinks[2]: expected a mapping'):
+            self.assertIn(part, message)
+        values = ruuvi_config.validate({
+            'my_brokers': BROKERS, 'my_ruuvis': {},
+            'snapshot': {'fields': ['temperature'], 'interval': 60},
+            'sinks': [{'type': 'file', 'path': 'readings.jsonl', 'batch_size': 10}],
+        })
+        self.assertEqual(values['snapshot']['interval'], 60)
+
+    def test_derived_metrics(self):
+        """Test that derived metric names must be known to ruuvi_derived."""
+        values = {'my_brokers': BROKERS, 'my_ruuvis': {}, 'derived_metrics': ['dew_point']}
+        self.assertEqual(ruuvi_config.validate(values)['derived_metrics'], ['dew_point'])
+        values['derived_metrics'] = ['dew_point', 'heat_index']
+        with self.assertRaisesRegex(ruuvi_config.ConfigError, 'derived_metrics'):
+            ruuvi_config.validate(values)
+
+    def test_sink_options_per_type(self):
+        """Test that a sink only accepts the options of its own type."""
+        with self.assertRaises(ruuvi_config.ConfigError) as context:
+            ruuvi_config.validate({
+                'my_brokers': BROKERS, 'my_ruuvis': {},
+                'sinks': [{'type': 'file', 'path': 'readings.jsonl', 'measurement': 'ruuvi'},
+                          {'type': 'influx', 'url': 'udp://influx:8089', 'path': 'x'}],
+            })
+        message = str(context.exception)
+        self.assertIn("sinks[0]: unknown option 'measurement'", message)
+        self.assertIn("sinks[1]: unknown option 'path'", message)
+
+    def test_log_level(self):
+        """Test that log_level must be a logging level name."""
+        values = {'my_brokers': BROKERS, 'my_ruuvis': {}, 'log_level': 'DEBUG'}
+        self.assertEqual(ruuvi_config.validate(values)['log_level'], 'DEBUG')
+        values['log_level'] = 'VERBOSE'
+        with self.assertRaisesRegex(ruuvi_config.ConfigError, 'log_level'):
+            ruuvi_config.validate(values)
+
+    def test_required(self):
+        """Test that brokers and ruuvis are required."""
+        with self.assertRaises(ruuvi_config.ConfigError) as context:
+            ruuvi_config.validate({})
+        self.assertIn('my_brokers is required', str(context.exception))
+        self.assertIn('my_ruuvis is required', str(context.exception))
+
+
+class TestLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w', encoding='utf-8') as file_handle:
+            file_handle.write(content)
+        return path
+
+    def test_read_python(self):
+        """Test that settings.py public names are read, imports are not."""
+        path = self.write('settings.py', "import os\n_private = 1\n"
+                          "my_brokers = {'local': {'host': 'localhost', 'port': 1883}}\n"
+                          "my_ruuvis = {}\n")
+        self.assertEqual(ruuvi_config.read(path), {'my_brokers': BROKERS, 'my_ruuvis': {}})
+
+    def test_read_json(self):
+        """Test that settings.json is read."""
+        path = self.write('settings.json', json.dumps({'my_brokers': BROKERS, 'my_ruuvis': {}}))
+        self.assertEqual(ruuvi_config.read(path)['my_brokers'], BROKERS)
+
+    @unittest.skipIf(ruuvi_config.tomllib is None, "tomllib needs Python 3.11")
+    def test_read_toml(self):
+        """Test that settings.toml is read."""
+        path = self.write('settings.toml', '[my_brokers.local]\nhost = "localhost"\n'
+                          'port = 1883\n\n[my_ruuvis]\n"AA:BB:CC:DD:EE:FF" = "sauna"\n')
+        values = ruuvi_config.read(path)
+        self.assertEqual(values['my_brokers'], BROKERS)
+        self.assertEqual(values['my_ruuvis'], {'AA:BB:CC:DD:EE:FF': 'sauna'})
+
+    def test_read_broken(self):
+        """Test that syntax errors become ConfigError."""
+        path = self.write('settings.py', "my_brokers = {\n")
+        with self.assertRaises(ruuvi_config.ConfigError):
+            ruuvi_config.read(path)
+
+    def test_read_raising(self):
+        """Test that any exception raised by settings.py becomes ConfigError."""
+        for content in ("import no_such_module\n", "import os\nx = os.no_such_name\n"):
+            path = self.write('settings.py', content)
+            with self.assertRaises(ruuvi_config.ConfigError):
+                ruuvi_config.read(path)
+
+    def test_ruuvis_file(self):
+        """Test that ruuvis_file adds tags and my_ruuvis wins."""
+        self.write('ruuvis.json', json.dumps({'aa:bb:cc:dd:ee:ff': 'attic',
+                                              '11:22:33:44:55:66': 'garage'}))
+        path = self.write('settings.json', json.dumps({
+            'my_brokers': BROKERS,
+            'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna'},
+            'ruuvis_file': 'ruuvis.json',
+        }))
+        config = ruuvi_config.load(path)
+        self.assertEqual(config.ruuvis, {'AA:BB:CC:DD:EE:FF': 'sauna',
+                                         '11:22:33:44:55:66': 'garage'})
+
+    def test_find(self):
+        """Test the search order and the environment override."""
+        self.write('settings.py', '')
+        toml = self.write('settings.toml', '')
+        with patch.dict(os.environ, {ruuvi_config.CONFIG_ENV: ''}):
+            self.assertEqual(ruuvi_config.find([self.tmpdir.name]), toml)
+        with patch.dict(os.environ, {ruuvi_config.CONFIG_ENV: '/etc/ruuvi.toml'}):
+            self.assertEqual(ruuvi_config.find([self.tmpdir.name]), '/etc/ruuvi.toml')
+        with patch.dict(os.environ, {ruuvi_config.CONFIG_ENV: ''}):
+            with self.assertRaises(ruuvi_config.ConfigError):
+                ruuvi_config.find([os.path.join(self.tmpdir.name, 'missing')])
+
+    def test_find_data_volume_first(self):
+        """Test that the data volume is searched before the app directory."""
+        self.assertEqual(ruuvi_config.SEARCH_DIRECTORIES[0], '/data')
+        data_dir = os.path.join(self.tmpdir.name, 'data')
+        os.mkdir(data_dir)
+        self.write('settings.py', '')
+        json_path = os.path.join(data_dir, 'settings.json')
+        with open(json_path, 'w', encoding='utf-8') as file_handle:
+            file_handle.write('{}')
+        with patch.dict(os.environ, {ruuvi_config.CONFIG_ENV: ''}), \
+                patch('ruuvi_config.SEARCH_DIRECTORIES', (data_dir, self.tmpdir.name)):
+            self.assertEqual(ruuvi_config.find(), json_path)
+
+    def test_data_dir(self):
+        """Test that data_dir is configured or defaults to the data volume or "."."""
+        self.assertEqual(ruuvi_config.data_dir({'data_dir': '/srv/ruuvi'}), '/srv/ruuvi')
+        with patch('os.path.isdir', return_value=True):
+            self.assertEqual(ruuvi_config.data_dir({}), '/data')
+        with patch('os.path.isdir', return_value=False):
+            self.assertEqual(ruuvi_config.data_dir({}), '.')
+
+    def test_write_round_trip(self):
+        """Test that settings.py and settings.json are written in their own format."""
+        values = {'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna'},
+                  'my_brokers': {'local': {'host': 'localhost', 'port': 1883,
+                                           'conflate': True}},
+                  'log_level': 'DEBUG'}
+        for name in ('settings.py', 'settings.json'):
+            path = os.path.join(self.tmpdir.name, name)
+            ruuvi_config.write(path, values)
+            self.assertEqual(ruuvi_config.read(path), values)
+        with self.assertRaises(ruuvi_config.ConfigError):
+            ruuvi_config.write(os.path.join(self.tmpdir.name, 'settings.toml'), values)
+
+    def test_write_literals_only(self):
+        """Test that values computed from imports are not written to settings.py."""
+        path = os.path.join(self.tmpdir.name, 'settings.py')
+        values = {'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna'},
+                  'my_brokers': {'local': {'host': 'localhost'}},
+                  'log_level': 'INFO',
+                  'started': datetime.datetime(2024, 1, 1),
+                  'pattern': re.compile('sauna')}
+        ruuvi_config.write(path, values)
+        self.assertEqual(ruuvi_config.read(path),
+                         {name: values[name] for name in ('my_ruuvis', 'my_brokers', 'log_level')})
+
+class TestConfig(unittest.TestCase):
+
+    def test_lookups(self):
+        """Test the precompiled room, topic and discovery lookups."""
+        config = ruuvi_config.Config({
+            'my_brokers': BROKERS,
+            'my_ruuvis': {'aa:bb:cc:dd:ee:ff': 'sauna', '11:22:33:44:55:66': 'attic'},
+            'log_level': 'DEBUG',
+        })
+        self.assertEqual(config.rooms, {'sauna', 'attic'})
+        self.assertEqual(config.topics['sauna'], 'home/sauna')
+        self.assertTrue('sauna_temperature'.startswith(config.discovery_prefixes))
+        self.assertEqual(config.get('log_level'), 'DEBUG')
+        self.assertEqual(config.get('tag_timeout', 30), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
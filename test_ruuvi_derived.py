@@ -0,0 +1,57 @@
+import unittest
+from unittest.mock import patch
+import ruuvi_derived
+
+
+class TestCompute(unittest.TestCase):
+
+    def test_reference_values(self):
+        """Test the metrics against reference values at 20 °C and 50 %."""
+        results = ruuvi_derived.compute(
+            ruuvi_derived.METRICS, 20.0, 50.0, 1013.25)
+        self.assertAlmostEqual(results['dew_point'], 9.26, places=1)
+        self.assertAlmostEqual(results['absolute_humidity'], 8.64, places=1)
+        self.assertAlmostEqual(results['vpd'], 1.17, places=1)
+        self.assertAlmostEqual(results['air_density'], 1.20, places=1)
+
+    def test_missing_inputs(self):
+        """Test that metrics with missing inputs are left out."""
+        self.assertEqual(ruuvi_derived.compute(['dew_point'], None, 50.0), {})
+        self.assertEqual(ruuvi_derived.compute(['air_density'], 20.0, 50.0), {})
+
+
+class TestEnricher(unittest.TestCase):
+
+    def test_unknown_metric(self):
+        """Test that unknown metric names are rejected."""
+        with self.assertRaises(ValueError):
+            ruuvi_derived.Enricher(['heat_index'])
+
+    def test_disabled_enricher_is_false(self):
+        """Test that an enricher without metrics is falsy."""
+        self.assertFalse(ruuvi_derived.Enricher([]))
+
+    def test_enrich_caches_per_tag(self):
+        """Test that metrics are recomputed only when the inputs change."""
+        enricher = ruuvi_derived.Enricher(['dew_point', 'vpd'])
+        with patch('ruuvi_derived.compute', wraps=ruuvi_derived.compute) as mock_compute:
+            jdata = {'temperature': 20.0, 'humidity': 50.0}
+            enricher.enrich('AA', jdata)
+            self.assertIn('dew_point', jdata)
+
+            enricher.enrich('AA', {'temperature': 20.0, 'humidity': 50.0})
+            self.assertEqual(mock_compute.call_count, 1)
+
+            enricher.enrich('AA', {'temperature': 21.0, 'humidity': 50.0})
+            enricher.enrich('BB', {'temperature': 21.0, 'humidity': 50.0})
+            self.assertEqual(mock_compute.call_count, 3)
+
+    def test_discovery_sensors(self):
+        """Test that discovery entries match the enabled metrics."""
+        enricher = ruuvi_derived.Enricher(['vpd'])
+        self.assertEqual(enricher.discovery_sensors(),
+                         {'vpd': {'class': 'pressure', 'unit': 'kPa'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import ruuvi_discovery
+
+
+class TestDiscoveryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.index = ruuvi_discovery.DiscoveryIndex(
+            sync_window=5, clock=lambda: self.now[0])
+
+    def test_needs_publish(self):
+        """Test that only missing or changed configs need publishing."""
+        value = ruuvi_discovery.digest('{"a": 1}')
+        self.assertTrue(self.index.needs_publish('b1', 'topic', value))
+        self.index.record('b1', 'topic', value)
+        self.assertFalse(self.index.needs_publish('b1', 'topic', value))
+        self.assertTrue(self.index.needs_publish('b2', 'topic', value))
+        self.assertTrue(self.index.needs_publish(
+            'b1', 'topic', ruuvi_discovery.digest('{"a": 2}')))
+
+    def test_observe_matches_published_digest(self):
+        """Test that a replayed payload has the digest of the published one."""
+        self.index.observe('b1', 'topic', b'{"a": 1}')
+        self.assertFalse(self.index.needs_publish(
+            'b1', 'topic', ruuvi_discovery.digest('{"a": 1}')))
+        self.index.observe('b1', 'topic', b'')
+        self.assertNotIn('topic', self.index.digests['b1'])
+
+    @patch('ruuvi_discovery.logging')
+    def test_finish_sync_drops_topics_not_replayed(self, mock_logging):
+        """Test that topics the broker no longer holds are dropped after sync."""
+        self.index.record('b1', 'kept', 'x')
+        self.index.record('b1', 'lost', 'y')
+        self.index.begin_sync('b1')
+        self.index.observe('b1', 'kept', b'payload')
+
+        self.assertEqual(self.index.finish_sync(), 0)  # Window still open
+        self.now[0] = 6.0
+        self.assertEqual(self.index.finish_sync(), 1)
+        self.assertEqual(list(self.index.digests['b1']), ['kept'])
+        self.assertEqual(self.index.syncing, {})
+
+    @patch('ruuvi_discovery.logging')
+    def test_save_and_load(self, mock_logging):
+        """Test that the index survives a restart."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.json')
+            self.index.load(path)
+            self.index.record('b1', 'topic', 'x')
+            self.index.save()
+            with open(path, encoding='utf-8') as handle:
+                self.assertEqual(json.load(handle), {'b1': {'topic': 'x'}})
+
+            index = ruuvi_discovery.DiscoveryIndex()
+            index.load(path)
+            self.assertFalse(index.needs_publish('b1', 'topic', 'x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
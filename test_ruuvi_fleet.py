@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import unittest
+import ruuvi_config
+import ruuvi_fleet
+
+BROKERS = {'local': {'host': 'localhost', 'port': 1883}}
+
+
+class TestMessages(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Test that encoded configurations parse back with only the sent settings."""
+        payload = ruuvi_fleet.encode(7, ruuvis={'AA:BB:CC:DD:EE:FF': 'sauna'})
+        self.assertEqual(ruuvi_fleet.parse(payload.encode()),
+                         (7, {'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna'}}))
+
+    def test_parse_invalid(self):
+        """Test that malformed messages and versions are rejected."""
+        for payload in (b'nope', b'[]', b'{}', b'{"version": -1}', b'{"version": true}'):
+            with self.assertRaises(ruuvi_config.ConfigError):
+                ruuvi_fleet.parse(payload)
+
+    def test_status(self):
+        """Test the acknowledgement of applied and rejected versions."""
+        applied = json.loads(ruuvi_fleet.status(3, 'gw', applied={
+            'moved': {'AA': ('a', 'b')}, 'brokers_added': ['new'],
+            'brokers_removed': [], 'brokers_changed': [],
+        }))
+        self.assertEqual((applied['status'], applied['moved'], applied['brokers_added']),
+                         ('applied', 1, ['new']))
+        self.assertNotIn('brokers_removed', applied)
+        rejected = json.loads(ruuvi_fleet.status(None, 'gw', error='bad'))
+        self.assertEqual((rejected['status'], rejected['error']), ('rejected', 'bad'))
+
+
+class TestChanges(unittest.TestCase):
+
+    def test_changes(self):
+        """Test that only moved tags and changed brokers are reported."""
+        old = ruuvi_config.Config({
+            'my_brokers': dict(BROKERS, remote={'host': 'a', 'port': 1883}),
+            'my_ruuvis': {'AA:BB:CC:DD:EE:FF': 'sauna', '11:22:33:44:55:66': 'attic'},
+            'tag_timeout': 60,
+        })
+        new = ruuvi_fleet.build({
+            'my_brokers': dict(BROKERS, remote={'host': 'b', 'port': 1883},
+                               extra={'host': 'c', 'port': 1883}),
+            'my_ruuvis': {'aa:bb:cc:dd:ee:ff': 'sauna', '11:22:33:44:55:66': 'cellar',
+                          '22:33:44:55:66:77': 'garage'},
+        }, old)
+        self.assertEqual(new.get('tag_timeout'), 60)
+        self.assertEqual(ruuvi_fleet.changes(old, new), {
+            'moved': {'11:22:33:44:55:66': ('attic', 'cellar'),
+                      '22:33:44:55:66:77': (None, 'garage')},
+            'brokers_added': ['extra'],
+            'brokers_removed': [],
+            'brokers_changed': ['remote'],
+        })
+
+    def test_save_and_load(self):
+        """Test that the applied configuration is kept across restarts."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'fleet_config.json')
+            self.assertIsNone(ruuvi_fleet.load(path))
+            ruuvi_fleet.save(path, 9, {'my_brokers': BROKERS})
+            self.assertEqual(ruuvi_fleet.load(path), (9, {'my_brokers': BROKERS}))
+
+
+if __name__ == '__main__':
+    unittest.main()
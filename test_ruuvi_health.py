@@ -0,0 +1,85 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+import ruuvi_health
+
+
+class TestStartupTimer(unittest.TestCase):
+
+    @patch('ruuvi_health.process_age', return_value=0.5)
+    def test_marks_from_process_start(self, mock_age):
+        """Test that milestones count from process start and are kept once."""
+        now = [10.0]
+        timer = ruuvi_health.StartupTimer(clock=lambda: now[0])
+        timer.mark('imports')
+        now[0] = 11.0
+        timer.mark('imports')
+        timer.finish('first_publish')
+        self.assertEqual(timer.summary(), {'imports': 500.0, 'first_publish': 1500.0})
+        self.assertTrue(timer.done)
+
+    def test_liveness_waits_for_first_reading(self):
+        """Test that liveness fails while starting until the first reading or the grace."""
+        now = [0.0]
+        timer = ruuvi_health.StartupTimer(clock=lambda: now[0])
+        timer.origin = 0.0
+        alive, details = ruuvi_health.liveness(timer, None, 60, grace=30)
+        self.assertFalse(alive)
+        self.assertEqual(details['status'], 'starting')
+        now[0] = 31.0
+        self.assertTrue(ruuvi_health.liveness(timer, None, 60, grace=30)[0])
+        now[0] = 1.0
+        timer.mark('first_reading')
+        self.assertTrue(ruuvi_health.liveness(timer, 1.0, 60, grace=30)[0])
+        alive, details = ruuvi_health.liveness(timer, 61.0, 60, grace=30)
+        self.assertFalse(alive)
+        self.assertEqual(details['status'], 'stale')
+
+    def test_process_age(self):
+        """Test that the process age is a small positive number or unknown."""
+        age = ruuvi_health.process_age()
+        if age is not None:
+            self.assertGreaterEqual(age, 0)
+
+
+class TestHealthServer(unittest.TestCase):
+
+    def setUp(self):
+        self.ready = False
+        self.server = ruuvi_health.HealthServer(0, {
+            '/healthz': lambda: (True, {'status': 'ok'}),
+            '/readyz': lambda: (self.ready, {'brokers': {'local': self.ready}}),
+        }, host='127.0.0.1')
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get(self, path):
+        url = f'http://127.0.0.1:{self.server.port}{path}'
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as exc:
+            body = exc.read()
+            return exc.code, json.loads(body) if body.startswith(b'{') else None
+
+    def test_probes(self):
+        """Test that checks answer 200 when ok and 503 otherwise."""
+        self.assertEqual(self.get('/healthz'), (200, {'status': 'ok'}))
+        self.assertEqual(self.get('/readyz'), (503, {'brokers': {'local': False}}))
+        self.ready = True
+        self.assertEqual(self.get('/readyz')[0], 200)
+        self.assertEqual(self.get('/other')[0], 404)
+
+    def test_serve_disabled(self):
+        """Test that serve() starts nothing for port 0 or a port in use."""
+        self.assertIsNone(ruuvi_health.serve(0, {}))
+        with patch('ruuvi_health.logging'):
+            self.assertIsNone(ruuvi_health.serve(self.server.port, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import MagicMock
+import ruuvi_latency
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        """Test that percentiles are within the bucket resolution."""
+        histogram = ruuvi_latency.LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.add(ms / 1000)
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50_ms'], 50, delta=50 * 0.2)
+        self.assertAlmostEqual(summary['p99_ms'], 99, delta=99 * 0.2)
+        self.assertEqual(summary['max_ms'], 100)
+
+    def test_empty(self):
+        """Test that an empty histogram has no percentiles."""
+        self.assertIsNone(ruuvi_latency.LatencyHistogram().percentile(50))
+
+
+class TestLatencyTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.tracer = ruuvi_latency.LatencyTracer(clock=lambda: self.now[0])
+
+    def test_ack_after_sent(self):
+        """Test that the time from receive to ack is recorded per broker."""
+        self.tracer.sent('local', 1, received=0.0)
+        self.now[0] = 0.02
+        self.tracer.acked('local', 1)
+        self.tracer.stage('publish', 0.0)
+        summary = self.tracer.summary()
+        self.assertEqual(summary['ack:local']['count'], 1)
+        self.assertEqual(summary['ack:local']['max_ms'], 20)
+        self.assertEqual(self.tracer.summary(), {})
+
+    def test_ack_before_sent(self):
+        """Test acks that arrive before the publish call has returned."""
+        self.now[0] = 0.005
+        self.tracer.acked('local', 7)
+        self.tracer.sent('local', 7, received=0.0)
+        self.assertEqual(self.tracer.summary()['ack:local']['max_ms'], 5)
+
+    def test_run_benchmark(self):
+        """Test the benchmark loop with a client that acks immediately."""
+        client = MagicMock()
+
+        def publish(topic, payload, qos):
+            info = MagicMock(mid=client.publish.call_count)
+            self.tracer.acked('benchmark', info.mid)
+            return info
+        client.publish.side_effect = publish
+
+        summary = ruuvi_latency.run_benchmark(client, self.tracer, 10, 1, 0)
+        self.assertEqual(summary['ack:benchmark']['count'], 10)
+        self.assertEqual(summary['publish']['count'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import random
+import unittest
+from ruuvitag_sensor.decoder import Df5Decoder
+import ruuvi_loadgen
+
+
+async def collect(generator, duration):
+    return [reading async for reading in generator.readings(duration)]
+
+
+class TestVirtualTag(unittest.TestCase):
+
+    def test_encode_decodes_as_df5(self):
+        """Test that advertisements decode with the ruuvitag_sensor decoder."""
+        tag = ruuvi_loadgen.VirtualTag(258, random.Random(1), drift=0.02)
+        tag.sequence = 65535
+        tag.advance()
+        data = Df5Decoder().decode_data(tag.encode())
+        self.assertEqual(tag.mac, 'F2:00:00:00:01:02')
+        self.assertEqual(data['mac'], 'f20000000102')
+        self.assertEqual(data['measurement_sequence_number'], 0)
+        self.assertAlmostEqual(data['temperature'], tag.temperature, delta=0.01)
+        self.assertAlmostEqual(data['humidity'], tag.humidity, delta=0.01)
+        self.assertAlmostEqual(data['pressure'], tag.pressure, delta=0.01)
+        self.assertLess(data['rssi'], 0)
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def test_rate_and_loss(self):
+        """Test that tags advertise at the rate and lost packets skip sequences."""
+        generator = ruuvi_loadgen.LoadGenerator(tags=5, rate=200, jitter=0, loss=0.2, seed=1)
+        readings = asyncio.run(collect(generator, 0.1))
+
+        stats = generator.stats()
+        self.assertEqual(len(readings), stats['sent'])
+        self.assertGreater(stats['lost'], 0)
+        self.assertAlmostEqual(stats['sent'] + stats['lost'], 5 * 200 * 0.1, delta=10)
+        self.assertEqual({mac for mac, _ in readings}, {tag.mac for tag in generator.tags})
+
+    def test_lag_when_consumer_is_slow(self):
+        """Test that a slow consumer shows up as schedule lag."""
+        now = [0.0]
+        generator = ruuvi_loadgen.LoadGenerator(tags=2, rate=1, seed=1,
+                                                clock=lambda: now[0])
+
+        async def consume():
+            async for _ in generator.readings():
+                now[0] += 5  # Each reading takes five seconds to handle
+                if generator.sent >= 4:
+                    return
+
+        asyncio.run(consume())
+        self.assertGreater(generator.stats()['max_lag_ms'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import io
+import json
+import logging
+import unittest
+import ruuvi_logging
+
+
+def make_record(msg, *args, level=logging.INFO):
+    return logging.LogRecord('test', level, __file__, 1, msg, args, None)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def test_rate_limit_per_first_argument(self):
+        """Test that a template is limited separately for each first argument."""
+        now = [0.0]
+        log_filter = ruuvi_logging.RateLimitFilter(
+            {"Not found %s": 60}, clock=lambda: now[0])
+
+        self.assertTrue(log_filter.filter(make_record("Not found %s", "AA")))
+        self.assertFalse(log_filter.filter(make_record("Not found %s", "AA")))
+        self.assertTrue(log_filter.filter(make_record("Not found %s", "BB")))
+
+        # Window closed: passes again and reports suppressed records
+        now[0] = 61.0
+        record = make_record("Not found %s", "AA")
+        self.assertTrue(log_filter.filter(record))
+        self.assertEqual(record.suppressed, 1)
+
+    def test_unlimited_templates_pass(self):
+        """Test that templates without a limit are never filtered."""
+        log_filter = ruuvi_logging.RateLimitFilter({"Not found %s": 60})
+        for _ in range(3):
+            self.assertTrue(log_filter.filter(make_record("Other %s", "AA")))
+
+
+class TestSampleFilter(unittest.TestCase):
+
+    def test_sample_every_nth(self):
+        """Test that every n:th record of a sampled template passes."""
+        log_filter = ruuvi_logging.SampleFilter({"sample %s": 3})
+        passed = [log_filter.filter(make_record("sample %s", i)) for i in range(6)]
+        self.assertEqual(passed, [True, False, False, True, False, False])
+
+
+class TestJsonFormatter(unittest.TestCase):
+
+    def test_json_output(self):
+        """Test that records are formatted as JSON objects."""
+        record = make_record("%s: %s", "living_room", 22.5, level=logging.WARNING)
+        record.suppressed = 2
+        entry = json.loads(ruuvi_logging.JsonFormatter().format(record))
+        self.assertEqual(entry['message'], "living_room: 22.5")
+        self.assertEqual(entry['level'], "WARNING")
+        self.assertEqual(entry['suppressed'], 2)
+
+
+class TestTextFormatter(unittest.TestCase):
+
+    def test_suppressed_count(self):
+        """Test that text lines note the records suppressed by a rate limit."""
+        formatter = ruuvi_logging.TextFormatter('%(message)s')
+        record = make_record("Not found %s", "AA")
+        self.assertEqual(formatter.format(record), "Not found AA")
+        record.suppressed = 3
+        self.assertEqual(formatter.format(record), "Not found AA (3 suppressed)")
+
+
+class TestSetupLogging(unittest.TestCase):
+
+    def tearDown(self):
+        logging.getLogger().handlers.clear()
+
+    def test_records_written_by_listener(self):
+        """Test that records are written by the background listener."""
+        stream = io.StringIO()
+        listener = ruuvi_logging.setup_logging(
+            json_output=True, rate_limits={"Not found %s": 60}, stream=stream)
+        logging.info("Not found %s", "AA")
+        logging.info("Not found %s", "AA")
+        logging.debug("hidden")
+        listener.stop()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['message'], "Not found AA")
+
+    def test_dropped(self):
+        """Test that records dropped on a full queue are counted."""
+        listener = ruuvi_logging.setup_logging(stream=io.StringIO())
+        listener.stop()  # Nothing takes records off the queue
+        handler = logging.getLogger().handlers[0]
+        for _ in range(handler.queue.maxsize):
+            handler.queue.put_nowait(make_record("filler"))
+        logging.info("lost")
+        self.assertEqual(ruuvi_logging.dropped(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
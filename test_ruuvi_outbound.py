@@ -0,0 +1,260 @@
+import gzip
+import json
+import threading
+import unittest
+from unittest.mock import MagicMock
+from paho.mqtt.client import MQTT_ERR_NO_CONN, MQTT_ERR_SUCCESS
+import ruuvi_outbound
+
+
+class FakeClient:
+    """MQTT client whose messages stay in flight until written()."""
+
+    def __init__(self):
+        self.connected = True
+        self.sent = []
+        self.infos = []
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = MagicMock()
+        info.rc = MQTT_ERR_SUCCESS if self.connected else MQTT_ERR_NO_CONN
+        info.is_published.return_value = False
+        self.sent.append((topic, payload))
+        self.infos.append(info)
+        return info
+
+    def written(self):
+        for info in self.infos:
+            info.is_published.return_value = True
+
+
+class TestConflatingPublisher(unittest.TestCase):
+
+    def test_passes_through_with_capacity(self):
+        """Test that messages go straight out while the broker keeps up."""
+        client = FakeClient()
+        publisher = ruuvi_outbound.ConflatingPublisher(client, max_in_flight=2)
+        self.assertIsNotNone(publisher.publish('home/a', '1'))
+        client.written()
+        self.assertIsNotNone(publisher.publish('home/a', '2'))
+        self.assertEqual(client.sent, [('home/a', '1'), ('home/a', '2')])
+        self.assertEqual(publisher.conflated, 0)
+
+    def test_conflates_per_topic_when_behind(self):
+        """Test that only the newest message per topic is kept when behind."""
+        client = FakeClient()
+        publisher = ruuvi_outbound.ConflatingPublisher(client, max_in_flight=1)
+        publisher.publish('home/a', '1')
+        publisher.publish('home/a', '2')
+        publisher.publish('home/b', '1')
+        publisher.publish('home/a', '3')
+
+        self.assertEqual(client.sent, [('home/a', '1')])
+        self.assertEqual(list(publisher.pending), ['home/a', 'home/b'])
+        self.assertEqual(publisher.metrics(),
+                         {'pending': 2, 'in_flight': 1, 'conflated': 1})
+
+        # Capacity frees up: pending messages go out in arrival order
+        client.written()
+        publisher.on_publish(client, None, 1)
+        self.assertEqual(client.sent, [('home/a', '1')])  # Not sent from the callback
+        ruuvi_outbound.flush_due(publisher)
+        self.assertEqual(client.sent, [('home/a', '1'), ('home/a', '3')])
+        client.written()
+        publisher.on_publish(client, None, 2)
+        ruuvi_outbound.flush_due(publisher)
+        self.assertEqual(client.sent[-1], ('home/b', '1'))
+        self.assertEqual(len(publisher.pending), 0)
+
+    def test_holds_latest_while_disconnected(self):
+        """Test that the newest message per topic is delivered after reconnect."""
+        client = FakeClient()
+        client.connected = False
+        publisher = ruuvi_outbound.ConflatingPublisher(client)
+        publisher.publish('home/a', '1')
+        publisher.publish('home/a', '2', retain=True)
+        self.assertEqual(client.sent, [])
+
+        client.connected = True
+        publisher.flush()
+        self.assertEqual(client.sent, [('home/a', '2')])
+
+
+class LockingClient(FakeClient):
+    """QoS 1 client that locks like paho: publish() and the acknowledgement
+    on the network thread share a message lock, and on_publish is called
+    with it held, before the message is marked published."""
+
+    def __init__(self):
+        super().__init__()
+        self.out_message_mutex = threading.Lock()
+        self.on_publish = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self.out_message_mutex:
+            return super().publish(topic, payload, qos, retain)
+
+    def puback(self):
+        with self.out_message_mutex:
+            info = next(info for info in self.infos if not info.is_published())
+            self.on_publish(self, None, len(self.infos))
+            info.is_published.return_value = True
+
+
+class TestConflatingQos1(unittest.TestCase):
+
+    def test_acks_from_network_thread(self):
+        """Test that acks on another thread neither deadlock nor leave messages behind."""
+        client = LockingClient()
+        publisher = ruuvi_outbound.ConflatingPublisher(client, max_in_flight=1)
+        client.on_publish = publisher.on_publish
+        publisher.publish('home/a', '1', qos=1)
+        publisher.publish('home/b', '1', qos=1)
+        publisher.publish('home/c', '1', qos=1)
+
+        for expected in (2, 3):
+            network = threading.Thread(target=client.puback, daemon=True)
+            with publisher.lock:  # The main thread inside publish() while the ack arrives
+                network.start()
+                network.join(timeout=5)
+            self.assertFalse(network.is_alive())
+            ruuvi_outbound.flush_due(publisher)
+            self.assertEqual(len(client.sent), expected)
+
+        self.assertEqual(len(publisher.pending), 0)
+        self.assertEqual(publisher.metrics()['in_flight'], 1)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_round_trip_with_deltas(self):
+        """Test that batches unpack to the original messages."""
+        messages = [
+            ('home/sauna', json.dumps({'temperature': 80.1, 'humidity': 10, 'ts': 1})),
+            ('home/cellar', json.dumps({'temperature': 4.0, 'ts': 1})),
+            ('sauna/temperature', '80.1'),
+            ('home/sauna', json.dumps({'temperature': 80.3, 'humidity': 10, 'ts': 2})),
+            ('home/sauna', json.dumps({'temperature': 80.3, 'ts': 3})),
+        ]
+        payload = ruuvi_outbound.pack_batch('gw', messages)
+
+        gateway, unpacked = ruuvi_outbound.unpack_batch(payload)
+
+        self.assertEqual(gateway, 'gw')
+        self.assertEqual([topic for topic, _ in unpacked], [topic for topic, _ in messages])
+        for (_, original), (_, result) in zip(messages, unpacked):
+            if original.startswith('{'):
+                self.assertEqual(json.loads(result), json.loads(original))
+            else:
+                self.assertEqual(result, original)
+
+    def test_repeated_readings_are_delta_encoded(self):
+        """Test that only changed keys are stored for a repeated topic."""
+        messages = [('home/a', json.dumps({'temperature': 20.0, 'humidity': 40, 'ts': i}))
+                    for i in range(3)]
+        raw = json.loads(gzip.decompress(ruuvi_outbound.pack_batch('gw', messages)))
+        self.assertEqual(raw['messages'][1], {'t': 'home/a', 'd': {'ts': 1}})
+
+    def test_unknown_compression(self):
+        """Test that payloads that are not batches are rejected."""
+        with self.assertRaises(ValueError):
+            ruuvi_outbound.unpack_batch(b'{"v": 1}')
+        with self.assertRaises(ValueError):
+            ruuvi_outbound.BatchingPublisher(MagicMock(), 'gw', compression='lz4')
+
+    def test_malformed_batches(self):
+        """Test that corrupt and malformed batches raise ValueError only."""
+        payloads = [
+            ruuvi_outbound.GZIP_MAGIC + b'\x09corrupt',
+            gzip.compress(b'{"messages": [')[:-4],
+            gzip.compress(b'{"gateway": "gw", "messages": 5}'),
+            gzip.compress(b'["not", "a", "batch"]'),
+            gzip.compress(b'{"gateway": "gw", "messages": [{"p": {}}]}'),
+            gzip.compress(b'{"gateway": "gw", "messages": [{"t": "home/a", "d": {"ts": 1}}]}'),
+            gzip.compress(b'{"gateway": "gw", "messages": ["home/a"]}'),
+        ]
+        for payload in payloads:
+            with self.assertRaises(ValueError):
+                ruuvi_outbound.unpack_batch(payload)
+
+
+class TestBatchingPublisher(unittest.TestCase):
+
+    def test_flushes_on_message_count(self):
+        """Test that a batch is sent when max_messages is reached."""
+        client = MagicMock()
+        publisher = ruuvi_outbound.BatchingPublisher(client, 'gw', max_messages=2,
+                                                     clock=lambda: 0)
+        publisher.publish('home/a', '{"t": 1}')
+        client.publish.assert_not_called()
+        publisher.publish('home/b', '{"t": 2}')
+
+        client.publish.assert_called_once()
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, 'home/_batch/gw')
+        self.assertEqual(len(ruuvi_outbound.unpack_batch(payload)[1]), 2)
+        self.assertEqual(publisher.metrics()['batched_messages'], 2)
+
+    def test_flushes_on_interval(self):
+        """Test that a batch is sent once its oldest message is interval old."""
+        now = [100.0]
+        client = MagicMock()
+        publisher = ruuvi_outbound.BatchingPublisher(client, 'gw', interval=10,
+                                                     clock=lambda: now[0])
+        publisher.publish('home/a', '{"t": 1}')
+        now[0] = 105.0
+        publisher.publish('home/a', '{"t": 2}')
+        client.publish.assert_not_called()
+        now[0] = 110.0
+        publisher.publish('home/a', '{"t": 3}')
+        client.publish.assert_called_once()
+        self.assertEqual(publisher.messages, [])
+
+    def test_flush_due_without_new_messages(self):
+        """Test that a batch goes out after the interval when nothing else arrives."""
+        now = [100.0]
+        client = MagicMock()
+        publisher = ruuvi_outbound.BatchingPublisher(client, 'gw', interval=10,
+                                                     clock=lambda: now[0])
+        publisher.publish('home/a', '{"t": 1}')
+        now[0] = 109.0
+        ruuvi_outbound.flush_due(publisher)
+        client.publish.assert_not_called()
+        now[0] = 110.0
+        ruuvi_outbound.flush_due(publisher)
+        client.publish.assert_called_once()
+        self.assertEqual(publisher.messages, [])
+
+    def test_retained_pass_through(self):
+        """Test that retained messages are not batched."""
+        client = MagicMock()
+        publisher = ruuvi_outbound.BatchingPublisher(client, 'gw')
+        publisher.publish('home/a/availability', 'online', retain=True)
+        client.publish.assert_called_once_with('home/a/availability', 'online',
+                                               qos=0, retain=True)
+        self.assertEqual(publisher.messages, [])
+
+
+
+class TestWrap(unittest.TestCase):
+
+    def test_wrap_unwrap_close(self):
+        """Test that broker options stack the publishers and close flushes the batch."""
+        client = MagicMock()
+        publisher = ruuvi_outbound.wrap(client, {'conflate': True, 'batch': {'interval': 60}},
+                                        'testhost')
+        self.assertIsInstance(publisher, ruuvi_outbound.BatchingPublisher)
+        self.assertIsInstance(publisher.client, ruuvi_outbound.ConflatingPublisher)
+        self.assertIs(ruuvi_outbound.unwrap(publisher), client)
+        self.assertIs(ruuvi_outbound.wrap(client, {}, 'testhost'), client)
+        publisher.publish('home/sauna', '{}')
+        ruuvi_outbound.close(publisher)
+        self.assertEqual(client.publish.call_args[0][0], 'home/_batch/testhost')
+        client.disconnect.assert_called_once()
+        client.loop_stop.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import asyncio
+import unittest
+import ruuvi_probe
+
+SAUNA = 'AA:BB:CC:DD:EE:FF'
+ATTIC = '11:22:33:44:55:66'
+
+
+class FakeScan:
+    """Async source yielding fixed packets, then waiting forever."""
+
+    def __init__(self, packets):
+        self.packets = list(packets)
+        self.closed = False
+        self.yielded = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.packets:
+            await asyncio.sleep(3600)
+        self.yielded += 1
+        return self.packets.pop(0)
+
+    async def aclose(self):
+        self.closed = True
+
+
+class TestProbe(unittest.TestCase):
+
+    def test_stops_when_all_seen(self):
+        """Test that the scan ends at the last wanted tag and keeps first packets."""
+        now = [0.0]
+
+        def clock():
+            now[0] += 0.5
+            return now[0]
+
+        scan = FakeScan([
+            ('aa:bb:cc:dd:ee:ff', {'rssi': -60, 'temperature': 21.0}),
+            ('F2:00:00:00:00:01', {'rssi': -90}),
+            (SAUNA, {'rssi': -50, 'temperature': 22.0}),
+            (ATTIC, {'rssi': -70, 'temperature': 5.0}),
+            (SAUNA, {'rssi': -40}),
+        ])
+        found = asyncio.run(ruuvi_probe.probe([SAUNA, ATTIC], scan, timeout=5, clock=clock))
+        self.assertEqual(set(found), {SAUNA, ATTIC})
+        self.assertEqual(found[SAUNA]['rssi'], -60)
+        self.assertEqual(found[SAUNA]['data']['temperature'], 21.0)
+        self.assertEqual(found[SAUNA]['first_packet_s'], 0.5)
+        self.assertEqual(scan.yielded, 4)
+        self.assertTrue(scan.closed)
+
+    def test_timeout_reports_missing(self):
+        """Test that missing tags are reported after the timeout."""
+        scan = FakeScan([(SAUNA, {'rssi': -60})])
+        found = asyncio.run(ruuvi_probe.probe([SAUNA, ATTIC], scan, timeout=0.05))
+        result = ruuvi_probe.report([SAUNA, ATTIC], found, {SAUNA: 'sauna'}, 0.05)
+        self.assertEqual(result['found'][SAUNA]['room'], 'sauna')
+        self.assertEqual(result['missing'], [ATTIC])
+        self.assertEqual(result['elapsed_s'], 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
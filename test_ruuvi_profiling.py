@@ -0,0 +1,125 @@
+import json
+import os
+import signal
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import ruuvi_profiling
+
+
+class TestStageTimers(unittest.TestCase):
+
+    def test_disabled_timers_record_nothing(self):
+        """Test that stage() is a no-op while timers are disabled."""
+        timers = ruuvi_profiling.StageTimers()
+        with timers.stage("publish"):
+            pass
+        self.assertEqual(timers.stats, {})
+
+    def test_summary(self):
+        """Test that the summary aggregates count, mean and max."""
+        timers = ruuvi_profiling.StageTimers()
+        timers.add("publish", 0.001)
+        timers.add("publish", 0.003)
+        summary = timers.summary()["publish"]
+        self.assertEqual(summary["count"], 2)
+        self.assertAlmostEqual(summary["mean_ms"], 2.0)
+        self.assertAlmostEqual(summary["max_ms"], 3.0)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.now = [0.0]
+        self.profiler = ruuvi_profiling.Profiler(
+            self.tmpdir.name, "test", clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch('ruuvi_profiling.logging')
+    def test_request_rejects_unknown_commands(self, mock_logging):
+        """Test that unknown commands and durations are rejected."""
+        self.assertFalse(self.profiler.request("disk 10"))
+        self.assertFalse(self.profiler.request("cpu ten"))
+        self.assertTrue(self.profiler.request("cpu 10"))
+
+    @patch('ruuvi_profiling.logging')
+    def test_timers_session_dumps_results(self, mock_logging):
+        """Test that a timers session runs for its duration and dumps JSON."""
+        self.profiler.request("timers 5")
+        self.profiler.poll()
+        self.assertTrue(self.profiler.timers.enabled)
+        with self.profiler.timers.stage("serialize"):
+            pass
+
+        self.now[0] = 6.0
+        self.profiler.poll()
+
+        self.assertFalse(self.profiler.timers.enabled)
+        files = os.listdir(self.tmpdir.name)
+        self.assertEqual(len(files), 1)
+        with open(os.path.join(self.tmpdir.name, files[0]), encoding="utf-8") as handle:
+            self.assertEqual(json.load(handle)["serialize"]["count"], 1)
+
+    @patch('ruuvi_profiling.logging')
+    def test_cpu_and_memory_sessions_dump_results(self, mock_logging):
+        """Test that cpu and memory sessions write their reports."""
+        self.profiler.request("cpu 1")
+        self.profiler.request("memory 1")
+        self.profiler.poll()
+        self.now[0] = 2.0
+        self.profiler.poll()
+
+        suffixes = sorted(name.split("-")[1] + os.path.splitext(name)[1]
+                          for name in os.listdir(self.tmpdir.name))
+        self.assertEqual(suffixes, ["cpu.pstats", "cpu.txt", "memory.txt"])
+
+    @patch('ruuvi_profiling.logging')
+    def test_failed_sessions_are_dropped(self, mock_logging):
+        """Test that sessions failing to start or dump are logged and cleared."""
+        self.profiler.output_dir = os.path.join(self.tmpdir.name, 'missing')
+        self.profiler.request("cpu 1")
+        self.profiler.request("timers 1")
+        self.profiler.poll()
+        self.now[0] = 2.0
+        self.profiler.poll()
+        self.assertIsNone(self.profiler._cpu_profile)  # pylint: disable=protected-access
+        self.assertFalse(self.profiler.timers.enabled)
+        self.assertEqual(self.profiler.deadlines, {})
+        self.assertEqual(mock_logging.error.call_count, 2)
+
+        with patch('cProfile.Profile.enable', side_effect=ValueError("active")):
+            self.profiler.request("cpu 1")
+            self.profiler.poll()
+        self.assertNotIn("cpu", self.profiler.deadlines)
+        self.assertIsNone(self.profiler._cpu_profile)  # pylint: disable=protected-access
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestSignals(unittest.TestCase):
+
+    @patch('ruuvi_profiling.signal.signal')
+    def test_signals_request_profiling(self, mock_signal):
+        """Test that SIGUSR1 requests cpu and SIGUSR2 memory and timers profiling."""
+        profiler = MagicMock()
+        ruuvi_profiling.install_signals(profiler)
+        handlers = dict(call[0] for call in mock_signal.call_args_list)
+        handlers[signal.SIGUSR1](signal.SIGUSR1, None)
+        handlers[signal.SIGUSR2](signal.SIGUSR2, None)
+        self.assertEqual([call[0][0] for call in profiler.request.call_args_list],
+                         ['cpu', 'memory', 'timers'])
+
+    @patch('ruuvi_profiling.os.kill')
+    @patch('ruuvi_profiling.signal.signal')
+    def test_signals_forwarded_to_processes(self, mock_signal, mock_kill):
+        """Test that SIGUSR1 and SIGUSR2 are passed on to the publisher processes."""
+        publisher = MagicMock(pid=1234)
+        ruuvi_profiling.install_signals(MagicMock(), {'local': publisher})
+        handler = dict(call[0] for call in mock_signal.call_args_list)[signal.SIGUSR1]
+        handler(signal.SIGUSR1, None)
+        mock_kill.assert_called_once_with(1234, signal.SIGUSR1)
@@ -0,0 +1,97 @@
+import datetime
+import json
+import threading
+import unittest
+import ruuvi_reading
+
+SAUNA = 'AA:BB:CC:DD:EE:FF'
+
+
+class TestReading(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'data_format': 5, 'temperature': 80.5, 'humidity': 10.0,
+                     'rssi': -70, 'mac': 'aabbccddeeff'}
+        self.reading = ruuvi_reading.Reading(SAUNA, self.data, 1.0, 1700000000.25)
+        self.reading.room = 'sauna'
+        self.reading.client = 'gw'
+
+    def test_payload_matches_dict(self):
+        """Test that the payload holds the decoded data and the gateway fields."""
+        payload = json.loads(self.reading.payload())
+        self.assertEqual(payload, self.reading.as_dict())
+        self.assertEqual(payload['room'], 'sauna')
+        self.assertEqual(payload['client'], 'gw')
+        self.assertEqual(payload['ts'], 1700000000.25)
+        self.assertEqual(payload['ts_iso'], '2023-11-14T22:13:20.250000+00:00')
+        self.assertEqual(payload['rssi_gw'], -70)
+
+    def test_decoded_data_not_extended(self):
+        """Test that the decoded dict is not extended with the gateway fields."""
+        self.reading.payload()
+        self.reading.as_dict()
+        self.assertNotIn('room', self.data)
+        self.assertNotIn('ts_iso', self.data)
+
+    def test_extra_fields(self):
+        """Test that added fields are serialized and invalidate the cached dict."""
+        self.assertNotIn('latency_ms', self.reading.as_dict())
+        self.reading.add('latency_ms', 1.5)
+        self.assertEqual(json.loads(self.reading.payload())['latency_ms'], 1.5)
+        self.assertEqual(self.reading.as_dict()['latency_ms'], 1.5)
+
+    def test_payload_escapes_values(self):
+        """Test that quotes in values and rooms stay valid JSON."""
+        reading = ruuvi_reading.Reading(SAUNA, {'name': "Bob's \"tag\""}, 1.0, 1700000000.0)
+        reading.room = 'Bob\'s "room"'
+        reading.client = 'gw'
+        payload = json.loads(reading.payload())
+        self.assertEqual(payload['name'], "Bob's \"tag\"")
+        self.assertEqual(payload['room'], 'Bob\'s "room"')
+        self.assertIsNone(payload['rssi_gw'])
+
+    def test_iso_time(self):
+        """Test that iso_time() matches datetime.isoformat()."""
+        for timestamp in (1700000000.0, 1700000000.5, 1700000001.000001, 1700000001.999999):
+            expected = datetime.datetime.fromtimestamp(
+                timestamp, tz=datetime.timezone.utc).isoformat()
+            self.assertEqual(ruuvi_reading.iso_time(timestamp), expected)
+
+    def test_iso_time_threads(self):
+        """Test that iso_time() stays consistent when threads change the cached second."""
+        errors = []
+
+        def format_times(base):
+            for offset in range(2000):
+                timestamp = base + offset % 7 + 0.5
+                expected = datetime.datetime.fromtimestamp(
+                    timestamp, tz=datetime.timezone.utc).isoformat()
+                if ruuvi_reading.iso_time(timestamp) != expected:
+                    errors.append(timestamp)
+
+        threads = [threading.Thread(target=format_times, args=(1700000000 + index * 10,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_from_found(self):
+        """Test that tuples are wrapped and readings passed through."""
+        self.assertIs(ruuvi_reading.from_found(self.reading), self.reading)
+        reading = ruuvi_reading.from_found((SAUNA, self.data), 2.0)
+        self.assertEqual((reading.mac, reading.data, reading.received), (SAUNA, self.data, 2.0))
+        self.assertEqual(reading.now.tzinfo, datetime.timezone.utc)
+
+    def test_benchmark(self):
+        """Test that the benchmark reports both variants."""
+        results = ruuvi_reading.benchmark(count=100, tags=5, backlog=20)
+        self.assertEqual(set(results), {'dict', 'reading'})
+        for result in results.values():
+            self.assertGreater(result['us_per_packet'], 0)
+            self.assertGreater(result['bytes_per_queued_reading'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import copy
+import multiprocessing
+import unittest
+from unittest.mock import patch, MagicMock
+import ruuvi_shm
+
+MAC = 'AA:BB:CC:DD:EE:FF'
+DF5 = {
+    'data_format': 5, 'humidity': 51.87, 'temperature': 15.71, 'pressure': 1006.41,
+    'acceleration': 984.0777408314854, 'acceleration_x': -12, 'acceleration_y': -3,
+    'acceleration_z': 984, 'tx_power': 4, 'battery': 2986, 'movement_counter': 0,
+    'measurement_sequence_number': 18499, 'mac': 'aabbccddeeff', 'rssi': -83,
+}
+
+
+class TestReadingRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = ruuvi_shm.ReadingRing(slots=4)
+        self.addCleanup(self.ring.close, unlink=True)
+
+    def test_round_trip(self):
+        """Test that a data format 5 reading comes back with the same values and types."""
+        self.ring.put(MAC, DF5, 12.5)
+        mac, data, received = self.ring.get()[0]
+        self.assertEqual((mac, received), (MAC, 12.5))
+        self.assertEqual(data, DF5)
+        self.assertIsInstance(data['battery'], int)
+        self.assertEqual(self.ring.get(), [])
+
+    def test_e1_fields(self):
+        """Test that string data formats, booleans and missing values survive."""
+        self.ring.put(MAC, {'data_format': 'E1', 'co2': 410.0, 'pm_2_5': None,
+                            'calibration_in_progress': False}, 0.0)
+        self.assertEqual(self.ring.get()[0][1], {'data_format': 'E1', 'co2': 410.0,
+                                                 'calibration_in_progress': False})
+
+    def test_slow_reader_drops_oldest(self):
+        """Test that a reader more than a ring behind skips to the oldest record."""
+        for seq in range(6):
+            self.ring.put(MAC, {'measurement_sequence_number': seq}, float(seq))
+        readings = self.ring.get()
+        self.assertEqual([data['measurement_sequence_number'] for _, data, _ in readings],
+                         [2, 3, 4, 5])
+        self.assertEqual(self.ring.metrics(), {'written': 6, 'behind': 0, 'dropped': 2})
+
+    def test_readers_have_own_cursor(self):
+        """Test that every reader sees every reading, limited per call."""
+        other = copy.copy(self.ring)
+        self.ring.put(MAC, {'rssi': -50}, 0.0)
+        self.ring.put(MAC, {'rssi': -51}, 0.0)
+        self.assertEqual(len(self.ring.get(limit=1)), 1)
+        self.assertEqual(len(self.ring.get()), 1)
+        self.assertEqual(len(other.get()), 2)
+
+    def test_across_processes(self):
+        """Test that a forked process reads what the parent writes."""
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+
+        def reader():
+            readings = []
+            while len(readings) < 3:
+                readings += self.ring.get()
+            queue.put([data['rssi'] for _, data, _ in readings])
+
+        process = context.Process(target=reader)
+        process.start()
+        for rssi in (-50, -60, -70):
+            self.ring.put(MAC, {'rssi': rssi}, 0.0)
+        self.assertEqual(queue.get(timeout=5), [-50, -60, -70])
+        process.join(5)
+
+
+
+class TestConsume(unittest.TestCase):
+
+    @patch('ruuvi_shm.os.getppid', return_value=2)
+    def test_consume_until_parent_exits(self, mock_getppid):
+        """Test that consume() handles the ring and stops when the capture process is gone."""
+        ring = ruuvi_shm.ReadingRing(slots=4)
+        self.addCleanup(ring.close, unlink=True)
+        ring.put(MAC, {'data_format': 5, 'humidity': 40.0}, 2.0)
+        handle, tick = MagicMock(), MagicMock()
+        asyncio.run(ruuvi_shm.consume(ring, handle, tick, parent=1))
+        handle.assert_called_once_with((MAC, {'data_format': 5, 'humidity': 40.0}), 2.0)
+        self.assertEqual([call.args for call in tick.call_args_list], [(False,), (True,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
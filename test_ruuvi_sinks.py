@@ -0,0 +1,169 @@
+import http.client
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import ruuvi_reading
+import ruuvi_sinks
+
+
+class ListSink(ruuvi_sinks.Sink):
+    """Sink collecting sent batches, failing the first `failures` sends."""
+
+    def __init__(self, failures=0, **options):
+        super().__init__("list", retry_delay=0, **options)
+        self.failures = failures
+        self.batches = []
+
+    def format(self, reading):
+        return reading["value"]
+
+    def send(self, lines):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("down")
+        self.batches.append(lines)
+
+
+class TestSink(unittest.TestCase):
+
+    def test_batches_and_flushes_on_close(self):
+        """Test that readings are sent in batches and the rest on close."""
+        sink = ListSink(batch_size=2, flush_interval=60)
+        sink.start()
+        for value in range(5):
+            sink.submit({"value": value})
+        sink.close()
+        self.assertEqual(sink.batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(sink.metrics()["sent"], 5)
+
+    def test_retries_then_gives_up(self):
+        """Test that failed batches are retried and then counted as failed."""
+        sink = ListSink(failures=1, retries=1)
+        self.assertTrue(sink.flush([{"value": 1}]))
+        self.assertEqual(sink.batches, [[1]])
+
+        sink = ListSink(failures=5, retries=2)
+        self.assertFalse(sink.flush([{"value": 1}]))
+        self.assertEqual(sink.metrics()["failed"], 1)
+
+    def test_full_queue_drops(self):
+        """Test that submit never blocks and counts dropped readings."""
+        sink = ListSink(queue_size=1)
+        self.assertTrue(sink.submit({"value": 1}))
+        self.assertFalse(sink.submit({"value": 2}))
+        self.assertEqual(sink.metrics()["dropped"], 1)
+
+    @patch('ruuvi_sinks.logging')
+    def test_format_errors_skip_readings(self, mock_logging):
+        """Test that a reading that cannot be formatted is skipped and counted."""
+        sink = ListSink()
+        self.assertTrue(sink.flush([{"value": 1}, {"other": 2}, {"value": 3}]))
+        self.assertEqual(sink.batches, [[1, 3]])
+        self.assertEqual(sink.metrics()["failed"], 1)
+
+    @patch('ruuvi_sinks.logging')
+    def test_http_errors_are_send_failures(self, mock_logging):
+        """Test that HTTP protocol errors are retried like OSError."""
+        sink = ListSink(retries=1)
+        sink.send = MagicMock(side_effect=[http.client.IncompleteRead(b""), None])
+        self.assertTrue(sink.flush([{"value": 1}]))
+        self.assertEqual(sink.send.call_count, 2)
+
+    @patch('ruuvi_sinks.logging')
+    def test_worker_survives_unexpected_errors(self, mock_logging):
+        """Test that the worker keeps running after a flush raises."""
+        sink = ListSink(batch_size=1)
+        sink.send = MagicMock(side_effect=[RuntimeError("bug"), None])
+        sink.start()
+        sink.submit({"value": 1})
+        sink.submit({"value": 2})
+        sink.close()
+        self.assertEqual(sink.send.call_count, 2)
+        self.assertEqual(sink.metrics()["failed"], 1)
+        self.assertEqual(sink.metrics()["sent"], 1)
+
+    def test_abstract(self):
+        """Test that a sink must implement format() and send()."""
+        with self.assertRaises(TypeError):
+            ruuvi_sinks.Sink("incomplete")  # pylint: disable=abstract-class-instantiated
+
+    def test_formats_reading_records(self):
+        """Test that queued readings are turned into dicts when flushed."""
+        sink = ListSink()
+        reading = ruuvi_reading.Reading("AA:BB:CC:DD:EE:FF", {"rssi": -60}, 1.0, 1700000000.0)
+        reading.add("value", 3)
+        self.assertTrue(sink.flush([reading, {"value": 4}]))
+        self.assertEqual(sink.batches, [[3, 4]])
+
+
+class TestLineProtocol(unittest.TestCase):
+
+    def test_line(self):
+        """Test tags, field types, escaping and the timestamp."""
+        line = ruuvi_sinks.line_protocol({
+            "room": "living room", "mac": "AA:BB", "client": "pi",
+            "temperature": 21.5, "movement_counter": 3, "data_format": 5,
+            "ts": 1700000000.5, "ts_iso": "2023-11-14T22:13:20", "note": 'a "b"',
+            "acceleration": None,
+        })
+        self.assertEqual(
+            line,
+            'ruuvi,room=living\\ room,mac=AA:BB,client=pi temperature=21.5,'
+            'movement_counter=3i,data_format=5i,note="a \\"b\\"" 1700000000500000000'
+        )
+
+    def test_no_fields(self):
+        """Test that readings without fields give no line."""
+        self.assertIsNone(ruuvi_sinks.line_protocol({"room": "x"}))
+
+
+class TestInfluxSink(unittest.TestCase):
+
+    @patch('ruuvi_sinks.socket.socket')
+    def test_udp_splits_datagrams(self, mock_socket):
+        """Test that UDP batches are split to fit in datagrams."""
+        sink = ruuvi_sinks.InfluxSink("influx", "udp://influx.local:8089")
+        line = "ruuvi " + "x" * 600
+        sink.send([line, line, line])
+        sock = mock_socket.return_value.__enter__.return_value
+        self.assertEqual(sock.sendto.call_count, 2)
+        self.assertEqual(sock.sendto.call_args[0][1], ("influx.local", 8089))
+
+    @patch('ruuvi_sinks.urllib.request.urlopen')
+    def test_http_write(self, mock_urlopen):
+        """Test that HTTP batches are posted with the token."""
+        sink = ruuvi_sinks.InfluxSink("influx", "http://influx:8086/api/v2/write?bucket=b",
+                                      token="secret")
+        sink.send(["a b=1", None, "a b=2"])
+        request = mock_urlopen.call_args[0][0]
+        self.assertEqual(request.data, b"a b=1\na b=2")
+        self.assertEqual(request.get_header("Authorization"), "Token secret")
+
+    def test_bad_url(self):
+        """Test that unsupported urls are rejected."""
+        with self.assertRaises(ValueError):
+            ruuvi_sinks.InfluxSink("influx", "tcp://influx:8086")
+
+
+class TestCreateSinks(unittest.TestCase):
+
+    def test_create_and_write_file(self):
+        """Test creating a file sink from settings and writing to it."""
+        with tempfile.TemporaryDirectory() as data_dir:
+            sinks = ruuvi_sinks.create_sinks(
+                [{"type": "file", "path": "readings.jsonl"}], data_dir
+            )
+            sinks[0].flush([{"room": "sauna", "temperature": 80}])
+            with open(os.path.join(data_dir, "readings.jsonl"), encoding="utf-8") as handle:
+                self.assertEqual(json.loads(handle.readline())["room"], "sauna")
+
+    def test_unknown_type(self):
+        """Test that unknown sink types are rejected."""
+        with self.assertRaises(ValueError):
+            ruuvi_sinks.create_sinks([{"type": "kafka"}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import unittest
+import ruuvi_snapshot
+
+SAUNA = 'AA:BB:CC:DD:EE:FF'
+
+
+class TestSnapshotTable(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.table = ruuvi_snapshot.SnapshotTable('gw', interval=60, debounce=10,
+                                                  clock=lambda: self.now)
+
+    def test_compact_entries(self):
+        """Test that entries hold only the selected fields of the latest reading."""
+        self.table.update('sauna', SAUNA, {'temperature': 80.5, 'humidity': 10.0,
+                                           'acceleration_x': 4, 'rssi': -70}, 1700000000.7)
+        snapshot = json.loads(self.table.payload())
+        self.assertEqual(snapshot['gateway'], 'gw')
+        self.assertEqual(snapshot['tags'], {'sauna': {
+            'mac': SAUNA, 'ts': 1700000000, 'temperature': 80.5, 'humidity': 10.0, 'rssi': -70,
+        }})
+
+    def test_due_debounced_on_change(self):
+        """Test that changes are published after the debounce and RSSI alone waits."""
+        self.assertFalse(self.table.due())
+        self.table.update('sauna', SAUNA, {'temperature': 80.0}, 0)
+        self.assertTrue(self.table.due())
+        self.table.payload()
+
+        self.now = 20.0
+        self.table.update('sauna', SAUNA, {'temperature': 80.0, 'rssi': -60}, 20)
+        self.assertFalse(self.table.due())
+        self.table.update('sauna', SAUNA, {'temperature': 81.0}, 20)
+        self.assertTrue(self.table.due())
+        self.table.payload()
+
+        self.now = 25.0
+        self.table.remove('sauna')
+        self.assertFalse(self.table.due())
+        self.now = 30.0
+        self.assertTrue(self.table.due())
+        self.assertEqual(json.loads(self.table.payload())['tags'], {})
+
+    def test_due_every_interval(self):
+        """Test that an unchanged snapshot is republished every interval."""
+        self.table.update('sauna', SAUNA, {'temperature': 80.0}, 0)
+        self.table.payload()
+        self.now = 59.0
+        self.assertFalse(self.table.due())
+        self.now = 60.0
+        self.assertTrue(self.table.due())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+import ruuvi_tags
+
+
+class TestInterval(unittest.TestCase):
+
+    def test_due(self):
+        """Test that a task is due once per interval, the first time only if asked."""
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        later = start + datetime.timedelta(seconds=60)
+        interval = ruuvi_tags.Interval(60)
+        self.assertFalse(interval.due(start))
+        self.assertFalse(interval.due(later - datetime.timedelta(seconds=1)))
+        self.assertTrue(interval.due(later))
+        self.assertFalse(interval.due(later))
+        self.assertTrue(ruuvi_tags.Interval(60, first=True).due(start))
+        self.assertFalse(ruuvi_tags.Interval(0, first=True).due(start))
+
+
+class TestStalenessTracker(unittest.TestCase):
+
+    def test_touch_reports_new_tags(self):
+        """Test that touch() returns True only when a tag comes online."""
+        tracker = ruuvi_tags.StalenessTracker(10)
+        self.assertTrue(tracker.touch('a', now=0))
+        self.assertFalse(tracker.touch('a', now=5))
+        self.assertIn('a', tracker)
+
+    def test_expire_after_timeout(self):
+        """Test that tags expire only after the timeout since last seen."""
+        tracker = ruuvi_tags.StalenessTracker(10)
+        tracker.touch('a', now=0)
+        tracker.touch('b', now=0)
+        tracker.touch('a', now=8)
+
+        self.assertEqual(tracker.expire(now=12), ['b'])
+        self.assertEqual(tracker.expire(now=17), [])
+        self.assertEqual(tracker.expire(now=18), ['a'])
+        self.assertEqual(len(tracker), 0)
+
+    def test_expire_only_pops_due_entries(self):
+        """Test that expire() leaves entries that are not due untouched."""
+        tracker = ruuvi_tags.StalenessTracker(10)
+        for i in range(1000):
+            tracker.touch(i, now=i)
+        self.assertEqual(tracker.expire(now=12), [0, 1, 2])
+        self.assertEqual(len(tracker.heap), 997)
+
+    def test_resends(self):
+        """Test that resends() returns each queued target once."""
+        tracker = ruuvi_tags.StalenessTracker(10)
+        tracker.request_resend('broker1', 'broker2')
+        tracker.request_resend('broker1')
+        self.assertEqual(sorted(tracker.resends()), ['broker1', 'broker2'])
+        self.assertEqual(tracker.resends(), [])
+
+    def test_removed_tag_comes_back(self):
+        """Test that a removed tag is scheduled again when seen."""
+        tracker = ruuvi_tags.StalenessTracker(10)
+        tracker.touch('a', now=0)
+        tracker.remove('a')
+        self.assertEqual(tracker.expire(now=20), [])
+        self.assertTrue(tracker.touch('a', now=20))
+        self.assertEqual(tracker.expire(now=30), ['a'])
+
+
+
+class TestTagRegistry(unittest.TestCase):
+
+    def test_configured_tags_are_never_evicted(self):
+        """Test that only unconfigured tags are evicted."""
+        registry = ruuvi_tags.TagRegistry(capacity=0, ttl=10)
+        registry.touch('AA', 'sauna', True, now=0)
+        registry.touch('BB', 'Ruuvi-BB', False, now=0)
+        evicted = registry.evict(now=100)
+        self.assertEqual([record.mac for record in evicted], ['BB'])
+        self.assertIsNotNone(registry.get('AA'))
+        self.assertEqual(len(registry), 1)
+
+    def test_moved_tag_keeps_room_current(self):
+        """Test that a configured tag moved twice is recorded in its latest room."""
+        registry = ruuvi_tags.TagRegistry()
+        registry.touch('AA', 'kitchen', True, now=0)
+        registry.touch('AA', 'sauna', True, now=1)
+        self.assertEqual(registry.get('AA').room, 'sauna')
+        registry.touch('AA', 'attic', True, now=2)
+        self.assertEqual(registry.get('AA').room, 'attic')
+
+    def test_lru_eviction_over_capacity(self):
+        """Test that the least recently seen tags are evicted first."""
+        registry = ruuvi_tags.TagRegistry(capacity=2, ttl=3600)
+        registry.touch('A', 'Ruuvi-A', False, now=0)
+        registry.touch('B', 'Ruuvi-B', False, now=1)
+        registry.touch('A', 'Ruuvi-A', False, now=2)
+        registry.touch('C', 'Ruuvi-C', False, now=3)
+        evicted = registry.evict(now=3)
+        self.assertEqual([record.mac for record in evicted], ['B'])
+        self.assertEqual(list(registry.transient), ['A', 'C'])
+
+    def test_ttl_eviction(self):
+        """Test that tags not seen within the ttl are evicted."""
+        registry = ruuvi_tags.TagRegistry(capacity=10, ttl=60)
+        registry.touch('A', 'Ruuvi-A', False, now=0)
+        registry.touch('B', 'Ruuvi-B', False, now=30)
+        self.assertEqual(registry.evict(now=59), [])
+        self.assertEqual([record.mac for record in registry.evict(now=61)], ['A'])
+
+    def test_tag_becomes_configured(self):
+        """Test that a tag added to my_ruuvis keeps its record."""
+        registry = ruuvi_tags.TagRegistry(capacity=10, ttl=60)
+        first = registry.touch('A', 'Ruuvi-A', False, now=0)
+        record = registry.touch('A', 'sauna', True, now=5)
+        self.assertIs(record, first)
+        self.assertEqual(record.room, 'sauna')
+        self.assertEqual(record.first_seen, 0)
+        self.assertNotIn('A', registry.transient)
+
+
+    def test_save_unknown_only_when_changed(self):
+        """Test that unknown tags are written with statistics when changed."""
+        registry = ruuvi_tags.TagRegistry(capacity=10, ttl=60)
+        registry.touch('A', 'sauna', True, rssi=-50)
+        registry.touch('B', 'Ruuvi-B', False, rssi=-90)
+        registry.touch('B', 'Ruuvi-B', False, rssi=-70)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'detected.json')
+            self.assertTrue(registry.save_unknown(path))
+            self.assertFalse(registry.save_unknown(path))
+            with open(path, encoding='utf-8') as handle:
+                detected = json.load(handle)
+            self.assertEqual(os.listdir(tmpdir), ['detected.json'])
+        self.assertEqual([tag['mac'] for tag in detected], ['B'])
+        self.assertEqual(detected[0]['best_rssi'], -70)
+        self.assertEqual(detected[0]['packets'], 2)
+
+
+class TestLinkStats(unittest.TestCase):
+
+    def test_loss_and_gaps(self):
+        """Test received vs. expected packets and the gap histogram."""
+        link = ruuvi_tags.LinkStats()
+        for seq in (10, 11, 11, 13, 17, 18):
+            link.add(seq, rssi=-70)
+        stats = link.snapshot()
+        self.assertEqual(stats['link_received'], 5)
+        self.assertEqual(stats['link_expected'], 9)
+        self.assertEqual(stats['link_loss'], 44.4)
+        self.assertEqual(stats['link_duplicates'], 1)
+        self.assertEqual(stats['link_gaps'], {'1': 2, '2': 1, '3-4': 1, '5-8': 0,
+                                              '9-16': 0, '17+': 0})
+
+        # Counters restart after a snapshot, across the sequence wraparound
+        link.last_seq = 65535
+        link.add(0)
+        stats = link.snapshot()
+        self.assertEqual((stats['link_received'], stats['link_expected']), (1, 1))
+
+    def test_restart_is_not_loss(self):
+        """Test that a large jump in the sequence counts as a tag restart."""
+        link = ruuvi_tags.LinkStats()
+        link.add(40000)
+        link.add(5)
+        self.assertEqual(link.snapshot()['link_loss'], 0.0)
+
+    def test_link_loss_needs_expected_packets(self):
+        """Test that the loss is left out until two packets were compared."""
+        link = ruuvi_tags.LinkStats()
+        link.add(7, rssi=-70)
+        self.assertNotIn('link_loss', link.snapshot())
+
+    def test_rssi_ring(self):
+        """Test RSSI mean and percentiles over the latest window packets."""
+        link = ruuvi_tags.LinkStats(window=4)
+        for seq, rssi in enumerate((-100, -100, -80, -70, -60, -50)):
+            link.add(seq, rssi)
+        stats = link.snapshot()
+        self.assertEqual(stats['link_rssi_mean'], -65.0)
+        self.assertEqual(stats['link_rssi_p10'], -80)
+        self.assertEqual(stats['link_rssi_p90'], -50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import gzip
+import unittest
+from unittest.mock import MagicMock, patch
+import ruuvi_outbound
+import ruuvi_unbatch
+
+
+class TestRepublish(unittest.TestCase):
+
+    @patch('ruuvi_unbatch.logging')
+    def test_republishes_messages(self, mock_logging):
+        """Test that the messages of a batch go to their own topics."""
+        client = MagicMock()
+        payload = ruuvi_outbound.pack_batch('gw', [('home/sauna', '{"temperature": 80.1}')])
+        self.assertEqual(ruuvi_unbatch.republish(client, payload), 1)
+        client.publish.assert_called_once_with('home/sauna', '{"temperature": 80.1}')
+
+    @patch('ruuvi_unbatch.logging')
+    def test_malformed_batch_is_skipped(self, mock_logging):
+        """Test that a malformed batch is logged and does not stop the consumer."""
+        client = MagicMock()
+        for payload in (b'\x1f\x8b\x09corrupt', gzip.compress(b'{"gateway": "gw"}')):
+            self.assertEqual(ruuvi_unbatch.republish(client, payload), 0)
+        client.publish.assert_not_called()
+        self.assertEqual(mock_logging.warning.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
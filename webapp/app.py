@@ -7,6 +7,8 @@ Ruuvi2MQTT Web Configuration Interface
 A Flask web application for configuring RuuviTag MQTT gateway settings.
 """
 
+import copy
+import datetime
 import json
 import os
 import sys
@@ -15,11 +17,16 @@ import threading
 import time
 
 from flask import Flask, render_template, request, jsonify
+from paho.mqtt import publish as mqtt_publish
+from paho.mqtt import MQTTException
 from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
 
-# Add parent directory to path to import settings
+# Add parent directory to path to import the shared config loader
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import ruuvi_config  # pylint: disable=wrong-import-position
+import ruuvi_fleet  # pylint: disable=wrong-import-position
+
 def get_version():
     """Get version from VERSION file."""
     try:
@@ -33,9 +40,16 @@ __version__ = get_version()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+# Static URLs carry the version (see index.html), so browsers may keep them for a year
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 365 * 24 * 3600
 
+# Written when the gateway has no configuration file yet
 SETTINGS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.py')
 SETTINGS_EXAMPLE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.py.example')
+# Unconfigured tags written by the gateway to its data directory
+DETECTED_FILE = 'detected_ruuvis.json'
+# Parsed settings per file, reused while the file version is unchanged
+SETTINGS_CACHE = {}  # path -> (version, settings)
 
 
 class MQTTListener(ServiceListener):
@@ -155,49 +169,123 @@ def scan_mqtt_brokers(timeout=5):  # pylint: disable=too-many-locals
     return unique_brokers
 
 
+def config_file():
+    """Return the configuration file the gateway reads, or None."""
+    try:
+        return ruuvi_config.find()
+    except ruuvi_config.ConfigError:
+        return None
+
+
+def settings_path():
+    """Return the gateway's configuration file, or the example if there is none."""
+    return config_file() or SETTINGS_EXAMPLE
+
+
+def settings_version(path):
+    """Return the version of a settings file: modification time and size.
+
+    Returns:
+        tuple: (st_mtime_ns, st_size), or None if the file doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
 def load_settings():
-    """Load current settings from settings.py file."""
+    """Load current settings from the configuration file.
+
+    The file is parsed again only when its version has changed.
+    """
     settings = {
         'brokers': {},
         'ruuvis': {}
     }
-
-    if os.path.exists(SETTINGS_FILE):
+    path = settings_path()
+    version = settings_version(path)
+    if version is None:
+        return settings
+    cached = SETTINGS_CACHE.get(path)
+    if cached is None or cached[0] != version:
         try:
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                content = f.read()
-                # Execute the settings file to get the dictionaries
-                exec_globals = {}
-                exec(content, exec_globals)  # pylint: disable=exec-used
-                settings['brokers'] = exec_globals.get('my_brokers', {})
-                settings['ruuvis'] = exec_globals.get('my_ruuvis', {})
-        except (OSError, SyntaxError) as exc:
+            values = ruuvi_config.read(path)
+            settings['brokers'] = values.get('my_brokers', {})
+            settings['ruuvis'] = values.get('my_ruuvis', {})
+        except ruuvi_config.ConfigError as exc:
             print(f"Error loading settings: {exc}")
-    elif os.path.exists(SETTINGS_EXAMPLE):
-        # If settings.py doesn't exist, load from example
-        try:
-            with open(SETTINGS_EXAMPLE, 'r', encoding='utf-8') as f:
-                content = f.read()
-                exec_globals = {}
-                exec(content, exec_globals)  # pylint: disable=exec-used
-                settings['brokers'] = exec_globals.get('my_brokers', {})
-                settings['ruuvis'] = exec_globals.get('my_ruuvis', {})
-        except (OSError, SyntaxError) as exc:
-            print(f"Error loading example settings: {exc}")
+        cached = SETTINGS_CACHE[path] = (version, settings)
+    # Callers modify the settings before saving them
+    return copy.deepcopy(cached[1])
+
+
+def load_extra_settings():
+    """Load optional settings other than my_brokers and my_ruuvis."""
+    path = config_file()
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        values = ruuvi_config.read(path)
+    except ruuvi_config.ConfigError as exc:
+        print(f"Error loading settings: {exc}")
+        return {}
+    return {name: value for name, value in values.items()
+            if name not in ('my_brokers', 'my_ruuvis')}
+
+
+def detected_file():
+    """Return the detected tags file in the gateway's data directory.
+
+    A relative data_dir is taken from the app directory the gateway runs in.
+    """
+    directory = ruuvi_config.data_dir(load_extra_settings())
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        directory, DETECTED_FILE)
 
-    return settings
+
+def load_detected(ruuvis):
+    """Load unconfigured tags seen by the gateway.
+
+    Args:
+        ruuvis (dict): Configured tags, left out of the result.
+
+    Returns:
+        list: Detected tags, most recently seen first.
+    """
+    try:
+        with open(detected_file(), 'r', encoding='utf-8') as f:
+            detected = json.load(f)
+    except (OSError, ValueError):
+        return []
+    configured = {mac.upper() for mac in ruuvis}
+    detected = [tag for tag in detected if tag.get('mac', '').upper() not in configured]
+    for tag in detected:
+        tag['last_seen_iso'] = time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(tag.get('last_seen', 0)))
+    detected.sort(key=lambda tag: tag.get('last_seen', 0), reverse=True)
+    return detected
 
 
 def save_settings(brokers, ruuvis):
-    """Save settings to settings.py file."""
+    """Save settings to the configuration file the gateway reads.
+
+    settings.py and settings.json are written in their own format,
+    settings.py is created if there is no configuration file. Optional
+    settings already in the file are written back unchanged if they are
+    plain literals. The settings
+    are validated with the gateway's loader first and MAC addresses are
+    normalized.
+
+    Raises:
+        ruuvi_config.ConfigError: If the settings are invalid or the file
+            is settings.toml; nothing is written then.
+    """
+    extra = load_extra_settings()
+    values = ruuvi_config.validate({**extra, 'my_brokers': brokers, 'my_ruuvis': ruuvis})
     try:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            f.write("my_brokers = ")
-            f.write(json.dumps(brokers, indent=2))
-            f.write("\n\n")
-            f.write("my_ruuvis = ")
-            f.write(json.dumps(ruuvis, indent=2))
-            f.write("\n")
+        ruuvi_config.write(config_file() or SETTINGS_FILE, values)
         return True
     except OSError as exc:
         print(f"Error saving settings: {exc}")
@@ -211,6 +299,8 @@ def index():
     return render_template('index.html',
                           brokers=settings['brokers'],
                           ruuvis=settings['ruuvis'],
+                          detected=load_detected(settings['ruuvis']),
+                          fleet=load_extra_settings().get('fleet'),
                           version=__version__)
 
 
@@ -227,9 +317,55 @@ def scan_mqtt():
 
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
-    """API endpoint to get current settings."""
+    """API endpoint to get current settings.
+
+    The ETag and Last-Modified headers follow the settings file version, so
+    polling clients get 304 Not Modified until the file changes.
+    """
+    version = settings_version(settings_path())
+    response = jsonify(load_settings())
+    response.cache_control.no_cache = True
+    if version is not None:
+        response.set_etag(f"{version[0]:x}-{version[1]:x}")
+        response.last_modified = datetime.datetime.fromtimestamp(
+            version[0] / 1e9, tz=datetime.timezone.utc)
+    return response.make_conditional(request)
+
+
+@app.route('/api/detected', methods=['GET'])
+def get_detected():
+    """API endpoint to get unconfigured tags seen by the gateway."""
+    settings = load_settings()
+    return jsonify({'success': True, 'detected': load_detected(settings['ruuvis'])})
+
+
+@app.route('/api/fleet', methods=['POST'])
+def publish_fleet():
+    """API endpoint to publish the current settings to all gateways of the fleet.
+
+    The brokers and RuuviTags are published as a retained, versioned
+    message on the fleet topic of the broker named in the fleet setting.
+    """
+    fleet = load_extra_settings().get('fleet')
+    if not fleet:
+        return jsonify({'success': False, 'message': 'No fleet broker configured'}), 400
     settings = load_settings()
-    return jsonify(settings)
+    broker = settings['brokers'].get(fleet.get('broker'))
+    if broker is None:
+        return jsonify({'success': False, 'message': 'Fleet broker not found'}), 400
+    version = time.time_ns() // 1000000
+    try:
+        mqtt_publish.single(
+            fleet.get('topic', ruuvi_fleet.DEFAULT_TOPIC),
+            ruuvi_fleet.encode(version, settings['brokers'], settings['ruuvis']),
+            qos=1, retain=True, hostname=broker['host'], port=broker['port'],
+            client_id='ruuvi2mqtt-webapp'
+        )
+    except (OSError, ValueError, MQTTException) as exc:
+        # MQTTException: the broker refused the connection, e.g. not authorized
+        return jsonify({'success': False, 'message': f'Error publishing: {exc}'}), 502
+    return jsonify({'success': True, 'version': version,
+                    'message': f'Published configuration version {version}'})
 
 
 @app.route('/api/settings', methods=['POST'])
@@ -243,7 +379,7 @@ def update_settings():
         if save_settings(brokers, ruuvis):
             return jsonify({'success': True, 'message': 'Settings saved successfully'})
         return jsonify({'success': False, 'message': 'Error saving settings'}), 500
-    except (TypeError, AttributeError) as exc:
+    except (TypeError, AttributeError, ruuvi_config.ConfigError) as exc:
         return jsonify({'success': False, 'message': str(exc)}), 400
 
 
@@ -282,7 +418,7 @@ def delete_broker(name):
                 return jsonify({'success': True, 'message': 'Broker deleted successfully'})
             return jsonify({'success': False, 'message': 'Error saving settings'}), 500
         return jsonify({'success': False, 'message': 'Broker not found'}), 404
-    except (TypeError, KeyError) as exc:
+    except (TypeError, KeyError, ruuvi_config.ConfigError) as exc:
         return jsonify({'success': False, 'message': str(exc)}), 400
 
 
@@ -304,7 +440,7 @@ def add_ruuvi():
         if save_settings(settings['brokers'], settings['ruuvis']):
             return jsonify({'success': True, 'message': 'RuuviTag added successfully'})
         return jsonify({'success': False, 'message': 'Error saving RuuviTag'}), 500
-    except (TypeError, AttributeError) as exc:
+    except (TypeError, AttributeError, ruuvi_config.ConfigError) as exc:
         return jsonify({'success': False, 'message': str(exc)}), 400
 
 
@@ -313,6 +449,8 @@ def delete_ruuvi(mac):
     """Delete a RuuviTag mapping."""
     try:
         settings = load_settings()
+        if mac not in settings['ruuvis']:
+            mac = ruuvi_config.normalize_mac(mac)
 
         if mac in settings['ruuvis']:
             del settings['ruuvis'][mac]
@@ -320,10 +458,28 @@ def delete_ruuvi(mac):
                 return jsonify({'success': True, 'message': 'RuuviTag deleted successfully'})
             return jsonify({'success': False, 'message': 'Error saving settings'}), 500
         return jsonify({'success': False, 'message': 'RuuviTag not found'}), 404
-    except (TypeError, KeyError) as exc:
+    except (TypeError, KeyError, ruuvi_config.ConfigError) as exc:
         return jsonify({'success': False, 'message': str(exc)}), 400
 
 
+def serve(port):
+    """Serve the app with waitress, or the Flask server with WEBAPP_DEBUG set.
+
+    Args:
+        port (int): TCP port to listen on.
+    """
+    if os.environ.get('WEBAPP_DEBUG'):
+        app.run(host='0.0.0.0', port=port, debug=True)
+        return
+    try:
+        from waitress import serve as waitress_serve  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print("waitress is not installed, using the Flask development server")
+        app.run(host='0.0.0.0', port=port, threaded=True)
+        return
+    waitress_serve(app, host='0.0.0.0', port=port,
+                   threads=int(os.environ.get('WEBAPP_THREADS', 4)))
+
+
 if __name__ == '__main__':
-    port = int(os.environ.get('WEBAPP_PORT', 5883))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    serve(int(os.environ.get('WEBAPP_PORT', 5883)))
@@ -125,6 +125,60 @@ async function deleteRuuvi(mac) {
     }
 }
 
+// Adopt a detected RuuviTag into the configured tags
+async function adoptRuuvi(mac) {
+    const name = prompt(`Location/name for RuuviTag "${mac}":`);
+    if (!name) {
+        return;
+    }
+
+    try {
+        const response = await fetch('/api/ruuvis', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ mac: mac, name: name })
+        });
+
+        const result = await response.json();
+
+        if (result.success) {
+            showNotification('RuuviTag adopted successfully!', 'success');
+            setTimeout(() => location.reload(), 1000);
+        } else {
+            showNotification(result.message, 'error');
+        }
+    } catch (error) {
+        showNotification('Error adopting RuuviTag', 'error');
+        console.error('Error:', error);
+    }
+}
+
+// Publish the configuration to all gateways of the fleet
+async function publishFleet() {
+    if (!confirm('Publish these brokers and RuuviTags to all gateways?')) {
+        return;
+    }
+
+    try {
+        const response = await fetch('/api/fleet', {
+            method: 'POST'
+        });
+
+        const result = await response.json();
+
+        if (result.success) {
+            showNotification(result.message, 'success');
+        } else {
+            showNotification(result.message, 'error');
+        }
+    } catch (error) {
+        showNotification('Error publishing to fleet', 'error');
+        console.error('Error:', error);
+    }
+}
+
 // Auto-format MAC address input
 document.getElementById('ruuvi-mac').addEventListener('input', (e) => {
     let value = e.target.value.toUpperCase().replace(/[^A-F0-9]/g, '');